@@ -1,13 +1,16 @@
 
 # coding=utf-8
 
-import io
 import logging
+import os
 import struct
+import sys
 
+from array import array
+from collections import deque
 from enum import Enum
+from fractions import Fraction
 
-from formats.structio import BytesStructIO, Endianess
 from formats.util import Bunch
 
 
@@ -22,9 +25,18 @@ class Type(Enum):
 	SHORT = 3
 	LONG = 4
 	RATIONAL = 5
+	SBYTE = 6
 	UNDEFINED = 7
+	SSHORT = 8
 	SLONG = 9
 	SRATIONAL = 10
+	FLOAT = 11
+	DOUBLE = 12
+	IFD = 13
+	# BigTIFF
+	LONG8 = 16
+	SLONG8 = 17
+	IFD8 = 18
 
 Type.size = {
 	Type.BYTE: 1,
@@ -32,11 +44,102 @@ Type.size = {
 	Type.SHORT: 2,
 	Type.LONG: 4,
 	Type.RATIONAL: 8,
+	Type.SBYTE: 1,
 	Type.UNDEFINED: 1,
+	Type.SSHORT: 2,
 	Type.SLONG: 4,
-	Type.SRATIONAL: 8
+	Type.SRATIONAL: 8,
+	Type.FLOAT: 4,
+	Type.DOUBLE: 8,
+	Type.IFD: 4,
+	Type.LONG8: 8,
+	Type.SLONG8: 8,
+	Type.IFD8: 8
 }
 
+Type.format = {
+	Type.BYTE: "B",
+	Type.SHORT: "H",
+	Type.LONG: "I",
+	Type.RATIONAL: "I",
+	Type.SBYTE: "b",
+	Type.SSHORT: "h",
+	Type.SLONG: "i",
+	Type.SRATIONAL: "i",
+	Type.FLOAT: "f",
+	Type.DOUBLE: "d",
+	Type.IFD: "I",
+	Type.LONG8: "Q",
+	Type.SLONG8: "q",
+	Type.IFD8: "Q"
+}
+
+# array typecodes, rationals being two of them each
+Type.typecode = {
+	Type.BYTE: "B",
+	Type.SHORT: "H",
+	Type.LONG: "I" if array("I").itemsize == 4 else "L",
+	Type.RATIONAL: "I" if array("I").itemsize == 4 else "L",
+	Type.SBYTE: "b",
+	Type.SSHORT: "h",
+	Type.SLONG: "i" if array("i").itemsize == 4 else "l",
+	Type.SRATIONAL: "i" if array("i").itemsize == 4 else "l",
+	Type.FLOAT: "f",
+	Type.DOUBLE: "d",
+	Type.IFD: "I" if array("I").itemsize == 4 else "L",
+	Type.LONG8: "Q",
+	Type.SLONG8: "q",
+	Type.IFD8: "Q"
+}
+
+NATIVE = "<" if sys.byteorder == "little" else ">"
+
+
+class RationalArray(object):
+	"""
+	RATIONAL/SRATIONAL values as two integer arrays instead of a list of tuples, indexing still gives (numerator, denominator)
+	"""
+	def __init__(self, numerators, denominators):
+		self.numerators = numerators
+		self.denominators = denominators
+
+	@classmethod
+	def from_array(cls, values):
+		"""
+		From the values as they're stored, numerator and denominator interleaved
+		"""
+		return cls(values[0::2], values[1::2])
+
+	def floats(self):
+		"""
+		All of them divided out in one go (with numpy when there is one), nan where the denominator is 0
+		"""
+		try:
+			import numpy as np
+		except ImportError:
+			return array("d", (n / d if d else float("nan") for (n, d) in zip(self.numerators, self.denominators)))
+		numerators = np.frombuffer(self.numerators, dtype=np.dtype(self.numerators.typecode))
+		denominators = np.frombuffer(self.denominators, dtype=np.dtype(self.denominators.typecode))
+		with np.errstate(divide="ignore", invalid="ignore"):
+			return np.where(denominators == 0, np.nan, numerators / denominators)
+
+	def __len__(self):
+		return len(self.numerators)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return RationalArray(self.numerators[i], self.denominators[i])
+		return (self.numerators[i], self.denominators[i])
+
+	def __iter__(self):
+		return zip(self.numerators, self.denominators)
+
+	def __eq__(self, other):
+		return len(self) == len(other) and all(a == b for (a, b) in zip(self, other))
+
+	def __repr__(self):
+		return "RationalArray({})".format(list(self))
+
 
 class IFDTagType(Enum):
 	# Image data
@@ -74,6 +177,8 @@ class IFDTagType(Enum):
 	Artist = 0x13B
 	Copyright = 0x8298
 	# Tiff stuff
+	NewSubfileType = 0xFE
+	SubfileType = 0xFF
 	FillOrder = 0x10A
 	Predictor = 0x13D
 	ColorMap = 0x140
@@ -84,6 +189,7 @@ class IFDTagType(Enum):
 	InkSet = 0x14C
 	DotRange = 0x150
 	ExtraSamples = 0x152
+	SampleFormat = 0x153
 	# Exif IFD
 	# Version
 	ExifVersion = 0x9000
@@ -184,6 +290,39 @@ class IFDTagType(Enum):
 	ICCProfile = 0x8773
 	ImageSourceData = 0x935C
 	Annotations = 0xC44F
+	# DNG
+	DNGVersion = 0xC612
+	DNGBackwardVersion = 0xC613
+	UniqueCameraModel = 0xC614
+	LocalizedCameraModel = 0xC615
+	CFARepeatPatternDim = 0x828D
+	CFAPattern2 = 0x828E
+	CFAPlaneColor = 0xC616
+	CFALayout = 0xC617
+	LinearizationTable = 0xC618
+	BlackLevelRepeatDim = 0xC619
+	BlackLevel = 0xC61A
+	WhiteLevel = 0xC61D
+	DefaultScale = 0xC61E
+	DefaultCropOrigin = 0xC61F
+	DefaultCropSize = 0xC620
+	ColorMatrix1 = 0xC621
+	ColorMatrix2 = 0xC622
+	CameraCalibration1 = 0xC623
+	CameraCalibration2 = 0xC624
+	AnalogBalance = 0xC627
+	AsShotNeutral = 0xC628
+	BaselineExposure = 0xC62A
+	DNGPrivateData = 0xC634
+	CalibrationIlluminant1 = 0xC65A
+	CalibrationIlluminant2 = 0xC65B
+	OriginalRawFileName = 0xC68B
+	ActiveArea = 0xC68D
+	ForwardMatrix1 = 0xC714
+	ForwardMatrix2 = 0xC715
+	OpcodeList1 = 0xC740
+	OpcodeList2 = 0xC741
+	OpcodeList3 = 0xC74E
 	# Windows Explorer
 	XPTitle = 0x9C9B
 	XPComment = 0x9C9C
@@ -236,6 +375,14 @@ class PhotometricInterpretation(Enum):
 	# this is not defined by the standard... but once again was encountered in the wild
 	Undefined = 5
 	YCbCr = 6
+	# TIFF and DNG ones
+	WhiteIsZero = 0
+	BlackIsZero = 1
+	Palette = 3
+	TransparencyMask = 4
+	CIELab = 8
+	CFA = 32803
+	LinearRaw = 34892
 
 
 class Compression(Enum):
@@ -569,7 +716,7 @@ class GPSVersionID(object):
 		self.major = values[0]
 		self.minor = values[1]
 		self.patch = values[2]
-		self.revision = values[4]
+		self.revision = values[3]
 		return self
 
 
@@ -593,75 +740,260 @@ IFDTagType.IFDPointer = {
 	IFDTagType.SubIFD: IFDTagType
 }
 
+# pointer tags by number, so spotting them doesn't need every tag turned into an enum
+IFDTagType.IFDPointerIds = {tag.value: tag for tag in IFDTagType.IFDPointer}
+
+# everything defined from ExifVersion down to LensSerialNumber belongs in the Exif IFD
+_defined = list(IFDTagType)
+IFDTagType.ExifIFDTags = set(_defined[_defined.index(IFDTagType.ExifVersion):_defined.index(IFDTagType.LensSerialNumber) + 1]) | {
+	IFDTagType.ISO,
+	IFDTagType.OffsetSchema
+}
+del _defined
+
+# tags holding offsets of data elsewhere in the file and the tag with how long each piece is
+IFDTagType.OffsetPairs = {
+	IFDTagType.JPEGInterchangeFormat: IFDTagType.JPEGInterchangeFormatLength,
+	IFDTagType.StripOffsets: IFDTagType.StripByteCounts,
+	IFDTagType.TileOffsets: IFDTagType.TileByteCounts
+}
+
+IFDTagType.InteropIFDTags = {
+	IFDTagType.InteropIndex,
+	IFDTagType.InteropVersion,
+	IFDTagType.RelatedImageFileFormat,
+	IFDTagType.RelatedImageWidth,
+	IFDTagType.RelatedImageHeight
+}
+
+
+def leads_to(pointer, tags):
+	"""
+	Whether any of tags could be in the IFD pointer points at (or one it points to in turn), pointer None being the
+	next IFD in the 0th IFD's chain
+	"""
+	for tag in tags:
+		if isinstance(tag, GPSTagType):
+			if pointer == IFDTagType.GPSIFD:
+				return True
+		elif tag in IFDTagType.InteropIFDTags:
+			if pointer in (IFDTagType.ExifIFD, IFDTagType.InteropIFD):
+				return True
+		elif tag in IFDTagType.ExifIFDTags:
+			if pointer == IFDTagType.ExifIFD:
+				return True
+		elif pointer in (None, IFDTagType.SubIFD):
+			return True
+	return False
+
+
+def tag_type_of(key):
+	"""
+	The tag type of the IFD stored under key in EXIF.ifd
+	"""
+	pointer = key[0] if isinstance(key, tuple) else key
+	return IFDTagType.IFDPointer.get(pointer, IFDTagType) if isinstance(pointer, IFDTagType) else IFDTagType
+
+
+def guess_type(value):
+	"""
+	What a new tag with value gets stored as when it isn't given as (Type, value)
+	"""
+	if isinstance(value, Enum):
+		value = value.value
+	if isinstance(value, str):
+		return Type.ASCII
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return Type.UNDEFINED
+	if isinstance(value, (float, Fraction, RationalArray)) or (isinstance(value, tuple) and len(value) == 2 and all(isinstance(i, int) for i in value)):
+		values = [value]
+	else:
+		values = [value] if isinstance(value, int) else list(value)
+	if any(not isinstance(i, int) for i in values):
+		pairs = [rational(i, True) for i in values]
+		return Type.SRATIONAL if any(i < 0 for pair in pairs for i in pair) else Type.RATIONAL
+	if min(values, default=0) < 0:
+		return Type.SLONG
+	return Type.SHORT if max(values, default=0) <= 0xFFFF else Type.LONG
+
+
+def rational(value, signed):
+	"""
+	(numerator, denominator) out of a pair already or anything Fraction takes
+	"""
+	if isinstance(value, tuple):
+		return value
+	fraction = Fraction(value).limit_denominator(0x7FFFFFFF if signed else 0xFFFFFFFF)
+	return (fraction.numerator, fraction.denominator)
+
+
+def encode_value(kind, value, endian):
+	"""
+	value as a tag of type kind stores it, returns (count, bytes)
+	"""
+	if isinstance(value, Enum):
+		value = value.value
+	if kind == Type.ASCII:
+		data = (value.encode("ascii") if isinstance(value, str) else bytes(value)) + b"\x00"
+		return (len(data), data)
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		data = bytes(value)
+		return (len(data) // Type.size.get(kind, 1), data)
+	if kind in (Type.RATIONAL, Type.SRATIONAL):
+		if isinstance(value, (float, Fraction)) or (isinstance(value, tuple) and len(value) == 2 and all(isinstance(i, int) for i in value)):
+			value = [value]
+		pairs = [rational(i, kind == Type.SRATIONAL) for i in value]
+		flat = [i for pair in pairs for i in pair]
+		return (len(pairs), struct.pack("{}{}{}".format(endian, len(flat), Type.format[kind]), *flat))
+	values = [value] if isinstance(value, int) else list(value)
+	return (len(values), struct.pack("{}{}{}".format(endian, len(values), Type.format[kind]), *values))
+
+
+def typed(value, default):
+	"""
+	Splits an explicit (Type, value) apart, otherwise value goes as default (or a guess when that's None)
+	"""
+	if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], Type):
+		return value
+	return (default or guess_type(value), value)
+
 
 class IFDTag(Bunch):
 	"""
 	IFDTag are in total 12 bytes and usually start @ 8
+	Only count (and offset for values that don't fit in the entry) are filled in straight away, tag, type and value
+	are worked out from the raw entry the first time they're asked for.
 	"""
+	SIZE = 12
+	# how the entry is stored, the IFD's tag count and next offset around it and how much fits in the entry itself
+	ENTRY = "HHII"
+	COUNT = "H"
+	NEXT = "I"
+	INLINE = 4
+	LAZY = ("tag", "type", "value")
+	SIZES = {kind.value: size for (kind, size) in Type.size.items()}
+
 	@classmethod
-	def from_structio(cls, raw, tag_type=IFDTagType):
+	def from_entry(cls, entry, position, buf, endian, tag_type=IFDTagType):
+		"""
+		entry being the unpacked (tag, type, count, value or offset) and position where its value field is in buf
+		"""
 		self = cls()
-		self.tag = raw.read_ushort()
-		try:
-			self.tag = tag_type(self.tag)
-		except ValueError:
-			pass  # print(self.tag)
+		# kept out of the dict itself so it doesn't show up as tag data
+		object.__setattr__(self, "_raw", (entry, position, buf, endian, tag_type))
+		(_, kind, count, field) = entry
+		self.count = count
+		if self.SIZES.get(kind, 1) * count > self.INLINE:
+			self.offset = field
+		return self
 
-		try:
-			self.type = Type(raw.read_ushort())
-		except ValueError:
-			logger.warning("Tag had invalid type pretending it's UNDEFINED.")
-			self.type = Type.UNDEFINED
-
-		self.count = raw.read_uint()
-		total_size = Type.size[self.type] * self.count
-		if total_size <= 4:
-			self.read(raw)
-			raw.seek(max(4 - total_size, 0), io.SEEK_CUR)
-		else:
-			self.offset = raw.read_uint()
-			logger.debug("at {}".format(self.offset))
-			old = raw.tell()
-			raw.seek(self.offset)
-			self.read(raw)
-			raw.seek(old)
-		if self.tag in tag_type.type:
+	@property
+	def id(self):
+		return self._raw[0][0]
+
+	def __missing__(self, key):
+		if key not in self.LAZY:
+			raise KeyError(key)
+		(entry, position, buf, endian, tag_type) = self._raw
+		if key == "tag":
 			try:
-				self.value = tag_type.type[self.tag](self.value)
-			except ValueError as e:
-				logger.warning("Failed to fully parse {} tag due to {}".format(self.tag, e))
+				self.tag = tag_type(entry[0])
+			except ValueError:
+				self.tag = entry[0]
+		elif key == "type":
+			try:
+				self.type = Type(entry[1])
+			except ValueError:
+				logger.warning("Tag had invalid type pretending it's UNDEFINED.")
+				self.type = Type.UNDEFINED
+		else:
+			self.read(buf, dict.get(self, "offset", position), endian)
+			if self.tag in tag_type.type and self.value is not None:
+				try:
+					self.value = tag_type.type[self.tag](bytes(self.value) if isinstance(self.value, memoryview) else self.value)
+				except ValueError as e:
+					logger.warning("Failed to fully parse {} tag due to {}".format(self.tag, e))
+		return dict.__getitem__(self, key)
+
+	def get(self, key, default=None):
+		if key in self.LAZY:
+			return self[key]
+		return dict.get(self, key, default)
+
+	@property
+	def field(self):
+		"""
+		Where the entry's value/offset field is in the exif data (its count is the INLINE bytes before)
+		"""
+		return self._raw[1]
+
+	@property
+	def size(self):
+		return self.SIZES.get(self._raw[0][1], 1) * self.count
+
+	@property
+	def data(self):
+		"""
+		The value's bytes as they're stored
+		"""
+		if self._raw[2] is None:
+			# unpickled, see __reduce_ex__
+			return self._data
+		position = dict.get(self, "offset", self.field)
+		return self._raw[2][position:position + self.size]
+
+	def resolve(self):
+		for key in self.LAZY:
+			self[key]
 		return self
 
-	def read(self, raw):
+	def __reduce_ex__(self, protocol):
+		"""
+		Memoryviews can't be pickled, so everything gets read and the tag goes without the buffer, keeping its own bytes
+		"""
+		self.resolve()
+		items = [(key, bytes(value) if isinstance(value, memoryview) else value) for (key, value) in self.items()]
+		(entry, position, buf, endian, tag_type) = self._raw
+		state = {"_raw": (entry, position, None, endian, tag_type), "_data": bytes(self.data)}
+		return (type(self), (), state, None, iter(items))
+
+	def __setstate__(self, state):
+		for (key, value) in state.items():
+			object.__setattr__(self, key, value)
+
+	def read(self, buf, position, endian):
 		logger.debug("of type {}#{}".format(self.type, self.count))
-		if self.type == Type.UNDEFINED:
-			self.value = raw.read(self.count)
+		size = Type.size[self.type] * self.count
+		if position + size > len(buf):
+			logger.warning("{} runs past the end of the exif data".format(self.tag))
+			self.value = None
+		elif self.type == Type.UNDEFINED:
+			# a view, MakerNotes and the like can be big and often never get looked at
+			self.value = buf[position:position + size]
 		elif self.type == Type.ASCII:
-			self.value = raw.read_string()
+			self.value = bytes(buf[position:position + size]).split(b"\x00", 1)[0]
 			try:
 				self.value = self.value.decode('ascii')
 			except UnicodeDecodeError:
 				logger.debug("Fuck you that wasn't ASCII you anus!!!")
+		elif self.count == 1:
+			if self.type in (Type.RATIONAL, Type.SRATIONAL):
+				self.value = struct.unpack_from("{}2{}".format(endian, Type.format[self.type]), buf, position)
+			else:
+				self.value = struct.unpack_from(endian + Type.format[self.type], buf, position)[0]
 		else:
-			self.value = []
-			for i in range(self.count):
-				if self.type == Type.BYTE:
-					self.value.append(raw.read_ubyte())
-				elif self.type == Type.LONG:
-					self.value.append(raw.read_ulong())
-				elif self.type == Type.RATIONAL:
-					self.value.append((raw.read_ulong(), raw.read_ulong()))
-				elif self.type == Type.SHORT:
-					self.value.append(raw.read_ushort())
-				elif self.type == Type.SLONG:
-					self.value.append(raw.read_long())
-				elif self.type == Type.SRATIONAL:
-					self.value.append((raw.read_long(), raw.read_long()))
-			if self.count == 1:
-				self.value = self.value[0]
+			# straight into an array in one copy, strip offsets and the like can run into the tens of thousands
+			values = array(Type.typecode[self.type])
+			values.frombytes(buf[position:position + size])
+			if endian != NATIVE:
+				values.byteswap()
+			if self.type in (Type.RATIONAL, Type.SRATIONAL):
+				values = RationalArray.from_array(values)
+			self.value = values
 		return self.value
 
 	def __repr__(self):
+		self.resolve()
 		s = "<"
 		if isinstance(self.tag, int):
 			s += "0x{:x}".format(self.tag)
@@ -670,96 +1002,409 @@ class IFDTag(Bunch):
 
 		s += ":{}".format(self.type)
 		if 'value' in self:
-			s += ":{}".format(self.value)
+			s += ":{}".format(self.value.tobytes() if isinstance(self.value, memoryview) else self.value)
 		if 'offset' in self:
 			s += " @ {}".format(self.offset)
 		return s + ">"
 
 
+class BigIFDTag(IFDTag):
+	"""
+	BigTIFF's IFDTag, 20 bytes with an 8 byte count and value/offset field
+	"""
+	SIZE = 20
+	ENTRY = "HHQQ"
+	COUNT = "Q"
+	NEXT = "Q"
+	INLINE = 8
+
+
 class IFD(Bunch):
 	"""
-	IFD blocks are of size (12 * n) + 2 with an upper bound of 786,422
+	IFD blocks are of size (12 * n) + 2 with an upper bound of 786,422, BigTIFF ones (20 * n) + 8
 	"""
 	@classmethod
-	def from_structio(cls, raw, tag_type=IFDTagType):
+	def from_buffer(cls, buf, offset, endian, tag_type=IFDTagType, big=False):
+		"""
+		Parses the IFD at offset straight out of buf (ideally a memoryview, tags keep a reference to it for their values)
+		"""
 		self = cls()
 		self.tags = []
-		self.offset = raw.tell()
-		count = raw.read_ushort()
-		logger.debug("with {} IFDTags @ {}".format(count, self.offset))
+		self.offset = offset
+		entry = BigIFDTag if big else IFDTag
 		try:
-			for i in range(count):
-				logger.debug("Reading IFDTag#{} @ {}".format(i, raw.tell()))
-				tag = IFDTag.from_structio(raw, tag_type=tag_type)
-				if tag is not None:
-					self.tags.append(tag)
+			(count,) = struct.unpack_from(endian + entry.COUNT, buf, offset)
 		except struct.error:
-			print("Truncated IFDTag")
+			logger.warning("IFD @ {} is past the end of the exif data".format(offset))
 			return self
-		self.next = raw.read_uint()
+		logger.debug("with {} IFDTags @ {}".format(count, offset))
+		# the whole entry table in one unpack, values get read from buf when they're asked for
+		start = offset + struct.calcsize(entry.COUNT)
+		end = min(start + entry.SIZE * count, len(buf))
+		end -= (end - start) % entry.SIZE
+		position = start + entry.SIZE - entry.INLINE
+		for fields in struct.iter_unpack(endian + entry.ENTRY, buf[start:end]):
+			self.tags.append(entry.from_entry(fields, position, buf, endian, tag_type))
+			position += entry.SIZE
+		if end < start + entry.SIZE * count:
+			logger.warning("Truncated IFDTag")
+			return self
+		try:
+			(self.next,) = struct.unpack_from(endian + entry.NEXT, buf, end)
+		except struct.error:
+			logger.warning("Truncated IFD, no next offset")
 		return self
 
+	@classmethod
+	def from_structio(cls, raw, tag_type=IFDTagType):
+		"""
+		from_buffer at raw's position, leaving raw after the IFD like reading it would
+		"""
+		self = cls.from_buffer(memoryview(raw.getvalue()), raw.tell(), raw.structs["uint"].format[0], tag_type)
+		raw.seek(self.offset + 2 + IFDTag.SIZE * len(self.tags) + (4 if "next" in self else 0))
+		return self
+
+	def find(self, tag):
+		"""
+		The IFDTag for tag (a tag type or its number) without touching any of the others, None when it isn't there
+		"""
+		number = tag.value if isinstance(tag, Enum) else tag
+		for entry in self.tags:
+			if entry.id == number:
+				return entry
+		return None
+
 
 class EXIF(Bunch):
 	"""
 	The actual embedded exif data is based on riff format, so...
+	Parsed in place, tags read their values out of the buffer it was given (UNDEFINED ones as views of it) when asked.
+	With tags (a collection of IFDTagType/GPSTagType) only IFDs that could hold them get read, only those tags are
+	kept and it stops as soon as it has them all.
+	ifd is keyed by position in the 0th IFD's chain or by the tag that pointed to it, (tag, n) for the nth after the first.
 	"""
-	def __init__(self, handle):
+	def __init__(self, buf, tags=None):
 		self.ifd = {}
-		with handle as self.handle:
-			self.parse()
-		del self.handle
-
-	def parse(self):
-		raw = BytesStructIO(self.handle.read())
-		byte_order = raw.read(2)
+		if hasattr(buf, "read"):
+			with buf as handle:
+				buf = handle.read()
+		buf = memoryview(buf)
+		# kept out of the dict, what writing needs to know about where this came from
+		object.__setattr__(self, "_buf", buf)
+		object.__setattr__(self, "_selection", tags)
+		self.parse(buf, tags)
+
+	def __getstate__(self):
+		# the buffer as bytes as memoryviews can't be pickled, the MakerNote gets worked out again if it's asked for
+		state = {key: value for (key, value) in self.__dict__.items() if key != "_makernote"}
+		state["_buf"] = bytes(self._buf)
+		return state
+
+	def __setstate__(self, state):
+		state["_buf"] = memoryview(state["_buf"])
+		for (key, value) in state.items():
+			object.__setattr__(self, key, value)
+
+	def read_ifd(self, buf, offset, endian, key, tag_type, tags, remaining):
+		"""
+		Reads one IFD into self.ifd[key], returns the pointer tags in it (which are taken out of it)
+		"""
+		ifd = self.ifd[key] = IFD.from_buffer(buf, offset, endian, tag_type=tag_type, big=self._big)
+		# pointer tag -> keys of the IFDs it points at, filled in as they get read
+		ifd.pointers = {}
+		pointers = []
+		kept = []
+		wanted = None if tags is None else {tag.value for tag in tags if isinstance(tag, tag_type)}
+		for tag in ifd.tags:
+			# pointers are just that and not useful to someone deep diving into exif data
+			if tag_type is IFDTagType and tag.id in IFDTagType.IFDPointerIds:
+				pointers.append(tag)
+			elif wanted is None or tag.id in wanted:
+				kept.append(tag)
+		ifd.tags = kept
+		if remaining:
+			found = {tag.id for tag in kept}
+			remaining.difference_update([tag for tag in remaining if isinstance(tag, tag_type) and tag.value in found])
+		return pointers
+
+	def parse(self, buf, tags=None):
+		byte_order = bytes(buf[:2])
 		if byte_order == b"II":
-			raw.set_endian(Endianess.LITTLE)
+			endian = "<"
 		elif byte_order == b"MM":
-			raw.set_endian(Endianess.BIG)
+			endian = ">"
 		else:
 			raise Exception("Invalid byte order '{}'.".format(byte_order))
-
-		if raw.read_ushort() != 42:
-			raise Exception("That wasn't 42, byte order might be wrong.")
-
-		# 0th IFD here we go
-		raw.seek(raw.read_uint())
-		count = 0
-		while True:
-			logger.debug("Reading IFD#{} @ {}".format(count, raw.tell()))
-			ifd = self.ifd[count] = IFD.from_structio(raw)
-			for (i, tag) in enumerate(ifd.tags):
-				if tag.tag in IFDTagType.IFDPointer:
-					logger.debug("Reading IFD['{}'] @ {}".format(tag.tag, tag.value))
-					raw.seek(tag.value)
-					p = self.ifd[tag.tag] = IFD.from_structio(raw, tag_type=IFDTagType.IFDPointer[tag.tag])
-
-					for (j, tag) in enumerate(p.tags):
-						# TODO: get rid of this nested duplication, loop using an array and push onto it an unfilled IFD, concurrent modification exception?
-						if tag.tag in IFDTagType.IFDPointer:
-							raw.seek(tag.value)
-							self.ifd[tag.tag] = IFD.from_structio(raw, tag_type=IFDTagType.IFDPointer[tag.tag])
-							del p.tags[j]
-
-					del ifd.tags[i]  # remove tag from IFD as it's just a pointer and not useful to someone deep diving into exif data
-			if 'next' not in ifd or ifd.next == 0 or ifd.next >= len(raw.getvalue()):
-				break
-			infinite_loop = False
-			for i in self.ifd:
-				if ifd.next == self.ifd[i].offset:
-					infinite_loop = True
-					break
-			if infinite_loop:
+		object.__setattr__(self, "_endian", endian)
+
+		(magic,) = struct.unpack_from(endian + "H", buf, 2)
+		if magic == 42:
+			(offset,) = struct.unpack_from(endian + "I", buf, 4)
+			header = 8
+		elif magic == 43:
+			# BigTIFF, the size of its offsets (always 8), 2 bytes of nothing and an 8 byte offset
+			(size, _, offset) = struct.unpack_from(endian + "HHQ", buf, 4)
+			if size != 8:
+				raise Exception("BigTIFF with {} byte offsets isn't a thing.".format(size))
+			header = 16
+		else:
+			raise Exception("That wasn't 42 (or 43), byte order might be wrong.")
+		object.__setattr__(self, "_big", magic == 43)
+
+		remaining = None if tags is None else set(tags)
+		seen = set()
+		pointed = {}
+		# (offset, chain index or pointer tag, tag type) of IFDs still to be read, 0th IFD here we go
+		pending = deque([(offset, 0, IFDTagType, None)])
+		while pending:
+			if remaining is not None and not remaining:
 				break
-			logger.debug("next IFD at {}".format(ifd.next))
-			raw.seek(ifd.next)
-			count += 1
+			(offset, key, tag_type, parent) = pending.popleft()
+			if offset in seen:
+				logger.warning("IFD {} @ {} was already read, skipping it".format(key, offset))
+				continue
+			if offset < header or offset + 2 > len(buf):
+				logger.warning("IFD {} @ {} is outside the exif data".format(key, offset))
+				continue
+			seen.add(offset)
+			if isinstance(key, IFDTagType):
+				# SubIFD can point at any number of them (DNGs), the first of each kind keeps the plain key
+				n = pointed.get(key, 0)
+				pointed[key] = n + 1
+				self.ifd[parent].pointers.setdefault(key, []).append(key if n == 0 else (key, n))
+				key = key if n == 0 else (key, n)
+			logger.debug("Reading IFD {} @ {}".format(key, offset))
+			following = []
+			for tag in self.read_ifd(buf, offset, endian, key, tag_type, tags, remaining):
+				if remaining is not None and not leads_to(tag.tag, remaining):
+					continue
+				for value in (tag.value if isinstance(tag.value, array) else [tag.value]):
+					if isinstance(value, int):
+						following.append((value, tag.tag, IFDTagType.IFDPointer[tag.tag], key))
+			# pointed to IFDs come before the next one in the chain
+			pending.extendleft(reversed(following))
+			ifd = self.ifd[key]
+			if isinstance(key, int) and ifd.get("next") and (remaining is None or leads_to(None, remaining)):
+				pending.append((ifd.next, key + 1, IFDTagType, None))
+
+	def find(self, tag):
+		"""
+		The IFDTag for tag from whichever IFD has it, None when none do
+		"""
+		for (key, ifd) in self.ifd.items():
+			# GPS tag numbers overlap the rest
+			if (tag_type_of(key) is GPSTagType) != isinstance(tag, GPSTagType):
+				continue
+			found = ifd.find(tag)
+			if found is not None:
+				return found
+		return None
+
+	@property
+	def makernote(self):
+		"""
+		The MakerNote read for whoever made the camera (see formats.makernote), worked out the first time it's asked for,
+		None when there isn't one or it's from someone we don't know
+		"""
+		if "_makernote" not in self.__dict__:
+			from formats.makernote import MakerNote
+			object.__setattr__(self, "_makernote", MakerNote.from_exif(self))
+		return self._makernote
+
+	def patches(self, changes):
+		"""
+		The (position, bytes) writes that make changes (tag: value or (Type, value)) where the values already are,
+		None if any of them can't be done like that (added, removed or pointer tags, a different type or a value
+		bigger than the space the old one had)
+		"""
+		writes = []
+		for (tag, value) in changes.items():
+			entry = None if value is None or tag in IFDTagType.IFDPointer else self.find(tag)
+			if entry is None:
+				return None
+			(kind, value) = typed(value, entry.type)
+			if kind != entry.type:
+				return None
+			(count, data) = encode_value(kind, value, self._endian)
+			if len(data) <= entry.INLINE:
+				writes.append((entry.field, data.ljust(entry.INLINE, b"\x00")))
+			elif "offset" in entry and len(data) <= entry.size:
+				writes.append((entry.offset, data.ljust(entry.size, b"\x00")))
+			else:
+				return None
+			if count != entry.count:
+				writes.append((entry.field - entry.INLINE, struct.pack(self._endian + entry.ENTRY[2], count)))
+		return writes
+
+	def patch(self, fd, base, changes):
+		"""
+		Makes changes in the file fd with a pwrite each, base being where the TIFF header is in it.
+		False (and nothing written) if they don't all fit, see patches.
+		"""
+		writes = self.patches(changes)
+		if writes is None:
+			return False
+		for (position, data) in writes:
+			os.pwrite(fd, data, base + position)
+		return True
+
+	def to_bytes(self, changes=None):
+		"""
+		Serializes the TIFF structure again with changes applied (tag: value or (Type, value), None removing the tag or
+		for pointers every IFD behind it) and every offset worked out afresh, in the same byte order.
+		New tags go in the IFD they belong in, making the Exif or GPS IFD when there isn't one.
+		Thumbnails and strips are carried along, MakerNotes with offsets of their own into the TIFF will be off when
+		they end up somewhere else.
+		"""
+		if self._selection is not None:
+			raise ValueError("only some tags were read, writing would lose the rest")
+		if self._big:
+			raise ValueError("BigTIFF can only be patched, not rewritten")
+		endian = self._endian
+		buf = self._buf
+		nodes = {}
+		for (key, ifd) in self.ifd.items():
+			node = nodes[key] = Bunch(tag_type=tag_type_of(key), entries={}, pointers={}, blobs={})
+			for tag in ifd.tags:
+				if tag._raw[0][1] not in IFDTag.SIZES:
+					# no telling how big its value is, copying it would cut it short
+					raise ValueError("{} has type {} which can't be written".format(tag.tag, tag._raw[0][1]))
+				node.entries[tag.id] = (tag._raw[0][1], tag.count, bytes(tag.data))
+			for (pointer, children) in ifd.get("pointers", {}).items():
+				node.pointers[pointer] = list(children)
+			if node.tag_type is not IFDTagType:
+				continue
+			for (offsets, lengths) in IFDTagType.OffsetPairs.items():
+				(offsets, lengths) = (ifd.find(offsets), ifd.find(lengths))
+				if offsets is None or lengths is None:
+					continue
+				pieces = list(zip(*[i.value if isinstance(i.value, array) else [i.value] for i in (offsets, lengths)]))
+				if any(start + length > len(buf) for (start, length) in pieces):
+					logger.warning("{} points outside the exif data, leaving it as is".format(offsets.tag))
+					continue
+				node.blobs[offsets.id] = [bytes(buf[start:start + length]) for (start, length) in pieces]
+
+		def drop(key):
+			stack = [key]
+			while stack:
+				node = nodes.pop(stack.pop(), None)
+				if node is not None:
+					stack.extend(child for children in node.pointers.values() for child in children)
+
+		for (tag, value) in (changes or {}).items():
+			tag_type = GPSTagType if isinstance(tag, GPSTagType) else IFDTagType
+			if tag in IFDTagType.IFDPointer:
+				if value is not None:
+					raise ValueError("{} is worked out when writing, it can only be removed".format(tag))
+				for node in list(nodes.values()):
+					for child in node.pointers.pop(tag, []):
+						drop(child)
+				continue
+			home = [key for (key, node) in nodes.items() if node.tag_type is tag_type and tag.value in node.entries]
+			if value is None:
+				for key in home:
+					del nodes[key].entries[tag.value]
+					nodes[key].blobs.pop(tag.value, None)
+				continue
+			if not home:
+				if tag_type is GPSTagType:
+					home = [IFDTagType.GPSIFD]
+				elif tag in IFDTagType.InteropIFDTags:
+					home = [IFDTagType.InteropIFD]
+				elif tag in IFDTagType.ExifIFDTags:
+					home = [IFDTagType.ExifIFD]
+				else:
+					home = [0]
+				if home[0] not in nodes:
+					if home[0] == IFDTagType.InteropIFD or 0 not in nodes:
+						raise ValueError("no IFD to put {} in".format(tag))
+					nodes[home[0]] = Bunch(tag_type=tag_type, entries={}, pointers={}, blobs={})
+					nodes[0].pointers[home[0]] = [home[0]]
+			node = nodes[home[0]]
+			(kind, value) = typed(value, Type(node.entries[tag.value][0]) if tag.value in node.entries and node.entries[tag.value][0] in IFDTag.SIZES else None)
+			(count, data) = encode_value(kind, value, endian)
+			node.entries[tag.value] = (kind.value, count, data)
+			node.blobs.pop(tag.value, None)
+
+		def even(n):
+			return n + (n & 1)
+
+		# the 0th IFD's chain, each followed by the IFDs it points to (and those they point to...)
+		order = []
+		placed = set()
+		stack = sorted((key for key in nodes if isinstance(key, int)), reverse=True)
+		while stack:
+			key = stack.pop()
+			if key not in nodes or key in placed:
+				continue
+			order.append(key)
+			placed.add(key)
+			stack.extend(reversed([child for children in nodes[key].pointers.values() for child in children if child in nodes]))
+
+		sizes = {}
+		for key in order:
+			node = nodes[key]
+			node.pointers = {pointer: [child for child in children if child in nodes] for (pointer, children) in node.pointers.items()}
+			node.pointers = {pointer: children for (pointer, children) in node.pointers.items() if children}
+			size = 2 + IFDTag.SIZE * (len(node.entries) + len(node.pointers)) + 4
+			size += sum(even(len(data)) for (_, _, data) in node.entries.values() if len(data) > 4)
+			size += sum(4 * len(children) for children in node.pointers.values() if len(children) > 1)
+			size += sum(even(len(blob)) for blobs in node.blobs.values() for blob in blobs)
+			sizes[key] = size
+		offsets = {}
+		position = 8
+		for key in order:
+			offsets[key] = position
+			position += sizes[key]
+
+		out = bytearray(position)
+		out[0:8] = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI", 42, 8)
+		for key in order:
+			node = nodes[key]
+			start = offsets[key]
+			entries = dict(node.entries)
+			# pieces go after everything else, the offsets tag then points at where they went
+			position = start + sizes[key] - sum(even(len(blob)) for blobs in node.blobs.values() for blob in blobs)
+			for (number, blobs) in node.blobs.items():
+				moved = []
+				for blob in blobs:
+					out[position:position + len(blob)] = blob
+					moved.append(position)
+					position += even(len(blob))
+				(kind, count, _) = entries[number]
+				entries[number] = (kind, count, encode_value(Type(kind), moved if count > 1 else moved[0], endian)[1])
+			for (pointer, children) in node.pointers.items():
+				entries[pointer.value] = (Type.LONG.value, len(children), struct.pack("{}{}I".format(endian, len(children)), *[offsets[child] for child in children]))
+
+			struct.pack_into(endian + "H", out, start, len(entries))
+			position = start + 2 + IFDTag.SIZE * len(entries) + 4
+			for (i, number) in enumerate(sorted(entries)):
+				(kind, count, data) = entries[number]
+				if len(data) <= 4:
+					field = data.ljust(4, b"\x00")
+				else:
+					field = struct.pack(endian + "I", position)
+					out[position:position + len(data)] = data
+					position += even(len(data))
+				struct.pack_into(endian + "HHI4s", out, start + 2 + IFDTag.SIZE * i, number, kind, count, field)
+			following = offsets.get(key + 1, 0) if isinstance(key, int) else 0
+			struct.pack_into(endian + "I", out, start + 2 + IFDTag.SIZE * len(entries), following)
+		return bytes(out)
+
+	@classmethod
+	def new(cls, endian=">"):
+		"""
+		An EXIF with nothing in it but an empty 0th IFD, for to_bytes to add tags to
+		"""
+		return cls((b"II" if endian == "<" else b"MM") + struct.pack(endian + "HIHI", 42, 8, 0, 0))
 
 	@classmethod
-	def from_buffer(cls, buf):
-		return cls(buf)
+	def from_buffer(cls, buf, tags=None):
+		"""
+		buf being bytes, a memoryview (of just the exif part of something bigger, nothing gets copied) or a readable handle
+		"""
+		return cls(buf, tags)
 
 	@classmethod
-	def from_file(cls, path):
-		return cls(open(path, "rb"))
+	def from_file(cls, path, tags=None):
+		return cls(open(path, "rb"), tags)
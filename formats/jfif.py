@@ -2,18 +2,23 @@
 # coding=utf-8
 
 import codecs
+import hashlib
 import io
 import logging
 import math
+import os
+import re
 import struct
 import traceback
 
+from array import array
 from enum import Enum
 from pathlib import Path
 from pprint import pprint
 
 from formats.exif import EXIF
 from formats.icc import ICCProfile
+from formats.mpf import MPF
 from formats.photoshop import Resource as PhotoshopResource, ResourceType as PhotoshopResourceType, PhotoshopError
 from formats.structio import BytesStructIO
 from formats.util import Bunch
@@ -27,6 +32,204 @@ logger.setLevel(logging.INFO)
 def split_4bit(i):
 	return ((i & 0xF0) >> 4, i & 0x0F)
 
+# zigzag position -> natural (row major) position within a block
+ZIGZAG = [
+	0, 1, 8, 16, 9, 2, 3, 10,
+	17, 24, 32, 25, 18, 11, 4, 5,
+	12, 19, 26, 33, 40, 48, 41, 34,
+	27, 20, 13, 6, 7, 14, 21, 28,
+	35, 42, 49, 56, 57, 50, 43, 36,
+	29, 22, 15, 23, 30, 37, 44, 51,
+	58, 59, 52, 45, 38, 31, 39, 46,
+	53, 60, 61, 54, 47, 55, 62, 63,
+]
+
+# the example tables from annex K.1 that libjpeg scales by quality, natural order
+IJG_LUMINANCE = [
+	16, 11, 10, 16, 24, 40, 51, 61,
+	12, 12, 14, 19, 26, 58, 60, 55,
+	14, 13, 16, 24, 40, 57, 69, 56,
+	14, 17, 22, 29, 51, 87, 80, 62,
+	18, 22, 37, 56, 68, 109, 103, 77,
+	24, 35, 55, 64, 81, 104, 113, 92,
+	49, 64, 78, 87, 103, 121, 120, 101,
+	72, 92, 95, 98, 112, 100, 103, 99,
+]
+IJG_CHROMINANCE = [
+	17, 18, 24, 47, 99, 99, 99, 99,
+	18, 21, 26, 66, 99, 99, 99, 99,
+	24, 26, 56, 99, 99, 99, 99, 99,
+	47, 66, 99, 99, 99, 99, 99, 99,
+	99, 99, 99, 99, 99, 99, 99, 99,
+	99, 99, 99, 99, 99, 99, 99, 99,
+	99, 99, 99, 99, 99, 99, 99, 99,
+	99, 99, 99, 99, 99, 99, 99, 99,
+]
+
+def ijg_table(base, quality):
+	"""
+	base scaled the way libjpeg's jpeg_set_quality does it (forced into baseline's 8 bits)
+	"""
+	scale = 5000 // quality if quality < 50 else 200 - quality * 2
+	return [min(max((value * scale + 50) // 100, 1), 255) for value in base]
+
+def estimate_quality(tables):
+	"""
+	Guesses the libjpeg quality setting from {table id: natural order table} by finding the quality whose scaled
+	IJG tables are closest, table 0 against luminance and table 1 (if there is one) against chrominance.
+	exact says whether they're a perfect match, anything that isn't was probably made by something other than libjpeg
+	with error giving the mean difference per entry.
+	"""
+	pairs = [(tables[tid], base) for (tid, base) in ((0, IJG_LUMINANCE), (1, IJG_CHROMINANCE)) if tid in tables]
+	if not pairs:
+		return None
+	best = None
+	for quality in range(1, 101):
+		error = 0
+		for (table, base) in pairs:
+			error += sum(abs(a - b) for (a, b) in zip(table, ijg_table(base, quality)))
+		if best is None or error < best[1]:
+			best = (quality, error)
+	(quality, error) = best
+	return Bunch(quality=quality, exact=error == 0, error=error / (64 * len(pairs)))
+
+def find_marker(buf, start=0, end=None):
+	"""
+	Finds the next real marker in entropy coded data, stepping over stuffed 0xFF00, RSTn and 0xFF fill bytes.
+	Returns the offset of its 0xFF or -1 if buf runs out first (including a 0xFF as the very last byte).
+	"""
+	if end is None:
+		end = len(buf)
+	pos = start
+	while True:
+		pos = buf.find(b"\xff", pos, end)
+		if pos == -1 or pos + 1 >= end:
+			return -1
+		c = buf[pos + 1]
+		if c == 0x00 or (c >= 0xD0 and c <= 0xD7):
+			pos += 2
+		elif c == 0xFF:
+			pos += 1
+		else:
+			return pos
+
+def scan_segments(buf, start):
+	"""
+	Splits the entropy coded data starting at start into its restart intervals.
+	Returns ([(start, end)] of each interval not including the RSTn between them, offset of the marker ending the scan).
+	"""
+	segments = []
+	pos = start
+	while True:
+		pos = buf.find(b"\xff", pos)
+		if pos == -1 or pos + 1 >= len(buf):
+			segments.append((start, len(buf)))
+			return (segments, len(buf))
+		c = buf[pos + 1]
+		if c == 0x00:
+			pos += 2
+		elif c == 0xFF:
+			pos += 1
+		elif c >= 0xD0 and c <= 0xD7:
+			segments.append((start, pos))
+			pos += 2
+			start = pos
+		else:
+			segments.append((start, pos))
+			return (segments, pos)
+
+def skip_entropy(handle, block_size=None):
+	"""
+	Moves handle from inside entropy coded data to the next marker that isn't RSTn (or EOF).
+	"""
+	block_size = block_size or JFIF.SCAN_BLOCK
+	carry = b""
+	while True:
+		block = handle.read(block_size)
+		if len(block) == 0:
+			return False
+		buf = carry + block if carry else block
+		pos = find_marker(buf)
+		if pos != -1:
+			handle.seek(pos - len(buf), io.SEEK_CUR)
+			return True
+		# a 0xFF right at the end of the block needs the next block to know what it is
+		carry = buf[-1:] if buf[-1] == 0xFF else b""
+
+def layout_components(frame):
+	"""
+	Fills in the sampled size (x by y) of each component of a parsed SOF from its sampling factors
+	"""
+	hmax = max(component['h_sample'] for component in frame['components'].values())
+	vmax = max(component['v_sample'] for component in frame['components'].values())
+	for component in frame['components'].values():
+		component['x'] = math.ceil(frame['samples_per_line'] * (component['h_sample'] / hmax))
+		component['y'] = math.ceil(frame['lines'] * (component['v_sample'] / vmax))
+	return (hmax, vmax)
+
+def app_name(peek):
+	"""
+	The identifier at the start of an APPn payload or None if it doesn't have one
+	"""
+	if b"\x00" not in peek:
+		return None
+	return peek.split(b"\x00", 1)[0].strip()
+
+def copy_range(src, dst, offset, count, block_size=None):
+	"""
+	Copies count bytes (or everything if None) from offset in src to wherever dst is at,
+	handing it to the kernel with copy_file_range/sendfile when both ends are real files and reading blocks through otherwise.
+	Returns how many bytes were copied.
+	"""
+	copied = 0
+	try:
+		(infd, outfd) = (src.fileno(), dst.fileno())
+	except (AttributeError, io.UnsupportedOperation):
+		infd = None
+
+	if infd is not None:
+		if count is None:
+			count = max(0, os.fstat(infd).st_size - offset)
+		dst.flush()
+		kernel = [
+			getattr(os, "copy_file_range", None) and (lambda n: os.copy_file_range(infd, outfd, n, offset + copied)),
+			getattr(os, "sendfile", None) and (lambda n: os.sendfile(outfd, infd, offset + copied, n))
+		]
+		for copy in filter(None, kernel):
+			try:
+				while copied < count:
+					sent = copy(count - copied)
+					if sent == 0:
+						break
+					copied += sent
+			except OSError as e:
+				# cross filesystem on older kernels, pipes, etc. try the next way
+				logger.debug("Kernel copy failed after {} bytes, {}".format(copied, e))
+				continue
+			break
+		# the kernel moved the fd along behind the buffered object's back
+		dst.seek(os.lseek(outfd, 0, os.SEEK_CUR))
+		if copied == count:
+			return copied
+
+	block_size = block_size or JFIF.SCAN_BLOCK
+	src.seek(offset + copied)
+	while count is None or copied < count:
+		block = src.read(block_size if count is None else min(block_size, count - copied))
+		if not block:
+			break
+		dst.write(block)
+		copied += len(block)
+	return copied
+
+def segment_bytes(marker, payload):
+	"""
+	Builds a whole marker segment out of its payload (everything after the length, APPn identifier included)
+	"""
+	if len(payload) > 0xFFFF - 2:
+		raise ValueError("{} payload of {} bytes won't fit in a segment".format(marker.name, len(payload)))
+	return struct.pack(">BBH", 0xFF, marker.value, len(payload) + 2) + payload
+
 def read_nulstring(s, start=0):
 	for i in range(start, len(s)):
 		if s[i:i + 1] == b'\x00':
@@ -119,19 +322,58 @@ class Marker(Enum):
 	# reserved extensions end
 	COM = 0xFE  # comment
 
-	def read_markerseg(self, handle):
+	def read_markerseg(self, handle, ctx=None):
 		l = max(struct.unpack(">H", handle.read(2))[0], 2) - 2
 		logger.debug("Reading marker of length {} @ {}".format(l, handle.tell()))
 		return handle.read(l)
 
-	def read_blob(self, handle):
+	def read_blob(self, handle, ctx=None):
 		return codecs.encode(self.read_markerseg(handle), "hex").decode("ascii")
 
-	def parse_short(self, handle):
+	def parse_dqt(self, handle, ctx=None):
+		"""
+		{table id: 64 entry array in natural order}, array('B') for 8 bit tables and array('H') for 16 bit ones
+		"""
+		raw = self.read_markerseg(handle)
+		tables = {}
+		pos = 0
+		while pos < len(raw):
+			(precision, tid) = split_4bit(raw[pos])
+			if precision == 0:
+				(values, table) = (raw[pos + 1:pos + 65], array("B", bytes(64)))
+				pos += 65
+			else:
+				(values, table) = (struct.unpack_from(">64H", raw, pos + 1), array("H", bytes(128)))
+				pos += 129
+			if len(values) < 64:
+				raise ValueError("DQT table {} is cut short".format(tid))
+			for (k, value) in enumerate(values):
+				table[ZIGZAG[k]] = value
+			tables[tid] = table
+		return tables
+
+	def parse_dht(self, handle, ctx=None):
+		"""
+		{(class, table id): {"counts": codes of each length 1-16, "values": symbols in code order}}, class 0 being DC and 1 AC
+		"""
+		raw = self.read_markerseg(handle)
+		tables = {}
+		pos = 0
+		while pos < len(raw):
+			(table_class, tid) = split_4bit(raw[pos])
+			counts = list(raw[pos + 1:pos + 17])
+			values = list(raw[pos + 17:pos + 17 + sum(counts)])
+			if len(counts) < 16 or len(values) < sum(counts):
+				raise ValueError("DHT table {}/{} is cut short".format(table_class, tid))
+			tables[(table_class, tid)] = {"counts": counts, "values": values}
+			pos += 17 + sum(counts)
+		return tables
+
+	def parse_short(self, handle, ctx=None):
 		handle.read(2)  # length, who cares
 		return struct.unpack(">H", handle.read(2))[0]
 
-	def parse_sof(self, handle):
+	def parse_sof(self, handle, ctx=None):
 		raw = io.BytesIO(self.read_markerseg(handle))
 		sample_precision = struct.unpack(">B", raw.read(1))[0]
 		lines = struct.unpack(">H", raw.read(2))[0]
@@ -145,19 +387,20 @@ class Marker(Enum):
 			components[id] = {"h_sample": h_sample, "v_sample": v_sample, "quant_dest": quant_dest}
 		return {"sample_precision": sample_precision, "lines": lines, "samples_per_line": samples_per_line, "components": components}
 
-	def parse_sos(self, handle):
+	def parse_sos(self, handle, ctx=None):
 		raw = io.BytesIO(self.read_markerseg(handle))
 		components = {}
 		for i in range(ord(raw.read(1))):
 			# selector, dc entropy dest, ac entropy dest
+			selector = ord(raw.read(1))
 			(dc_entropy, ac_entropy) = split_4bit(ord(raw.read(1)))
-			components[ord(raw.read(1))] = {"dc_entropy": dc_entropy, "ac_entropy": ac_entropy}
+			components[selector] = {"dc_entropy": dc_entropy, "ac_entropy": ac_entropy}
 		spectral_selection = ord(raw.read(1))
 		end_of_spectral = ord(raw.read(1))
 		(bit_high, bit_low) = split_4bit(ord(raw.read(1)))
 		return {"components": components, "spectral_selection": spectral_selection, "end_of_spectral": end_of_spectral, "bit_high": bit_high, "bit_low": bit_low}
 
-	def parse_jfif_app0(self, name, handle):
+	def parse_jfif_app0(self, name, handle, ctx):
 		(version, units, x_dens, y_dens, x_thumb, y_thumb) = struct.unpack(">2sBHHBB", handle.read(9))
 		dat = {"version": "{}.{}".format(version[0], version[1]), "units": Units(units), "x_density": x_dens, "y_density": y_dens}
 		thumb_res = (3 * (x_thumb * y_thumb))
@@ -167,7 +410,7 @@ class Marker(Enum):
 			dat['thumb'] = handle.read(thumb_res)
 		return dat
 
-	def parse_app(self, handle):
+	def parse_app(self, handle, ctx):
 		parsed = self.read_markerseg(handle)
 		raw = BytesStructIO(parsed)
 		try:
@@ -175,28 +418,31 @@ class Marker(Enum):
 		except EOFError:
 			return parsed
 		try:
-			return Marker.app_handlers[self][name](self, name, raw)
+			handler = Marker.app_handlers[self][name]
 		except KeyError:
 			return parsed
+		return handler(self, name, raw, ctx)
 
-	def parse_exif(self, name, raw):
-		raw.seek(1, io.SEEK_CUR)
+	def parse_exif(self, name, raw, ctx):
 		logger.debug("Found Exif APP1 data!")
-		return EXIF.from_buffer(raw)
+		# a view of the segment past "Exif\0\0" rather than another copy of it
+		return EXIF.from_buffer(memoryview(raw.getvalue())[raw.tell() + 1:], ctx.exif_tags if ctx is not None else None)
 
-	def parse_xmp(self, name, raw):
+	def parse_xmp(self, name, raw, ctx):
 		if name == b"XMP":
 			domain = raw.read_string()
 		else:
 			domain = name
 		logger.debug("Found XMP ({}) APP1 data!".format(domain))
-		self.xmp = raw.read()
-
-	def parse_iccp(self, name, raw):
-		raw.seek(2, io.SEEK_CUR)  # there's two junk bytes? they might mean something just don't know
-		return ICCProfile.parse(raw.read())
+		if domain == b"http://ns.adobe.com/xmp/extension/":
+			# 32 character md5 of the whole extension as its guid, the extension's full length and where this piece goes
+			guid = raw.read(32).decode("ascii", "replace").upper()
+			(length, offset) = struct.unpack(">II", raw.read(8))
+			ctx.add_xmp_extension(guid, length, offset, raw.read())
+		else:
+			ctx.xmp = raw.read()
 
-	def parse_photoshop(self, name, raw):
+	def parse_photoshop(self, name, raw, ctx=None):
 		resources = []
 		while True:
 			try:
@@ -209,44 +455,37 @@ class Marker(Enum):
 				pass
 		return resources
 
-	def parse_photoshop_web(self, name, raw):
+	def parse_photoshop_web(self, name, raw, ctx):
 		param = {}
 		param['quality'] = raw.read_uint()
 		param['comment'] = raw.read_string()
 		param['copyright'] = raw.read_string()
 		return param
 
-	def handler(self, handle):
+	def handler(self, handle, ctx):
 		if self in Marker.handlers:
-			return Marker.handlers[self](self, handle)
+			return Marker.handlers[self](self, handle, ctx)
 
-	@classmethod
-	def reset(self):
-		# TODO: not this, make Marker have a reference to JFIF instead?
-		self.icc = b""
-		self.photoshop = b""
+	def append_iccp(self, name, raw, ctx):
+		# profiles too big for one segment are split up, each piece is prefixed with its 1-based sequence number and the total
+		(seq, total) = struct.unpack(">BB", raw.read(2))
+		ctx.icc[seq] = raw.read()
 
-	def append_iccp(self, name, raw):
-		Marker.icc += raw.read()
+	def parse_mpf(self, name, raw, ctx):
+		logger.debug("Found MPF APP2 data!")
+		return MPF.from_buffer(raw.read())
 
-	def append_photoshop(self, name, raw):
-		Marker.photoshop += raw.read()
+	def append_photoshop(self, name, raw, ctx):
+		ctx.photoshop.append(raw.read())
 
-	def parse_adobe(self, name, raw):
+	def parse_adobe(self, name, raw, ctx):
 		(version, flags0, flags1, color_transform) = struct.unpack(">BHHB", raw.read(6))
 		return {"version": version, "flags0": flags0, "flags1": flags1, "color_transform": color_transform}
 
-	@classmethod
-	def finalize(self, jfif):
-		if len(Marker.icc) > 0:
-			jfif.icc = self.parse_iccp(self, "", BytesStructIO(Marker.icc))
-		if len(Marker.photoshop) > 0:
-			jfif.photshop = self.parse_photoshop(self, "", BytesStructIO(Marker.photoshop))
-
 
 Marker.handlers = {
-	Marker.DHT: Marker.read_blob,
-	Marker.DQT: Marker.read_blob,
+	Marker.DHT: Marker.parse_dht,
+	Marker.DQT: Marker.parse_dqt,
 	Marker.DRI: Marker.parse_short,
 	Marker.SOS: Marker.parse_sos,
 	Marker.DNL: Marker.parse_short,
@@ -293,6 +532,23 @@ for i in Marker.APP:
 	Marker.handlers[i] = Marker.parse_app
 
 
+Marker.RST = [
+	Marker.RST0,
+	Marker.RST1,
+	Marker.RST2,
+	Marker.RST3,
+	Marker.RST4,
+	Marker.RST5,
+	Marker.RST6,
+	Marker.RST7,
+]
+
+Marker.XMP = [
+	b"http://ns.adobe.com/xap/1.0/",
+	b"http://ns.adobe.com/xmp/extension/",
+	b"XMP"
+]
+
 Marker.app_handlers = {
 	Marker.APP0: {
 		b"JFIF": Marker.parse_jfif_app0
@@ -304,7 +560,8 @@ Marker.app_handlers = {
 		b"XMP": Marker.parse_xmp
 	},
 	Marker.APP2: {
-		b"ICC_PROFILE": Marker.append_iccp
+		b"ICC_PROFILE": Marker.append_iccp,
+		b"MPF": Marker.parse_mpf
 	},
 	Marker.APP12: {
 		b"Ducky": Marker.parse_photoshop_web
@@ -318,6 +575,78 @@ Marker.app_handlers = {
 }
 
 
+class ParseContext:
+	"""
+	State that builds up over the course of parsing a single file (segmented ICC/Photoshop payloads, XMP),
+	kept out of Marker so separate parses don't trample each other.
+	"""
+
+	# extended XMP buffers get sized from what the segment says, no real one comes anywhere near this
+	XMP_EXTENSION_LIMIT = 64 * 1024 * 1024
+
+	def __init__(self, exif_tags=None):
+		self.icc = {}
+		self.photoshop = []
+		# only these get pulled out of the exif, see EXIF
+		self.exif_tags = exif_tags
+		self.xmp = None
+		self.xmp_extension = {}
+
+	def add_xmp_extension(self, guid, length, offset, chunk):
+		"""
+		Pieces of each extension go straight into their place in a buffer sized up front from the length they all carry
+		"""
+		if guid not in self.xmp_extension:
+			if length > self.XMP_EXTENSION_LIMIT:
+				logger.warning("Extended XMP {} claims to be {} bytes, ignoring it".format(guid, length))
+				return
+			self.xmp_extension[guid] = (bytearray(length), {})
+		(buf, pieces) = self.xmp_extension[guid]
+		if length != len(buf):
+			logger.warning("Extended XMP {} piece @ {} says the length is {} not {}, ignoring it".format(guid, offset, length, len(buf)))
+			return
+		if offset + len(chunk) > len(buf):
+			logger.warning("Extended XMP {} piece @ {}+{} runs past its length {}".format(guid, offset, len(chunk), len(buf)))
+			return
+		memoryview(buf)[offset:offset + len(chunk)] = chunk
+		pieces[offset] = len(chunk)
+
+	def extended_xmp(self):
+		"""
+		The extension the main XMP points at with xmpNote:HasExtendedXMP (or the only one if it doesn't say),
+		None if it's missing pieces or doesn't match its checksum
+		"""
+		wanted = None
+		if self.xmp is not None:
+			found = re.search(rb"HasExtendedXMP(?:=[\"']|>)([0-9A-Fa-f]{32})", self.xmp)
+			if found:
+				wanted = found.group(1).decode("ascii").upper()
+		for (guid, (buf, pieces)) in self.xmp_extension.items():
+			if wanted is not None and guid != wanted:
+				logger.debug("Ignoring extended XMP {} as the main XMP wants {}".format(guid, wanted))
+				continue
+			if sum(pieces.values()) != len(buf):
+				logger.warning("Extended XMP {} is missing pieces, got {} of {} bytes".format(guid, sum(pieces.values()), len(buf)))
+				continue
+			if hashlib.md5(buf).hexdigest().upper() != guid:
+				logger.warning("Extended XMP {} doesn't match its checksum".format(guid))
+				continue
+			return bytes(buf)
+		return None
+
+	def finalize(self, jfif):
+		if len(self.icc) > 0:
+			jfif.icc = ICCProfile.parse(b"".join(self.icc[i] for i in sorted(self.icc)))
+		if len(self.photoshop) > 0:
+			jfif.photoshop = Marker.parse_photoshop(Marker.APP13, "", BytesStructIO(b"".join(self.photoshop)))
+		if self.xmp is not None:
+			jfif.xmp = self.xmp
+		if len(self.xmp_extension) > 0:
+			extension = self.extended_xmp()
+			if extension is not None:
+				jfif.xmp_extension = extension
+
+
 class JFIF(Bunch):
 	"""
 	Little Endian (MSB is left handed)
@@ -330,22 +659,32 @@ class JFIF(Bunch):
 	DONE_ON_FRAME = True
 	# done_on_frame will kill the loop before we even reach scan.
 	DONE_ON_SCAN = False
+	# how much entropy coded data gets searched for the next marker at once
+	SCAN_BLOCK = 1024 * 1024
+	# how much probe reads up front, almost every jpeg has its headers in the first 64K
+	PROBE_READAHEAD = 64 * 1024
 
-	def __init__(self, handle):
-		Marker.reset()
+	def __init__(self, handle, exif_tags=None):
 		self.markers = []
+		ctx = ParseContext(exif_tags)
 		with handle as self.handle:
-			self.parse()
+			self.parse(ctx)
 
-		Marker.finalize(self)
+		ctx.finalize(self)
 
 		del self.handle
 
 	def marker_parser(self):
 		while True:
-			c = ord(self.handle.read(1)) # Read marker start
+			c = self.handle.read(1) # Read marker start
+			if len(c) == 0:
+				logger.error("Hit end of file before EOI @ {}".format(self.handle.tell()))
+				break
+			c = ord(c)
 			if c == 0xFF:
 				c = ord(self.handle.read(1)) # Read marker id
+				while c == 0xFF:
+					c = ord(self.handle.read(1)) # Fill bytes can pad out any marker
 				try:
 					yield Marker(c) # Read all of marker
 				except (KeyError, ValueError):
@@ -357,60 +696,535 @@ class JFIF(Bunch):
 				self.handle.seek(-1, io.SEEK_CUR) # Seek back after reading crap byte
 				break
 
-	def parse(self):
+	def parse(self, ctx):
 		for marker in self.marker_parser():
 			logger.debug(marker)
+			start = self.handle.tell()
 			try:
-				parsed = Marker.handler(marker, self.handle)
-			except Exception as e:
-				logger.error("Failed to parse {} due to:\n{}".format(marker, traceback.format_exc(e)))
+				parsed = Marker.handler(marker, self.handle, ctx)
+			except Exception:
+				logger.error("Failed to parse {} due to:\n{}".format(marker, traceback.format_exc()))
 				continue
 			self.markers.append((marker, parsed))
 			if marker == Marker.EOI:
 				break
 			elif marker == Marker.COM:
 				self.comment = parsed
+			elif marker == Marker.APP2 and isinstance(parsed, MPF):
+				# offsets in there count from its TIFF header, after the length and "MPF\0"
+				self.mpf = parsed.locate(start + 6)
+			elif marker == Marker.DQT:
+				self.setdefault("quantization", {}).update(parsed)
+			elif marker == Marker.DHT:
+				self.setdefault("huffman", {}).update(parsed)
 			elif marker in Marker.SOF:
+				self.update(parsed)
+				layout_components(self)
+				self.data_unit_size = self.sample_precision // 8
+
 				if JFIF.DONE_ON_FRAME:
 					break
+			elif marker == Marker.SOS:
+				# there are restart_interval mcus in one scan interval, actually decoding them is jfif_decode's job
+				if JFIF.DONE_ON_SCAN:
+					break
 
-				self.update(parsed)
-				hmax = 0
-				vmax = 0
-				for (i, component) in self.components.items():
-					hmax = max(hmax, component['h_sample'])
-					vmax = max(vmax, component['v_sample'])
+				skip_entropy(self.handle)
 
-				for (i, component) in self.components.items():
-					component['x'] = math.ceil(self.lines * (component['h_sample'] / hmax))
-					component['y'] = math.ceil(self.samples_per_line * (component['v_sample'] / vmax))
+	@property
+	def quality(self):
+		"""
+		See estimate_quality, None when no quantization tables turned up
+		"""
+		return estimate_quality(self.get("quantization", {}))
 
-				self.data_unit_size = self.sample_precision // 8
-			elif marker == Marker.SOS:
-				# there are restart_interval mcus in one scan interval
-				# if this does ever get implemented it should probably goto a c module for huffman, quantization and dct decoding (as python will assuredly be ULTRA slow at it)
-				if JFIF.DONE_ON_SCAN:
+	@classmethod
+	def from_file(cls, path, exif_tags=None):
+		jfif = cls(open(path, "rb"), exif_tags)
+		jfif.path = str(path)
+		return jfif
+
+	def decode(self, data=None, scale=1, target=None, workers=None):
+		"""
+		Decodes the image into a numpy array, from data if given otherwise by rereading the file this was parsed from.
+		scale/target decode at 1/2, 1/4 or 1/8 size and workers spreads restart intervals over a process pool,
+		see formats.jfif_decode (which needs numpy).
+		"""
+		from formats.jfif_decode import decode
+
+		if data is None:
+			if self.get("path") is None:
+				raise ValueError("no data to decode, this JFIF wasn't read from a file")
+			with open(self.path, "rb") as handle:
+				data = handle.read()
+		return decode(data, scale, target, workers)
+
+	@classmethod
+	def index(cls, path, full=False):
+		return SegmentIndex.from_file(path, full=full)
+
+	@classmethod
+	def transform(cls, path, output, operation=None):
+		"""
+		Lossless rotate/flip, by default whatever undoes the exif orientation. See formats.jfif_transform (which needs numpy).
+		"""
+		from formats.jfif_transform import transform
+		return transform(path, output, operation)
+
+	@classmethod
+	def optimize(cls, path, output, progressive=False):
+		"""
+		Lossless size reduction by fitting the huffman tables to the image, see formats.jfif_optimize (which needs numpy).
+		"""
+		from formats.jfif_optimize import optimize
+		return optimize(path, output, progressive)
+
+	@classmethod
+	def validate(cls, path):
+		"""
+		Checks the structure of the whole file without decoding it, see formats.jfif_validate
+		"""
+		from formats.jfif_validate import validate
+		return validate(path)
+
+	@classmethod
+	def write_exif(cls, path, changes, output=None):
+		"""
+		Changes exif tags (tag: value or (Type, value), None removes it, see EXIF.patches and EXIF.to_bytes).
+		With output None and every new value fitting where the old one was the file is patched in place with a pwrite
+		each, otherwise the exif gets rebuilt and the file streamed to output (or a temporary that then replaces path)
+		with the new APP1 spliced in.
+		"""
+		with SegmentIndex.from_file(path) as index:
+			segment = next(iter(index.find(Marker.APP1, b"Exif")), None)
+			if segment is not None and output is None:
+				# only the tags being changed need reading to patch them
+				exif = index.parse(segment, ParseContext(list(changes)))
+				fd = os.open(path, os.O_WRONLY)
+				try:
+					# TIFF header after the marker, length and "Exif\0\0"
+					if exif.patch(fd, segment.offset + 10, changes):
+						return Bunch(path=str(path), output=str(path), patched=True)
+				finally:
+					os.close(fd)
+			exif = index.parse(segment) if segment is not None else EXIF.new()
+			payload = b"Exif\x00\x00" + exif.to_bytes(changes)
+			target = output or "{}.exif".format(path)
+			with open(target, "wb") as out:
+				if segment is not None:
+					index.rewrite(out, replace={(Marker.APP1, b"Exif"): payload})
+				else:
+					index.rewrite(out, insert=[(Marker.APP1, payload)])
+		if output is None:
+			os.replace(target, path)
+		return Bunch(path=str(path), output=str(output or path), patched=False, size=len(payload))
+
+	@classmethod
+	def rewrite(cls, path, output, drop=(), replace=None, insert=()):
+		"""
+		Copies the jpeg at path to output with its metadata segments changed, see SegmentIndex.rewrite.
+		"""
+		with SegmentIndex.from_file(path) as index, open(output, "wb") as out:
+			return index.rewrite(out, drop, replace, insert)
+
+	@classmethod
+	def probe(cls, path, readahead=None, done_on_frame=None):
+		"""
+		Gets dimensions, component layout and which APPn segments exist, usually with a single read of readahead bytes.
+		More is only read when a segment we need crosses the end of what we have, segments we don't need are seeked over.
+		Stops at the frame header unless done_on_frame is False in which case it carries on to the first scan.
+		"""
+		readahead = readahead or JFIF.PROBE_READAHEAD
+		if done_on_frame is None:
+			done_on_frame = JFIF.DONE_ON_FRAME
+
+		result = Bunch(apps=[], restart_interval=None, reads=0)
+		with open(path, "rb", buffering=0) as handle:
+			buf = b""
+			base = 0
+
+			def ensure(pos, size):
+				nonlocal buf, base
+				if pos >= base and pos + size <= base + len(buf):
+					return True
+				if pos >= base and pos <= base + len(buf):
+					# pick up where the buffer leaves off
+					handle.seek(base + len(buf))
+					buf += handle.read(max(pos + size - base - len(buf), readahead))
+				else:
+					handle.seek(pos)
+					(buf, base) = (handle.read(max(size, readahead)), pos)
+				result.reads += 1
+				return pos + size <= base + len(buf)
+
+			if not ensure(0, 2) or buf[:2] != b"\xff\xd8":
+				raise ValueError("not a jpeg, missing SOI")
+
+			pos = 2
+			while ensure(pos, 2):
+				(c0, c1) = (buf[pos - base], buf[pos - base + 1])
+				if c0 != 0xFF:
+					logger.error("Found some random crap '{}' @ {}".format(c0, pos))
+					break
+				if c1 == 0xFF:
+					pos += 1
+					continue
+				try:
+					marker = Marker(c1)
+				except ValueError:
+					logger.error("Found invalid marker '{}' @ {}.".format(c1, pos))
+					break
+				if marker == Marker.EOI or marker == Marker.SOS:
+					break
+				if marker in Marker.RST:
+					pos += 2
+					continue
+				if not ensure(pos, 4):
+					break
+				length = struct.unpack_from(">H", buf, pos - base + 2)[0]
+				if length < 2:
+					logger.error("{} length {} @ {} is too short".format(marker, length, pos))
 					break
 
-				while True:
-					c0 = self.handle.read(1)
-					if c0 == b"\xFF":
-						c1 = ord(self.handle.read(1))
-						if c1 >= 0xD0 and c1 <= 0xD7:
-							continue
-						elif c1 >= 0xC0:
-							self.handle.seek(-2, io.SEEK_CUR)
+				if marker in Marker.APP:
+					peek = min(length - 2, SegmentIndex.NAME_PEEK)
+					if ensure(pos + 4, peek):
+						result.apps.append((marker, app_name(buf[pos - base + 4:pos - base + 4 + peek])))
+				elif marker in Marker.SOF or marker == Marker.DRI:
+					if not ensure(pos, 2 + length):
+						break
+					parsed = Marker.handler(marker, BytesStructIO(buf[pos - base + 2:pos - base + 2 + length]), None)
+					if marker == Marker.DRI:
+						result.restart_interval = parsed
+					else:
+						result.update(parsed)
+						layout_components(result)
+						result.marker = marker
+						result.width = result.samples_per_line
+						result.height = result.lines
+						result.progressive = marker in (Marker.SOF2, Marker.SOF6, Marker.SOF10, Marker.SOF14)
+						if done_on_frame:
 							break
+				pos += 2 + length
+		return result
+
+
+class Segment:
+	"""
+	Where a marker segment sits in the file, offset points at its 0xFF and length is the segment's length field
+	(0 for markers without a segment). APPn segments also carry their identifier (b"Exif", b"ICC_PROFILE"...) as name.
+	"""
+
+	def __init__(self, marker, offset, length, name=None):
+		self.marker = marker
+		self.offset = offset
+		self.length = length
+		self.name = name
+
+	@property
+	def end(self):
+		return self.offset + 2 + self.length
+
+	def __repr__(self):
+		return "<Segment {}{} @ {}+{}>".format(self.marker.name, "" if self.name is None else " " + repr(self.name), self.offset, self.length)
+
+
+class SegmentIndex:
+	"""
+	Walks the file once recording where every segment is without parsing any of them,
+	parsed values are only produced (and cached) when one of the accessors asks for them.
+	Unless full is set the walk stops at the first SOS as nothing past it is metadata.
+	"""
+	# enough to hold any of the APPn identifiers we care about
+	NAME_PEEK = 64
+	# what gets dropped when stripping metadata, leaves ICC and adobe alone as they change how the image looks
+	METADATA = [
+		(Marker.APP1, b"Exif")
+	] + [(Marker.APP1, name) for name in Marker.XMP] + [
+		(Marker.APP13, b"Photoshop 3.0"),
+		Marker.COM
+	]
+
+	def __init__(self, handle, full=False):
+		self.handle = handle
+		self.segments = []
+		self.scan = None
+		self.end = None
+		self._cache = {}
+		self.build(full)
 
 	@classmethod
-	def from_file(cls, path):
-		return cls(open(path, "rb"))
+	def from_file(cls, path, full=False):
+		return cls(open(path, "rb"), full=full)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, one, two, three):
+		self.close()
+
+	def close(self):
+		self.handle.close()
+
+	def build(self, full):
+		handle = self.handle
+		handle.seek(0)
+		if handle.read(2) != b"\xff\xd8":
+			raise ValueError("not a jpeg, missing SOI")
+		self.segments.append(Segment(Marker.SOI, 0, 0))
+
+		while True:
+			head = handle.read(2)
+			if len(head) < 2:
+				logger.error("Hit end of file before EOI @ {}".format(handle.tell()))
+				break
+			if head[0] != 0xFF:
+				logger.error("Found some random crap '{}' @ {}".format(head[0], handle.tell() - 2))
+				break
+			code = head[1]
+			while code == 0xFF:
+				code = ord(handle.read(1) or b"\x00")
+			offset = handle.tell() - 2
+			try:
+				marker = Marker(code)
+			except ValueError:
+				logger.error("Found invalid marker '{}' @ {}.".format(code, offset))
+				break
+
+			if marker == Marker.EOI or marker in Marker.RST:
+				self.segments.append(Segment(marker, offset, 0))
+				if marker == Marker.EOI:
+					self.end = handle.tell()
+					break
+				continue
+
+			read = handle.read(2)
+			if len(read) < 2:
+				logger.error("Hit end of file in {} length @ {}".format(marker, offset))
+				break
+			length = struct.unpack(">H", read)[0]
+			if length < 2:
+				# the length counts its own two bytes, anything less can't be followed
+				logger.error("{} length {} @ {} is too short".format(marker, length, offset))
+				break
+			name = None
+			if marker in Marker.APP:
+				name = app_name(handle.read(max(0, min(length - 2, SegmentIndex.NAME_PEEK))))
+			self.segments.append(Segment(marker, offset, length, name))
+			handle.seek(offset + 2 + length)
+
+			if marker == Marker.SOS:
+				if self.scan is None:
+					self.scan = handle.tell()
+				if not full:
+					break
+				skip_entropy(handle)
+
+	def find(self, marker, name=None):
+		return [segment for segment in self.segments if segment.marker == marker and (name is None or segment.name == name)]
+
+	def rewrite(self, out, drop=(), replace=None, insert=()):
+		"""
+		Writes the file to out with the header segments before the first SOS copied one by one, except for
+		the ones matching drop. replace maps matches to a new payload which takes the place of the first match
+		(any other matches are dropped) and insert is a list of (marker, payload) put in after SOI and any JFIF APP0.
+		Matches are either a Marker or a (marker, APPn identifier) pair, payloads include the identifier.
+		Everything from the first SOS on, entropy data and anything trailing included, goes across untouched.
+		Returns a Bunch of what was dropped, replaced and inserted.
+		"""
+		if self.scan is None:
+			raise ValueError("no scan found, refusing to write a jpeg without image data")
+		report = self.copy_headers(out, drop, replace, insert)
+		copy_range(self.handle, out, self.find(Marker.SOS)[0].offset, None)
+		return report
+
+	def copy_headers(self, out, drop=(), replace=None, insert=()):
+		"""
+		The header half of rewrite, everything before the first SOS
+		"""
+		replace = dict(replace or {})
+		report = Bunch(dropped=[], replaced=[], inserted=[])
+		pending = list(insert)
+
+		def matches(segment, selector):
+			if isinstance(selector, Marker):
+				return segment.marker == selector
+			return segment.marker == selector[0] and segment.name == selector[1]
+
+		for segment in self.segments:
+			if segment.marker == Marker.SOS:
+				break
+			if pending and segment.marker != Marker.SOI and not (segment.marker == Marker.APP0 and segment.name == b"JFIF"):
+				for (marker, payload) in pending:
+					out.write(segment_bytes(marker, payload))
+					report.inserted.append(marker)
+				pending = []
+
+			for selector in list(replace):
+				if matches(segment, selector):
+					if replace[selector] is not None:
+						out.write(segment_bytes(segment.marker, replace[selector]))
+						report.replaced.append(segment)
+						# only the first one gets the new payload
+						replace[selector] = None
+					else:
+						report.dropped.append(segment)
+					break
+			else:
+				if any(matches(segment, selector) for selector in drop):
+					report.dropped.append(segment)
+					continue
+				self.handle.seek(segment.offset)
+				out.write(self.handle.read(segment.end - segment.offset))
+		return report
+
+	def strip(self, out, keep=()):
+		"""
+		rewrite dropping METADATA, other than what's in keep
+		"""
+		return self.rewrite(out, [selector for selector in self.METADATA if selector not in keep])
+
+	def payload(self, segment):
+		"""
+		The raw bytes of a segment, not including the marker or length
+		"""
+		self.handle.seek(segment.offset + 4)
+		return self.handle.read(segment.length - 2)
+
+	def parse(self, segment, ctx=None):
+		self.handle.seek(segment.offset + 2)
+		return Marker.handler(segment.marker, self.handle, ctx if ctx is not None else ParseContext())
+
+	def _cached(self, key, parse):
+		if key not in self._cache:
+			self._cache[key] = parse()
+		return self._cache[key]
+
+	def _first(self, markers, name=None):
+		for segment in self.segments:
+			if segment.marker in markers and (name is None or segment.name == name):
+				return self.parse(segment)
+		return None
+
+	def _collect(self, marker, names):
+		ctx = ParseContext()
+		for segment in self.segments:
+			if segment.marker == marker and segment.name in names:
+				self.parse(segment, ctx)
+		collected = Bunch()
+		ctx.finalize(collected)
+		return collected
+
+	@property
+	def sof(self):
+		def parse():
+			for segment in self.segments:
+				if segment.marker in Marker.SOF:
+					frame = self.parse(segment)
+					frame['marker'] = segment.marker
+					layout_components(frame)
+					return frame
+		return self._cached("sof", parse)
+
+	@property
+	def exif(self):
+		return self._cached("exif", lambda: self._first([Marker.APP1], b"Exif"))
+
+	def read_exif(self, tags=None):
+		"""
+		Just tags out of the exif (see EXIF), not cached like exif is
+		"""
+		for segment in self.find(Marker.APP1, b"Exif"):
+			return self.parse(segment, ParseContext(tags))
+		return None
+
+	@property
+	def icc(self):
+		return self._cached("icc", lambda: self._collect(Marker.APP2, [b"ICC_PROFILE"]).get("icc"))
+
+	@property
+	def xmp(self):
+		return self._cached("xmp", lambda: self._collect(Marker.APP1, Marker.XMP).get("xmp"))
+
+	@property
+	def xmp_extension(self):
+		return self._cached("xmp_extension", lambda: self._collect(Marker.APP1, Marker.XMP).get("xmp_extension"))
+
+	@property
+	def photoshop(self):
+		return self._cached("photoshop", lambda: self._collect(Marker.APP13, [b"Photoshop 3.0"]).get("photoshop"))
+
+	@property
+	def mpf(self):
+		def parse():
+			for segment in self.find(Marker.APP2, b"MPF"):
+				return self.parse(segment).locate(segment.offset + 8)
+		return self._cached("mpf", parse)
+
+	def extract(self, image):
+		"""
+		One of the images listed in MPF (by index or MPEntry), read straight out of the file
+		"""
+		if self.mpf is None:
+			raise ValueError("no MPF segment, there's only the one image")
+		return self.mpf.read(self.handle, image)
+
+	@property
+	def jfif(self):
+		return self._cached("jfif", lambda: self._first([Marker.APP0], b"JFIF"))
+
+	@property
+	def adobe(self):
+		return self._cached("adobe", lambda: self._first([Marker.APP14], b"Adobe"))
+
+	@property
+	def restart_interval(self):
+		return self._cached("restart_interval", lambda: self._first([Marker.DRI]))
+
+	@property
+	def comment(self):
+		return self._cached("comment", lambda: self._first([Marker.COM]))
+
+	@property
+	def quantization(self):
+		def parse():
+			tables = {}
+			for segment in self.find(Marker.DQT):
+				tables.update(self.parse(segment))
+			return tables
+		return self._cached("quantization", parse)
+
+	@property
+	def huffman(self):
+		def parse():
+			tables = {}
+			for segment in self.find(Marker.DHT):
+				tables.update(self.parse(segment))
+			return tables
+		return self._cached("huffman", parse)
+
+	@property
+	def quality(self):
+		return estimate_quality(self.quantization)
+
+	def __repr__(self):
+		return "<SegmentIndex {}>".format(self.segments)
+
 
 def main():
 	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-D", "--debug", action="store_true")
 	parser.add_argument("-d", "--directory", action="store_true")
+	parser.add_argument("-p", "--probe", action="store_true", help="only read enough of each file for its dimensions and layout")
+	parser.add_argument("-s", "--strip", metavar="OUTPUT", help="write a copy without exif, xmp, photoshop and comments to OUTPUT")
+	parser.add_argument("-o", "--orient", metavar="OUTPUT", help="write a losslessly rotated copy the right way up to OUTPUT")
+	parser.add_argument("-O", "--optimize", metavar="OUTPUT", help="write a copy with optimized huffman tables to OUTPUT (a directory for directories)")
+	parser.add_argument("--progressive", action="store_true", help="make optimized copies progressive")
+	parser.add_argument("-w", "--workers", type=int, help="processes to optimize or validate directories with")
+	parser.add_argument("-x", "--extract", type=int, metavar="N", help="write image N listed in MPF to --extract-output")
+	parser.add_argument("--extract-output", metavar="OUTPUT")
+	parser.add_argument("-V", "--validate", action="store_true", help="check files are complete and well formed")
 	parser.add_argument("file")
 	args = parser.parse_args()
 
@@ -422,13 +1236,47 @@ def main():
 		logger.debug("What?")
 		return
 
+	if args.strip:
+		with SegmentIndex.from_file(str(root)) as index, open(args.strip, "wb") as out:
+			pprint(index.strip(out))
+		return
+
+	if args.validate:
+		from formats.jfif_validate import validate, validate_directory
+		verdicts = validate_directory(root, args.workers) if root.is_dir() else [validate(str(root))]
+		for verdict in verdicts:
+			pprint(verdict)
+		return
+
+	if args.extract is not None:
+		with SegmentIndex.from_file(str(root)) as index:
+			pprint(index.mpf)
+			if args.extract_output:
+				with open(args.extract_output, "wb") as out:
+					out.write(index.extract(args.extract))
+		return
+
+	if args.optimize:
+		if root.is_dir():
+			from formats.jfif_optimize import optimize_directory
+			for result in optimize_directory(root, args.optimize, args.progressive, args.workers):
+				pprint(result)
+		else:
+			pprint(JFIF.optimize(str(root), args.optimize, args.progressive))
+		return
+
+	if args.orient:
+		pprint(JFIF.transform(str(root), args.orient))
+		return
+
+	load = JFIF.probe if args.probe else JFIF.from_file
 	if root.is_file():
-		jfif = JFIF.from_file(str(root))
+		jfif = load(str(root))
 		pprint(jfif)
 	elif root.is_dir():
 		for file in root.glob("**/*.jpg"):
 			logger.info(file)
-			jfif = JFIF.from_file(str(file))
+			jfif = load(str(file))
 			pprint(jfif)
 	# logger.debug(jfif)
 
@@ -0,0 +1,670 @@
+# coding=utf-8
+
+import logging
+import math
+import struct
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from formats.jfif import ZIGZAG, Marker, layout_components, scan_segments
+from formats.structio import BytesStructIO
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class DecodeError(Exception):
+	pass
+
+
+# how many block rows go through the idct at once, keeps the float intermediates small on big images
+IDCT_BAND = 64
+# the reduced sizes a block can be decoded at, as the denominator of the scale
+SCALES = [8, 4, 2, 1]
+# restart intervals get handed to workers in this many batches per worker, evens out intervals that decode slower
+BATCHES_PER_WORKER = 4
+
+
+def idct_matrix(size=8):
+	"""
+	M such that M @ F @ M.T is the inverse dct of the top left size x size coefficients of F
+	"""
+	x = np.arange(size).reshape(-1, 1)
+	u = np.arange(size).reshape(1, -1)
+	scale = np.where(u == 0, 1 / math.sqrt(2), 1.0) / 2
+	return (scale * np.cos((2 * x + 1) * u * np.pi / (2 * size))).astype(np.float32)
+
+
+def choose_scale(width, height, target):
+	"""
+	The largest scale denominator that still gives at least target (width, height) pixels
+	"""
+	for scale in SCALES:
+		if math.ceil(width / scale) >= target[0] and math.ceil(height / scale) >= target[1]:
+			return scale
+	return 1
+
+
+def needed_coefficients(width, height):
+	"""
+	How many coefficients (in zigzag order) it takes to cover the top left width x height of a block
+	"""
+	return max(ZIGZAG.index(row * 8 + col) for row in range(height) for col in range(width)) + 1
+
+
+class HuffmanTable:
+	"""
+	Decodes by peeking 16 bits and looking them up, each entry being (code length << 8) | symbol
+	"""
+
+	def __init__(self, counts, symbols):
+		self.counts = counts
+		self.symbols = symbols
+		self.lookup = [0] * 65536
+		code = 0
+		i = 0
+		for (length, count) in enumerate(counts, 1):
+			span = 1 << (16 - length)
+			for j in range(count):
+				start = code << (16 - length)
+				self.lookup[start:start + span] = [(length << 8) | symbols[i]] * span
+				code += 1
+				i += 1
+			code <<= 1
+
+
+class BitReader:
+	"""
+	Reads bits msb first out of a single entropy coded segment that has already had its 0xFF00 stuffing removed.
+	Running off the end reads zeros, what that does to the image is the caller's problem.
+	"""
+	__slots__ = ("data", "pos", "acc", "bits")
+
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+		self.acc = 0
+		self.bits = 0
+
+	def fill(self):
+		chunk = self.data[self.pos:self.pos + 4]
+		self.pos += 4
+		if len(chunk) < 4:
+			chunk += b"\x00" * (4 - len(chunk))
+		self.acc = ((self.acc & ((1 << self.bits) - 1)) << 32) | int.from_bytes(chunk, "big")
+		self.bits += 32
+
+	def decode(self, table):
+		if self.bits < 16:
+			self.fill()
+		entry = table.lookup[(self.acc >> (self.bits - 16)) & 0xFFFF]
+		if entry == 0:
+			raise DecodeError("invalid huffman code")
+		self.bits -= entry >> 8
+		return entry & 0xFF
+
+	def overran(self):
+		"""
+		Whether more bits were read than the segment has
+		"""
+		return (self.pos - len(self.data)) * 8 > self.bits
+
+	def receive(self, size):
+		if self.bits < size:
+			self.fill()
+		self.bits -= size
+		return (self.acc >> self.bits) & ((1 << size) - 1)
+
+	def receive_extend(self, size):
+		if size == 0:
+			return 0
+		value = self.receive(size)
+		if value < (1 << (size - 1)):
+			value -= (1 << size) - 1
+		return value
+
+
+def block_order(component, mcus_x, single, first, count):
+	"""
+	Indices of the blocks of a component in the order a scan visits them over count MCUs starting at first,
+	single being whether the scan has just the one component (non-interleaved scans go along in rows of blocks)
+	"""
+	mcus = np.arange(first, first + count)
+	if single:
+		(by, bx) = np.divmod(mcus, component.blocks_x)
+		return by * component.bw + bx
+	(my, mx) = np.divmod(mcus, mcus_x)
+	v = np.arange(component.v).reshape(1, -1, 1)
+	h = np.arange(component.h).reshape(1, 1, -1)
+	rows = (my.reshape(-1, 1, 1) * component.v + v) * component.bw
+	return (rows + mx.reshape(-1, 1, 1) * component.h + h).reshape(-1)
+
+
+class Component:
+	"""
+	Coefficients are kept in zigzag order, stride of them per block
+	"""
+
+	def __init__(self, cid, spec, mcus_x, mcus_y, stride=64):
+		self.id = cid
+		self.h = spec['h_sample']
+		self.v = spec['v_sample']
+		self.quant_dest = spec['quant_dest']
+		self.x = spec['x']
+		self.y = spec['y']
+		# the block grid is padded out to whole MCUs, non-interleaved scans only cover the unpadded part
+		self.bw = mcus_x * self.h
+		self.bh = mcus_y * self.v
+		self.blocks_x = math.ceil(self.x / 8)
+		self.blocks_y = math.ceil(self.y / 8)
+		self.stride = stride
+		self.coefs = array("h", bytes(2 * stride * self.bw * self.bh))
+		self.quant = None
+		self.pred = 0
+		self.dc = None
+		self.ac = None
+
+	def set_scale(self, size, hmax, vmax):
+		"""
+		At full size a block of a subsampled component is upsampled to cover 8 * hmax / h pixels.
+		When that's more than size the block is idct'd at that (up to 8) instead of being upsampled afterwards.
+		"""
+		(across, down) = (size * (hmax // self.h), size * (vmax // self.v))
+		(self.size_x, self.size_y) = (min(across, 8), min(down, 8))
+		(self.repeat_x, self.repeat_y) = (across // self.size_x, down // self.size_y)
+		self.needed = needed_coefficients(self.size_x, self.size_y)
+
+
+class Decoder:
+	"""
+	Baseline and progressive huffman coded jpeg, 8 bit samples only.
+	The entropy decoding is plain python, everything from dequantization on is done on whole arrays of blocks.
+	With a scale of 2, 4 or 8 (or a target size to pick one from) blocks are decoded at 4x4, 2x2 or 1x1
+	(subsampled components at proportionally more) straight from their low frequency coefficients,
+	baseline images then only store those coefficients and progressive images skip any AC scans that don't touch them.
+	Damaged entropy coded data is logged and the rest of that scan left empty, unless strict where it raises DecodeError
+	(so does a restart interval that runs short or there being more of them than the scan needs).
+	"""
+
+	def __init__(self, data, scale=1, target=None, workers=None, strict=False):
+		self.data = data
+		self.strict = strict
+		self.scale = scale
+		self.target = target
+		self.workers = workers
+		self.pool = None
+		self.quant = {}
+		self.dc_tables = {}
+		self.ac_tables = {}
+		self.restart_interval = 0
+		self.frame = None
+		self.progressive = False
+		self.adobe = None
+		self.components = []
+		self.eobrun = 0
+		self.skip = None
+		self.scans = 0
+
+	def decode(self):
+		self.read()
+		return self.output()
+
+	def read(self):
+		"""
+		Entropy decodes every scan, leaving the quantized coefficients in the components
+		"""
+		if self.workers is not None and self.workers > 1:
+			with ProcessPoolExecutor(self.workers) as self.pool:
+				self.read_markers()
+			self.pool = None
+		else:
+			self.read_markers()
+
+	def read_markers(self):
+		data = self.data
+		if data[:2] != b"\xff\xd8":
+			raise DecodeError("not a jpeg, missing SOI")
+
+		pos = 2
+		while pos + 1 < len(data):
+			if data[pos] != 0xFF:
+				raise DecodeError("expected a marker @ {}".format(pos))
+			code = data[pos + 1]
+			if code == 0xFF:
+				pos += 1
+				continue
+			try:
+				marker = Marker(code)
+			except ValueError:
+				raise DecodeError("invalid marker {} @ {}".format(code, pos))
+			if marker == Marker.EOI:
+				break
+			if marker in Marker.RST:
+				pos += 2
+				continue
+
+			start = pos
+			length = struct.unpack_from(">H", data, pos + 2)[0]
+			segment = data[pos + 2:pos + 2 + length]
+			payload = segment[2:]
+			pos += 2 + length
+
+			if marker == Marker.DQT:
+				for (tid, table) in Marker.parse_dqt(marker, BytesStructIO(segment)).items():
+					self.quant[tid] = np.array(table, dtype=np.uint16)
+			elif marker == Marker.DHT:
+				for ((tclass, tid), table) in Marker.parse_dht(marker, BytesStructIO(segment)).items():
+					(self.ac_tables if tclass == 1 else self.dc_tables)[tid] = HuffmanTable(table["counts"], table["values"])
+			elif marker == Marker.DRI:
+				self.restart_interval = Marker.parse_short(marker, BytesStructIO(segment))
+			elif marker == Marker.APP14 and payload.startswith(b"Adobe") and len(payload) >= 12:
+				self.adobe = payload[11]
+			elif marker in Marker.SOF:
+				self.start_frame(marker, Marker.parse_sof(marker, BytesStructIO(segment)))
+			elif marker == Marker.SOS:
+				if self.frame is None:
+					raise DecodeError("SOS before SOF")
+				if self.skip is None:
+					self.skip = self.plan(start) if self.progressive and self.size < 8 else []
+				pos = self.decode_scan(Marker.parse_sos(marker, BytesStructIO(segment)), pos)
+
+		if self.frame is None:
+			raise DecodeError("no frame found")
+
+	def start_frame(self, marker, frame):
+		if marker not in (Marker.SOF0, Marker.SOF1, Marker.SOF2):
+			raise DecodeError("unsupported frame type {}".format(marker))
+		if frame['sample_precision'] != 8:
+			raise DecodeError("unsupported sample precision {}".format(frame['sample_precision']))
+		if frame['lines'] == 0:
+			raise DecodeError("frames with their height in DNL aren't supported")
+
+		if self.target is not None:
+			self.scale = choose_scale(frame['samples_per_line'], frame['lines'], self.target)
+		if self.scale not in SCALES:
+			raise DecodeError("invalid scale 1/{}".format(self.scale))
+
+		self.frame = frame
+		self.progressive = marker == Marker.SOF2
+		self.size = 8 // self.scale
+		(self.hmax, self.vmax) = layout_components(frame)
+		self.mcus_x = math.ceil(frame['samples_per_line'] / (8 * self.hmax))
+		self.mcus_y = math.ceil(frame['lines'] / (8 * self.vmax))
+		for (cid, spec) in frame['components'].items():
+			if self.hmax % spec['h_sample'] or self.vmax % spec['v_sample']:
+				raise DecodeError("unsupported sampling factors {}x{}".format(spec['h_sample'], spec['v_sample']))
+			component = Component(cid, spec, self.mcus_x, self.mcus_y)
+			component.set_scale(self.size, self.hmax, self.vmax)
+			if not self.progressive:
+				# progressive refinement needs the history of every coefficient in a band so only baseline can drop them
+				component = Component(cid, spec, self.mcus_x, self.mcus_y, component.needed)
+				component.set_scale(self.size, self.hmax, self.vmax)
+			self.components.append(component)
+
+	def decode_scan(self, scan, pos):
+		components = []
+		for (cid, tables) in scan['components'].items():
+			component = next((c for c in self.components if c.id == cid), None)
+			if component is None:
+				raise DecodeError("scan references unknown component {}".format(cid))
+			component.dc = self.dc_tables.get(tables['dc_entropy'])
+			component.ac = self.ac_tables.get(tables['ac_entropy'])
+			if component.quant is None:
+				# tables are latched when a component first shows up
+				component.quant = self.quant.get(component.quant_dest)
+			component.pred = 0
+			components.append(component)
+
+		(ss, se, ah, al) = (scan['spectral_selection'], scan['end_of_spectral'], scan['bit_high'], scan['bit_low'])
+		if not self.progressive:
+			decode_block = self.decode_baseline
+		elif ss == 0:
+			decode_block = self.decode_dc_first if ah == 0 else self.decode_dc_refine
+		else:
+			if len(components) != 1:
+				raise DecodeError("progressive AC scans can only have one component")
+			decode_block = self.decode_ac_first if ah == 0 else self.decode_ac_refine
+
+		(segments, end) = scan_segments(self.data, pos)
+		self.scans += 1
+		if self.scans <= len(self.skip) and self.skip[self.scans - 1]:
+			return end
+		if self.pool is not None and self.restart_interval and len(segments) > 1 and ah == 0:
+			# refinement scans build on what's already there, everything else starts from nothing and can be split up
+			self.run_parallel(components, decode_block.__name__, (ss, se, al), segments)
+		else:
+			self.run_scan(components, decode_block, (ss, se, al), segments, 0, self.scan_mcus(components))
+		return end
+
+	def plan(self, pos):
+		"""
+		Works out which scans of a progressive image can be skipped at a reduced size, starting from the first SOS at pos.
+		Those are the ones only holding coefficients outside the reduced block, unless a refinement scan we do need
+		covers the same coefficients (it relies on their history to stay in sync with the bitstream).
+		"""
+		data = self.data
+		scans = []
+		while pos + 3 < len(data) and data[pos] == 0xFF:
+			code = data[pos + 1]
+			if code == 0xFF:
+				pos += 1
+				continue
+			if code >= Marker.RST0.value and code <= Marker.RST7.value:
+				pos += 2
+				continue
+			if code == Marker.EOI.value:
+				break
+			length = struct.unpack_from(">H", data, pos + 2)[0]
+			if code == Marker.SOS.value:
+				scan = Marker.parse_sos(Marker.SOS, BytesStructIO(data[pos + 2:pos + 2 + length]))
+				needed = max(c.needed for c in self.components if c.id in scan['components'])
+				scans.append((set(scan['components']), scan['spectral_selection'], scan['end_of_spectral'], scan['bit_high'], needed))
+				pos = scan_segments(data, pos + 2 + length)[1]
+			else:
+				pos += 2 + length
+
+		keep = [ss < needed for (components, ss, se, ah, needed) in scans]
+		changed = True
+		while changed:
+			changed = False
+			for (i, (components, ss, se, ah, needed)) in enumerate(scans):
+				if not keep[i] or ah == 0 or ss == 0:
+					continue
+				for (j, (earlier, ess, ese, eah, eneeded)) in enumerate(scans[:i]):
+					if not keep[j] and ess != 0 and components & earlier and ess <= se and ss <= ese:
+						keep[j] = True
+						changed = True
+		return [not i for i in keep]
+
+	def scan_mcus(self, components):
+		if len(components) == 1:
+			return components[0].blocks_x * components[0].blocks_y
+		return self.mcus_x * self.mcus_y
+
+	def run_parallel(self, components, decode_block, spectral, segments):
+		"""
+		Hands batches of restart intervals to the worker pool, each comes back as its blocks in scan order
+		which then get scattered into place.
+		"""
+		total = self.scan_mcus(components)
+		batches = self.workers * BATCHES_PER_WORKER
+		per_batch = max(1, math.ceil(len(segments) / batches))
+		tables = [((c.dc.counts, c.dc.symbols) if c.dc else None, (c.ac.counts, c.ac.symbols) if c.ac else None) for c in components]
+		shapes = [(c.h, c.v, c.stride) for c in components]
+
+		jobs = []
+		for i in range(0, len(segments), per_batch):
+			batch = segments[i:i + per_batch]
+			first = i * self.restart_interval
+			if first >= total:
+				break
+			count = min(total, (i + len(batch)) * self.restart_interval) - first
+			(start, end) = (batch[0][0], batch[-1][1])
+			rebased = [(a - start, b - start) for (a, b) in batch]
+			jobs.append((first, count, (decode_block, spectral, self.restart_interval, self.data[start:end], rebased, count, shapes, tables, self.strict)))
+
+		futures = [(first, count, self.pool.submit(decode_intervals, job)) for (first, count, job) in jobs]
+		(ss, se, al) = spectral
+		for (first, count, future) in futures:
+			for (component, decoded) in zip(components, future.result()):
+				blocks = np.frombuffer(component.coefs, dtype=np.int16).reshape(-1, component.stride)
+				decoded = np.frombuffer(decoded, dtype=np.int16).reshape(-1, component.stride)
+				index = block_order(component, self.mcus_x, len(components) == 1, first, count)
+				if decode_block == "decode_baseline":
+					blocks[index] = decoded
+				elif ss == 0:
+					blocks[index, 0] = decoded[:, 0]
+				else:
+					blocks[index, ss:se + 1] = decoded[:, ss:se + 1]
+
+	def run_scan(self, components, decode_block, spectral, segments, first, count, compact=False):
+		"""
+		Decodes count MCUs starting at MCU first, segments being the (start, end) of each restart interval.
+		When compact each component's blocks are written one after another in scan order rather than into place.
+		"""
+		interval = self.restart_interval or count
+		single = len(components) == 1
+		reader = None
+		segment = 0
+		for mcu in range(first, first + count):
+			if (mcu - first) % interval == 0:
+				if self.strict and reader is not None and reader.overran():
+					raise DecodeError("entropy coded segment {} ends before its last MCU".format(segment - 1))
+				if segment >= len(segments):
+					if self.strict:
+						raise DecodeError("scan data ran out after {} MCUs".format(mcu))
+					logger.warning("Scan data ran out after {} MCUs".format(mcu))
+					return
+				(start, end) = segments[segment]
+				segment += 1
+				reader = BitReader(bytes(self.data[start:end]).replace(b"\xff\x00", b"\xff"))
+				self.eobrun = 0
+				for component in components:
+					component.pred = 0
+
+			try:
+				if compact:
+					for component in components:
+						for i in range(1 if single else component.h * component.v):
+							decode_block(reader, component, component.cursor, spectral)
+							component.cursor += component.stride
+					continue
+
+				if single:
+					component = components[0]
+					(by, bx) = divmod(mcu, component.blocks_x)
+					decode_block(reader, component, (by * component.bw + bx) * component.stride, spectral)
+					continue
+
+				(my, mx) = divmod(mcu, self.mcus_x)
+				for component in components:
+					for v in range(component.v):
+						row = (my * component.v + v) * component.bw + mx * component.h
+						for h in range(component.h):
+							decode_block(reader, component, (row + h) * component.stride, spectral)
+			except DecodeError as e:
+				if self.strict:
+					raise DecodeError("scan broken at MCU {}: {}".format(mcu, e))
+				logger.warning("Giving up on scan at MCU {}: {}".format(mcu, e))
+				return
+
+		if self.strict:
+			if reader is not None and reader.overran():
+				raise DecodeError("entropy coded segment {} ends before its last MCU".format(segment - 1))
+			if segment < len(segments):
+				raise DecodeError("scan has {} restart intervals, {} MCUs only need {}".format(len(segments), count, segment))
+
+	def decode_baseline(self, reader, component, base, spectral):
+		coefs = component.coefs
+		component.pred += reader.receive_extend(reader.decode(component.dc))
+		coefs[base] = component.pred
+		ac = component.ac
+		stride = component.stride
+		k = 1
+		while k < 64:
+			rs = reader.decode(ac)
+			(r, s) = (rs >> 4, rs & 0x0F)
+			if s:
+				k += r
+				if k > 63:
+					raise DecodeError("coefficient index out of range")
+				value = reader.receive_extend(s)
+				if k < stride:
+					coefs[base + k] = value
+				k += 1
+			elif r == 15:
+				k += 16
+			else:
+				break
+
+	def decode_dc_first(self, reader, component, base, spectral):
+		component.pred += reader.receive_extend(reader.decode(component.dc))
+		component.coefs[base] = component.pred << spectral[2]
+
+	def decode_dc_refine(self, reader, component, base, spectral):
+		if reader.receive(1):
+			component.coefs[base] |= 1 << spectral[2]
+
+	def decode_ac_first(self, reader, component, base, spectral):
+		if self.eobrun > 0:
+			self.eobrun -= 1
+			return
+		(ss, se, al) = spectral
+		coefs = component.coefs
+		ac = component.ac
+		k = ss
+		while k <= se:
+			rs = reader.decode(ac)
+			(r, s) = (rs >> 4, rs & 0x0F)
+			if s:
+				k += r
+				if k > 63:
+					raise DecodeError("coefficient index out of range")
+				coefs[base + k] = reader.receive_extend(s) * (1 << al)
+				k += 1
+			elif r == 15:
+				k += 16
+			else:
+				self.eobrun = (1 << r) - 1
+				if r:
+					self.eobrun += reader.receive(r)
+				break
+
+	def decode_ac_refine(self, reader, component, base, spectral):
+		(ss, se, al) = spectral
+		coefs = component.coefs
+		p1 = 1 << al
+		m1 = -1 << al
+		k = ss
+		if self.eobrun == 0:
+			while k <= se:
+				rs = reader.decode(component.ac)
+				(r, s) = (rs >> 4, rs & 0x0F)
+				if s:
+					s = p1 if reader.receive(1) else m1
+				elif r != 15:
+					self.eobrun = 1 << r
+					if r:
+						self.eobrun += reader.receive(r)
+					break
+				# skip r zero coefficients, correcting any nonzero ones passed along the way
+				while k <= se:
+					pos = base + k
+					if coefs[pos] != 0:
+						if reader.receive(1) and (coefs[pos] & p1) == 0:
+							coefs[pos] += p1 if coefs[pos] >= 0 else m1
+					else:
+						r -= 1
+						if r < 0:
+							break
+					k += 1
+				if s and k <= se:
+					coefs[base + k] = s
+				k += 1
+
+		if self.eobrun > 0:
+			while k <= se:
+				pos = base + k
+				if coefs[pos] != 0 and reader.receive(1) and (coefs[pos] & p1) == 0:
+					coefs[pos] += p1 if coefs[pos] >= 0 else m1
+				k += 1
+			self.eobrun -= 1
+
+	def component_plane(self, component):
+		if component.quant is None:
+			raise DecodeError("component {} has no quantization table".format(component.id))
+		(sx, sy) = (component.size_x, component.size_y)
+		(rows, cols) = (idct_matrix(sy), idct_matrix(sx))
+		quant = component.quant.astype(np.float32).reshape(8, 8)[:sy, :sx]
+		# only the coefficients that land inside the reduced block matter
+		keep = [k for k in range(min(component.stride, component.needed)) if ZIGZAG[k] % 8 < sx and ZIGZAG[k] // 8 < sy]
+		natural = [(ZIGZAG[k] // 8) * sx + ZIGZAG[k] % 8 for k in keep]
+		blocks = np.frombuffer(component.coefs, dtype=np.int16).reshape(component.bh, component.bw, component.stride)
+		plane = np.empty((component.bh * sy, component.bw * sx), dtype=np.uint8)
+		for row in range(0, component.bh, IDCT_BAND):
+			zigzag = blocks[row:row + IDCT_BAND]
+			band = np.zeros(zigzag.shape[:2] + (sx * sy,), dtype=np.float32)
+			band[..., natural] = zigzag[..., keep]
+			band = band.reshape(band.shape[:2] + (sy, sx)) * quant
+			pixels = rows @ band @ cols.T
+			pixels = np.clip(np.rint(pixels + 128), 0, 255).astype(np.uint8)
+			plane[row * sy:(row + len(band)) * sy] = pixels.transpose(0, 2, 1, 3).reshape(len(band) * sy, -1)
+		return plane
+
+	def output(self):
+		height = math.ceil(self.frame['lines'] / self.scale)
+		width = math.ceil(self.frame['samples_per_line'] / self.scale)
+		planes = []
+		for component in self.components:
+			plane = self.component_plane(component)
+			plane = np.repeat(np.repeat(plane, component.repeat_y, axis=0), component.repeat_x, axis=1)
+			planes.append(plane[:height, :width])
+
+		if len(planes) == 1:
+			return planes[0]
+		image = np.stack(planes, axis=-1)
+		if len(planes) == 3 and self.transform():
+			return ycc_to_rgb(image)
+		if len(planes) == 4 and self.adobe == 2:
+			image[..., :3] = ycc_to_rgb(image[..., :3])
+			image[..., :3] = 255 - image[..., :3]
+		return image
+
+	def transform(self):
+		"""
+		Whether a 3 component image is YCbCr, same guesswork as libjpeg
+		"""
+		if self.adobe is not None:
+			return self.adobe != 0
+		return [c.id for c in self.components] != [ord("R"), ord("G"), ord("B")]
+
+
+def decode_intervals(job):
+	"""
+	Worker side of Decoder.run_parallel, decodes count MCUs out of the restart intervals in data
+	and returns each component's blocks in scan order
+	"""
+	(decode_block, spectral, restart_interval, data, segments, count, shapes, tables, strict) = job
+	decoder = Decoder(data, strict=strict)
+	decoder.restart_interval = restart_interval
+	components = []
+	for ((h, v, stride), (dc, ac)) in zip(shapes, tables):
+		component = Component.__new__(Component)
+		(component.h, component.v, component.stride) = (h, v, stride)
+		blocks = count * (1 if len(shapes) == 1 else h * v)
+		component.coefs = array("h", bytes(2 * stride * blocks))
+		component.cursor = 0
+		component.pred = 0
+		component.dc = HuffmanTable(*dc) if dc else None
+		component.ac = HuffmanTable(*ac) if ac else None
+		components.append(component)
+	decoder.run_scan(components, getattr(decoder, decode_block), spectral, segments, 0, count, compact=True)
+	return [component.coefs.tobytes() for component in components]
+
+
+def ycc_to_rgb(image):
+	ycc = image.astype(np.float32)
+	y = ycc[..., 0]
+	cb = ycc[..., 1] - 128
+	cr = ycc[..., 2] - 128
+	rgb = np.empty(image.shape, dtype=np.float32)
+	rgb[..., 0] = y + 1.402 * cr
+	rgb[..., 1] = y - 0.344136 * cb - 0.714136 * cr
+	rgb[..., 2] = y + 1.772 * cb
+	return np.clip(np.rint(rgb), 0, 255).astype(np.uint8)
+
+
+def decode(data, scale=1, target=None, workers=None, strict=False):
+	"""
+	Decodes a whole jpeg held in data into an (height, width[, components]) uint8 array,
+	3 components come out as RGB and 4 as CMYK exactly as stored (adobe files usually store it inverted).
+	scale (1, 2, 4 or 8) shrinks the output by that much, target picks the smallest scale that still covers (width, height).
+	With more than one worker, scans with restart intervals have their intervals entropy decoded in a process pool.
+	strict raises DecodeError for damaged entropy coded data instead of leaving the rest of the scan empty.
+	"""
+	return Decoder(data, scale, target, workers, strict).decode()
@@ -0,0 +1,443 @@
+# coding=utf-8
+
+import logging
+import math
+import struct
+
+import numpy as np
+
+from formats.jfif import ZIGZAG, Marker, segment_bytes
+from formats.jfif_decode import block_order
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class EncodeError(Exception):
+	pass
+
+
+# the example tables from annex K.3, (counts per code length, symbols) keyed by (class, id) with luminance as 0
+STANDARD_TABLES = {
+	(0, 0): (
+		[0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+		[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+	),
+	(0, 1): (
+		[0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+		[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+	),
+	(1, 0): (
+		[0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D],
+		[
+			0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+			0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xA1, 0x08, 0x23, 0x42, 0xB1, 0xC1, 0x15, 0x52, 0xD1, 0xF0,
+			0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0A, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x25, 0x26, 0x27, 0x28,
+			0x29, 0x2A, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+			0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+			0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+			0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7,
+			0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3, 0xC4, 0xC5,
+			0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA, 0xE1, 0xE2,
+			0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF1, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+			0xF9, 0xFA
+		]
+	),
+	(1, 1): (
+		[0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+		[
+			0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+			0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xA1, 0xB1, 0xC1, 0x09, 0x23, 0x33, 0x52, 0xF0,
+			0x15, 0x62, 0x72, 0xD1, 0x0A, 0x16, 0x24, 0x34, 0xE1, 0x25, 0xF1, 0x17, 0x18, 0x19, 0x1A, 0x26,
+			0x27, 0x28, 0x29, 0x2A, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+			0x49, 0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+			0x69, 0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+			0x88, 0x89, 0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5,
+			0xA6, 0xA7, 0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3,
+			0xC4, 0xC5, 0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA,
+			0xE2, 0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+			0xF9, 0xFA
+		]
+	)
+}
+
+
+def huffman_codes(counts, symbols):
+	"""
+	{symbol: (code, length)}, codes assigned the same canonical way a decoder does
+	"""
+	codes = {}
+	code = 0
+	i = 0
+	for (length, count) in enumerate(counts, 1):
+		for j in range(count):
+			codes[symbols[i]] = (code, length)
+			code += 1
+			i += 1
+		code <<= 1
+	return codes
+
+
+def dqt_payload(tables):
+	"""
+	tables being {table id: natural order array}, 16 bit precision is only used by tables that need it
+	"""
+	payload = b""
+	for (tid, table) in sorted(tables.items()):
+		values = [int(table[i]) for i in ZIGZAG]
+		if max(values) > 255:
+			payload += bytes([0x10 | tid]) + struct.pack(">64H", *values)
+		else:
+			payload += bytes([tid] + values)
+	return payload
+
+
+def dht_payload(tables):
+	"""
+	tables being {(class, id): (counts, symbols)}
+	"""
+	payload = b""
+	for ((tclass, tid), (counts, symbols)) in sorted(tables.items()):
+		payload += bytes([(tclass << 4) | tid] + list(counts) + list(symbols))
+	return payload
+
+
+class Component:
+	"""
+	What the encoder needs to know about a component, blocks being a (rows, columns, 64) array of
+	quantized coefficients in zigzag order covering the whole MCU padded grid
+	"""
+
+	def __init__(self, cid, h, v, quant_dest, blocks, x, y, dc_table=0, ac_table=0):
+		self.id = cid
+		self.h = h
+		self.v = v
+		self.quant_dest = quant_dest
+		self.blocks = blocks
+		self.x = x
+		self.y = y
+		(self.bh, self.bw) = blocks.shape[:2]
+		self.blocks_x = math.ceil(x / 8)
+		self.blocks_y = math.ceil(y / 8)
+		self.dc_table = dc_table
+		self.ac_table = ac_table
+		self.scanned = {}
+
+
+class BitWriter:
+	"""
+	Collects bits msb first, stuffing and padding only happen once at the end
+	"""
+	__slots__ = ("out", "acc", "bits")
+
+	def __init__(self):
+		self.out = bytearray()
+		self.acc = 0
+		self.bits = 0
+
+	def write(self, value, length):
+		self.acc = (self.acc << length) | value
+		self.bits += length
+		if self.bits >= 32:
+			self.bits -= 32
+			self.out += (self.acc >> self.bits).to_bytes(4, "big")
+			self.acc &= (1 << self.bits) - 1
+
+	def getvalue(self):
+		# pad the last byte out with 1s
+		pad = -self.bits % 8
+		acc = (self.acc << pad) | ((1 << pad) - 1)
+		tail = acc.to_bytes((self.bits + pad) // 8, "big")
+		return bytes(self.out + tail).replace(b"\xff", b"\xff\x00")
+
+
+class NullWriter:
+	"""
+	Throws everything away, for counting passes
+	"""
+	__slots__ = ()
+
+	def write(self, value, length):
+		pass
+
+
+class Frequencies:
+	"""
+	Stands in for a code table during a counting pass, tallying how often each symbol gets asked for
+	"""
+	__slots__ = ("counts",)
+
+	def __init__(self):
+		self.counts = [0] * 256
+
+	def __getitem__(self, symbol):
+		self.counts[symbol] += 1
+		return (0, 0)
+
+
+def optimal_table(counts):
+	"""
+	(counts per code length, symbols) for the frequencies in counts following annex K.2, lengths limited to 16 bits
+	and with a reserved symbol making sure no code is all 1 bits
+	"""
+	frequencies = list(counts) + [1]
+	if not any(counts):
+		frequencies[0] = 1
+	sizes = [0] * 257
+	others = [-1] * 257
+	while True:
+		# the two least frequent, the higher symbol winning ties like libjpeg
+		(c1, c2) = (-1, -1)
+		for (i, frequency) in enumerate(frequencies):
+			if frequency and (c1 < 0 or frequency <= frequencies[c1]):
+				c1 = i
+		for (i, frequency) in enumerate(frequencies):
+			if frequency and i != c1 and (c2 < 0 or frequency <= frequencies[c2]):
+				c2 = i
+		if c2 < 0:
+			break
+		frequencies[c1] += frequencies[c2]
+		frequencies[c2] = 0
+		sizes[c1] += 1
+		while others[c1] >= 0:
+			c1 = others[c1]
+			sizes[c1] += 1
+		others[c1] = c2
+		sizes[c2] += 1
+		while others[c2] >= 0:
+			c2 = others[c2]
+			sizes[c2] += 1
+
+	bits = [0] * 33
+	for size in sizes:
+		if size:
+			bits[size] += 1
+	for i in range(32, 16, -1):
+		while bits[i] > 0:
+			j = i - 2
+			while bits[j] == 0:
+				j -= 1
+			bits[i] -= 2
+			bits[i - 1] += 1
+			bits[j + 1] += 2
+			bits[j] -= 1
+	i = 16
+	while bits[i] == 0:
+		i -= 1
+	# drop the reserved symbol's code, the longest
+	bits[i] -= 1
+	symbols = [symbol for size in range(1, 33) for symbol in range(256) if sizes[symbol] == size]
+	return (bits[1:17], symbols)
+
+
+def encode_dc(writer, dc, diff):
+	size = abs(diff).bit_length()
+	(code, length) = dc[size]
+	writer.write((code << size) | (diff if diff >= 0 else diff + (1 << size) - 1), length + size)
+
+
+def encode_ac(writer, ac, positions, values, last=0):
+	"""
+	Run/size codes for the nonzero coefficients at positions (zigzag) following position last, returns the last one coded
+	"""
+	for (k, value) in zip(positions, values):
+		run = k - last - 1
+		while run > 15:
+			(code, length) = ac[0xF0]
+			writer.write(code, length)
+			run -= 16
+		size = abs(value).bit_length()
+		(code, length) = ac[(run << 4) | size]
+		writer.write((code << size) | (value if value >= 0 else value + (1 << size) - 1), length + size)
+		last = k
+	return last
+
+
+def encode_eobrun(writer, ac, eobrun):
+	size = eobrun.bit_length() - 1
+	(code, length) = ac[size << 4]
+	writer.write((code << size) | (eobrun - (1 << size)), length + size)
+
+
+def scan_blocks(component, mcus_x, mcus_y, single):
+	"""
+	A component's blocks in the order a scan goes through them as (dc, AC positions, AC values) with just the nonzero
+	AC coefficients, found for all blocks at once rather than block by block. Kept around as progressive goes over them a lot.
+	"""
+	if single in component.scanned:
+		return component.scanned[single]
+	count = component.blocks_x * component.blocks_y if single else mcus_x * mcus_y
+	order = block_order(component, mcus_x, single, 0, count)
+	blocks = component.blocks.reshape(-1, 64)[order].astype(np.int32)
+	(rows, columns) = np.nonzero(blocks[:, 1:])
+	starts = np.searchsorted(rows, np.arange(len(blocks) + 1)).tolist()
+	positions = (columns + 1).tolist()
+	values = blocks[rows, columns + 1].tolist()
+	dcs = blocks[:, 0].tolist()
+	scanned = component.scanned[single] = [(dcs[i], positions[starts[i]:starts[i + 1]], values[starts[i]:starts[i + 1]]) for i in range(len(blocks))]
+	return scanned
+
+
+def interleave(components, mcus_x, mcus_y):
+	"""
+	(component, block) pairs in MCU order, a single component just goes along its blocks
+	"""
+	if len(components) == 1:
+		component = components[0]
+		for block in scan_blocks(component, mcus_x, mcus_y, True):
+			yield (component, block)
+		return
+	plans = [(component, component.h * component.v, scan_blocks(component, mcus_x, mcus_y, False)) for component in components]
+	for mcu in range(mcus_x * mcus_y):
+		for (component, per_mcu, blocks) in plans:
+			for block in blocks[mcu * per_mcu:(mcu + 1) * per_mcu]:
+				yield (component, block)
+
+
+def encode_scan(writer, components, mcus_x, mcus_y, codes):
+	"""
+	Codes a sequential scan over components, codes being {(class, id): {symbol: (code, length)}}
+	"""
+	preds = {component.id: 0 for component in components}
+	try:
+		for (component, (dc, positions, values)) in interleave(components, mcus_x, mcus_y):
+			encode_dc(writer, codes[(0, component.dc_table)], dc - preds[component.id])
+			preds[component.id] = dc
+			ac = codes[(1, component.ac_table)]
+			if encode_ac(writer, ac, positions, values) != 63:
+				(code, length) = ac[0x00]
+				writer.write(code, length)
+	except KeyError as e:
+		raise EncodeError("no huffman code for symbol {}".format(e.args[0]))
+
+
+def encode_progressive_scan(writer, components, mcus_x, mcus_y, codes, ss, se):
+	"""
+	Codes the first (and only, there's no successive approximation) pass over coefficients ss to se.
+	DC scans can be interleaved, AC ones have one component and batch up blocks with nothing left in the band into EOB runs.
+	"""
+	if ss == 0:
+		preds = {component.id: 0 for component in components}
+		for (component, (dc, positions, values)) in interleave(components, mcus_x, mcus_y):
+			encode_dc(writer, codes[(0, component.dc_table)], dc - preds[component.id])
+			preds[component.id] = dc
+		return
+
+	component = components[0]
+	ac = codes[(1, component.ac_table)]
+	eobrun = 0
+	for (dc, positions, values) in scan_blocks(component, mcus_x, mcus_y, True):
+		band = [(k, value) for (k, value) in zip(positions, values) if ss <= k <= se]
+		if band:
+			if eobrun:
+				encode_eobrun(writer, ac, eobrun)
+				eobrun = 0
+			last = encode_ac(writer, ac, [k for (k, value) in band], [value for (k, value) in band], ss - 1)
+		else:
+			last = ss - 1
+		if last != se:
+			eobrun += 1
+			if eobrun == 0x7FFF:
+				encode_eobrun(writer, ac, eobrun)
+				eobrun = 0
+	if eobrun:
+		encode_eobrun(writer, ac, eobrun)
+
+
+def assign_tables(components):
+	# luminance gets its own tables and everything else shares the second set, like libjpeg
+	for (i, component) in enumerate(components):
+		component.dc_table = component.ac_table = 0 if i == 0 else 1
+
+
+def optimal_tables(encode, keys):
+	"""
+	Runs encode(writer, codes) once to count symbols for the tables in keys and builds optimal tables from that
+	"""
+	frequencies = {key: Frequencies() for key in keys}
+	encode(NullWriter(), frequencies)
+	return {key: optimal_table(frequency.counts) for (key, frequency) in frequencies.items()}
+
+
+def frame_layout(width, height, components):
+	hmax = max(component.h for component in components)
+	vmax = max(component.v for component in components)
+	return (math.ceil(width / (8 * hmax)), math.ceil(height / (8 * vmax)))
+
+
+def frame_header(marker, width, height, components):
+	sof = struct.pack(">BHHB", 8, height, width, len(components))
+	for component in components:
+		sof += bytes([component.id, (component.h << 4) | component.v, component.quant_dest])
+	return segment_bytes(marker, sof)
+
+
+def scan_header(components, ss, se):
+	sos = bytes([len(components)])
+	for component in components:
+		sos += bytes([component.id, (component.dc_table << 4) | component.ac_table])
+	return segment_bytes(Marker.SOS, sos + bytes([ss, se, 0]))
+
+
+def write_baseline(out, width, height, components, quant, tables=None):
+	"""
+	Writes everything from the quantization tables through to EOI of a baseline jpeg to out.
+	tables defaults to the annex K ones, "optimal" builds them from the image with an extra counting pass.
+	Either way the first component gets the luminance tables.
+	"""
+	(mcus_x, mcus_y) = frame_layout(width, height, components)
+	if tables is None or tables == "optimal":
+		assign_tables(components)
+	used = set()
+	for component in components:
+		used.update([(0, component.dc_table), (1, component.ac_table)])
+	if tables is None:
+		tables = STANDARD_TABLES
+	elif tables == "optimal":
+		tables = optimal_tables(lambda writer, codes: encode_scan(writer, components, mcus_x, mcus_y, codes), used)
+
+	writer = BitWriter()
+	encode_scan(writer, components, mcus_x, mcus_y, {key: huffman_codes(*tables[key]) for key in used})
+	out.write(segment_bytes(Marker.DQT, dqt_payload(quant)))
+	out.write(frame_header(Marker.SOF0, width, height, components))
+	out.write(segment_bytes(Marker.DHT, dht_payload({key: tables[key] for key in used})))
+	out.write(scan_header(components, 0, 63))
+	out.write(writer.getvalue())
+	out.write(b"\xff\xd9")
+
+
+def progressive_script(components):
+	"""
+	libjpeg's usual progression less the successive approximation: interleaved DC,
+	then the luminance AC in two bands and every other component's AC in one
+	"""
+	script = [(list(range(len(components))), 0, 0)]
+	for i in range(len(components)):
+		script += [([i], 1, 5), ([i], 6, 63)] if i == 0 else [([i], 1, 63)]
+	return script
+
+
+def write_progressive(out, width, height, components, quant, script=None):
+	"""
+	Writes everything from the quantization tables through to EOI of a progressive jpeg to out,
+	each scan gets huffman tables made to measure for it
+	"""
+	(mcus_x, mcus_y) = frame_layout(width, height, components)
+	assign_tables(components)
+	out.write(segment_bytes(Marker.DQT, dqt_payload(quant)))
+	out.write(frame_header(Marker.SOF2, width, height, components))
+	for (indices, ss, se) in script or progressive_script(components):
+		scan = [components[i] for i in indices]
+		if len(scan) > 1 and (ss != 0 or len(scan) > 4):
+			raise EncodeError("only DC scans can be interleaved")
+		keys = set((0, component.dc_table) if ss == 0 else (1, component.ac_table) for component in scan)
+		encode = lambda writer, codes: encode_progressive_scan(writer, scan, mcus_x, mcus_y, codes, ss, se)
+		tables = optimal_tables(encode, keys)
+		writer = BitWriter()
+		encode(writer, {key: huffman_codes(*table) for (key, table) in tables.items()})
+		out.write(segment_bytes(Marker.DHT, dht_payload(tables)))
+		out.write(scan_header(scan, ss, se))
+		out.write(writer.getvalue())
+	out.write(b"\xff\xd9")
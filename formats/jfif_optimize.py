@@ -0,0 +1,80 @@
+# coding=utf-8
+
+import io
+import logging
+import os
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from formats.jfif import SegmentIndex
+from formats.jfif_transform import FRAME_MARKERS, Transform
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def optimize(path, output, progressive=False):
+	"""
+	Rewrites the jpeg at path into output with huffman tables built for its own symbol statistics (two passes over
+	the coefficients, one counting and one coding), optionally as a progressive jpeg.
+	The quantized coefficients and so the pixels stay exactly the same, metadata segments are copied over as is.
+	When that doesn't come out smaller output gets the original bytes instead and kept is True.
+	"""
+	with SegmentIndex.from_file(path) as index:
+		index.handle.seek(0)
+		data = index.handle.read()
+		transform = Transform(data)
+		out = io.BytesIO()
+		index.copy_headers(out, FRAME_MARKERS)
+		transform.write(out, optimize=True, progressive=progressive)
+	optimized = out.getvalue()
+	kept = len(optimized) >= len(data)
+	with open(output, "wb") as handle:
+		handle.write(data if kept else optimized)
+	return Bunch(path=str(path), output=str(output), before=len(data), after=min(len(data), len(optimized)), progressive=progressive, kept=kept)
+
+
+def optimize_file(path, output=None, progressive=False):
+	"""
+	optimize that doesn't throw, with output None it works in place and only replaces path if it got smaller
+	"""
+	target = output or "{}.optimized".format(path)
+	try:
+		if output is not None:
+			os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+		result = optimize(path, target, progressive)
+	except Exception as e:
+		logger.error("Failed to optimize {} due to:\n{}".format(path, traceback.format_exc()))
+		if output is None and os.path.exists(target):
+			os.remove(target)
+		return Bunch(path=str(path), output=None, error="{}: {}".format(type(e).__name__, e))
+
+	if output is None:
+		if result.kept:
+			os.remove(target)
+		else:
+			os.replace(target, path)
+		result.output = str(path)
+	return result
+
+
+def optimize_directory(root, output=None, progressive=False, workers=None, pattern="**/*.jpg"):
+	"""
+	Optimizes every jpeg under root on a process pool (the coding is plain python so threads won't help),
+	into the same layout under output or in place when it's None. Yields results as they finish.
+	"""
+	root = Path(root)
+	with ProcessPoolExecutor(workers) as pool:
+		futures = []
+		for path in root.glob(pattern):
+			if not path.is_file():
+				continue
+			target = None if output is None else str(Path(output) / path.relative_to(root))
+			futures.append(pool.submit(optimize_file, str(path), target, progressive))
+		for future in as_completed(futures):
+			yield future.result()
@@ -0,0 +1,271 @@
+# coding=utf-8
+
+import logging
+import struct
+
+import numpy as np
+
+from formats.exif import EXIF, IFDTagType, Orientation, Type
+from formats.jfif import ZIGZAG, Marker, SegmentIndex
+from formats.jfif_decode import DecodeError, Decoder
+from formats.jfif_encode import Component, EncodeError, write_baseline, write_progressive
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TransformError(Exception):
+	pass
+
+
+# each operation as steps applied one after the other to the image as it is at that point
+OPERATIONS = {
+	"none": [],
+	"flip_h": ["flip_h"],
+	"flip_v": ["flip_v"],
+	"transpose": ["transpose"],
+	"transverse": ["transpose", "flip_h", "flip_v"],
+	"rotate_90": ["transpose", "flip_h"],
+	"rotate_180": ["flip_h", "flip_v"],
+	"rotate_270": ["transpose", "flip_v"]
+}
+
+# what it takes to get each orientation displaying the right way up
+CORRECTIONS = {
+	Orientation.Unknown: "none",
+	Orientation.TopLeft: "none",
+	Orientation.TopRight: "flip_h",
+	Orientation.BottomRight: "rotate_180",
+	Orientation.BottomLeft: "flip_v",
+	Orientation.LeftTop: "transpose",
+	Orientation.RightTop: "rotate_90",
+	Orientation.RightBottom: "transverse",
+	Orientation.LeftBottom: "rotate_270"
+}
+
+# headers that get written out fresh rather than copied
+FRAME_MARKERS = Marker.SOF + [Marker.DQT, Marker.DHT, Marker.DRI, Marker.SOS]
+
+# zigzag position of each natural position
+NATURAL = np.argsort(ZIGZAG)
+
+
+def orientation_offset(tiff):
+	"""
+	(struct byte order, offset) of the orientation value in IFD0 of some tiff data or None if it has none
+	"""
+	order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+	if order is None:
+		return None
+	try:
+		ifd = struct.unpack_from(order + "I", tiff, 4)[0]
+		count = struct.unpack_from(order + "H", tiff, ifd)[0]
+		for i in range(count):
+			entry = ifd + 2 + 12 * i
+			(tag, kind) = struct.unpack_from(order + "HH", tiff, entry)
+			if tag == IFDTagType.Orientation.value and kind == Type.SHORT.value:
+				return (order, entry + 8)
+	except struct.error:
+		logger.warning("Exif IFD0 runs off the end, can't find the orientation")
+	return None
+
+
+def read_orientation(payload):
+	"""
+	The orientation in an Exif APP1 payload, TopLeft if there isn't one
+	"""
+	found = orientation_offset(payload[6:])
+	if found is None:
+		return Orientation.TopLeft
+	(order, offset) = found
+	try:
+		return Orientation(struct.unpack_from(order + "H", payload, 6 + offset)[0])
+	except ValueError:
+		return Orientation.Unknown
+
+
+def reset_orientation(payload):
+	"""
+	The Exif APP1 payload with its orientation set back to TopLeft, everything else stays where it was
+	"""
+	found = orientation_offset(payload[6:])
+	if found is None:
+		return payload
+	(order, offset) = found
+	payload = bytearray(payload)
+	struct.pack_into(order + "H", payload, 6 + offset, Orientation.TopLeft.value)
+	return bytes(payload)
+
+
+def reoriented(payload, width, height):
+	"""
+	The Exif APP1 payload with its orientation reset and PixelXDimension/PixelYDimension set to the size the image
+	came out as (transposed and trimmed), like jpegtran does. Patched where the values are if they fit
+	(see EXIF.patches), rebuilt otherwise.
+	"""
+	try:
+		exif = EXIF(payload[6:])
+		changes = {}
+		if exif.find(IFDTagType.Orientation) is not None:
+			changes[IFDTagType.Orientation] = Orientation.TopLeft
+		for (tag, value) in ((IFDTagType.PixelXDimension, width), (IFDTagType.PixelYDimension, height)):
+			found = exif.find(tag)
+			if found is not None:
+				# either SHORT or LONG is allowed, a SHORT only stays one while the value fits
+				changes[tag] = (found.type if found.type == Type.LONG or value < 1 << 16 else Type.LONG, value)
+		writes = exif.patches(changes)
+		if writes is None:
+			return payload[:6] + exif.to_bytes(changes)
+	except Exception as e:
+		logger.warning("Can't rewrite the exif ({}), only resetting its orientation".format(e))
+		return reset_orientation(payload)
+	payload = bytearray(payload)
+	for (position, data) in writes:
+		payload[6 + position:6 + position + len(data)] = data
+	return bytes(payload)
+
+
+class Transform:
+	"""
+	Lossless flips/rotations done on the quantized coefficients, each block gets moved to where it belongs and
+	transposed/has the signs of its odd frequencies flipped. Flipping an edge made of a partial MCU would move the
+	padding into the picture, so like jpegtran -trim those edges get cropped off first.
+	The source is decoded strictly, damaged entropy coded data raises DecodeError rather than coming out as empty blocks.
+	"""
+
+	def __init__(self, data):
+		self.decoder = decoder = Decoder(data, strict=True)
+		decoder.read()
+		self.width = decoder.frame['samples_per_line']
+		self.height = decoder.frame['lines']
+		(self.hmax, self.vmax) = (decoder.hmax, decoder.vmax)
+		self.trimmed = False
+		self.transposed = False
+		self.grids = []
+		self.sampling = []
+		for component in decoder.components:
+			blocks = np.frombuffer(component.coefs, dtype=np.int16).reshape(component.bh, component.bw, 64)
+			self.grids.append(blocks[:, :, NATURAL].reshape(component.bh, component.bw, 8, 8).astype(np.int32))
+			self.sampling.append((component.h, component.v))
+
+	def apply(self, operation):
+		for step in OPERATIONS[operation]:
+			getattr(self, step)()
+
+	def flip_h(self):
+		mcu = 8 * self.hmax
+		if self.width % mcu:
+			self.width -= self.width % mcu
+			self.trimmed = True
+		if self.width == 0:
+			raise TransformError("image is narrower than an MCU, nothing left to flip")
+		for (i, (h, v)) in enumerate(self.sampling):
+			grid = self.grids[i][:, :self.width // mcu * h][:, ::-1].copy()
+			grid[:, :, :, 1::2] *= -1
+			self.grids[i] = grid
+
+	def flip_v(self):
+		mcu = 8 * self.vmax
+		if self.height % mcu:
+			self.height -= self.height % mcu
+			self.trimmed = True
+		if self.height == 0:
+			raise TransformError("image is shorter than an MCU, nothing left to flip")
+		for (i, (h, v)) in enumerate(self.sampling):
+			grid = self.grids[i][:self.height // mcu * v][::-1].copy()
+			grid[:, :, 1::2, :] *= -1
+			self.grids[i] = grid
+
+	def transpose(self):
+		self.grids = [grid.transpose(1, 0, 3, 2) for grid in self.grids]
+		self.sampling = [(v, h) for (h, v) in self.sampling]
+		(self.width, self.height) = (self.height, self.width)
+		(self.hmax, self.vmax) = (self.vmax, self.hmax)
+		self.transposed = not self.transposed
+
+	def huffman_tables(self):
+		"""
+		The tables the (baseline) source was coded with as {(class, id): (counts, symbols)}
+		"""
+		tables = {}
+		for (component, target) in zip(self.decoder.components, self.components):
+			for (tclass, source, table) in ((0, self.decoder.dc_tables, component.dc), (1, self.decoder.ac_tables, component.ac)):
+				tid = next(tid for (tid, candidate) in source.items() if candidate is table)
+				tables[(tclass, tid)] = (table.counts, table.symbols)
+				if tclass == 0:
+					target.dc_table = tid
+				else:
+					target.ac_table = tid
+		return tables
+
+	def write(self, out, optimize=False, progressive=False):
+		"""
+		Writes the transformed frame (tables through to EOI), returns whether the original huffman tables were kept.
+		optimize builds huffman tables to fit the image rather than reusing the original ones,
+		progressive writes a progressive jpeg instead which always gets fitted tables.
+		"""
+		quant = {}
+		for (tid, table) in self.decoder.quant.items():
+			quant[tid] = table.reshape(8, 8).T.reshape(64) if self.transposed else table
+
+		self.components = []
+		(mcus_x, mcus_y) = (-(-self.width // (8 * self.hmax)), -(-self.height // (8 * self.vmax)))
+		for (component, grid, (h, v)) in zip(self.decoder.components, self.grids, self.sampling):
+			if grid.shape[:2] != (mcus_y * v, mcus_x * h):
+				raise TransformError("component {} ended up {} blocks, expected {}".format(component.id, grid.shape[:2], (mcus_y * v, mcus_x * h)))
+			blocks = grid.reshape(grid.shape[0], grid.shape[1], 64)[:, :, ZIGZAG]
+			x = -(-self.width * h // self.hmax)
+			y = -(-self.height * v // self.vmax)
+			self.components.append(Component(component.id, h, v, component.quant_dest, blocks, x, y))
+
+		if progressive:
+			write_progressive(out, self.width, self.height, self.components, quant)
+			return False
+		if optimize:
+			write_baseline(out, self.width, self.height, self.components, quant, "optimal")
+			return False
+		if not self.decoder.progressive:
+			tables = self.huffman_tables()
+			header = out.tell()
+			try:
+				write_baseline(out, self.width, self.height, self.components, quant, tables)
+				return True
+			except EncodeError as e:
+				logger.debug("Original huffman tables won't do ({}), using the standard ones".format(e))
+				out.seek(header)
+				out.truncate()
+		write_baseline(out, self.width, self.height, self.components, quant)
+		return False
+
+
+def transform(path, output, operation=None):
+	"""
+	Losslessly flips/rotates the jpeg at path into output, by default undoing its exif orientation.
+	Metadata segments are copied over with the exif orientation reset and its pixel dimensions set to the new size,
+	the image comes out as baseline using the original huffman tables where they cover every symbol and the standard
+	ones otherwise. A source with damaged entropy coded data raises TransformError and nothing is written.
+	"""
+	with SegmentIndex.from_file(path) as index:
+		exif = index.find(Marker.APP1, b"Exif")
+		orientation = read_orientation(index.payload(exif[0])) if exif else Orientation.TopLeft
+		if operation is None:
+			operation = CORRECTIONS[orientation]
+		if operation not in OPERATIONS:
+			raise TransformError("unknown operation '{}'".format(operation))
+
+		index.handle.seek(0)
+		try:
+			transform = Transform(index.handle.read())
+		except DecodeError as e:
+			raise TransformError("can't decode {}: {}".format(path, e))
+		transform.apply(operation)
+
+		with open(output, "wb") as out:
+			replace = {(Marker.APP1, b"Exif"): reoriented(index.payload(exif[0]), transform.width, transform.height)} if exif else None
+			index.copy_headers(out, FRAME_MARKERS, replace)
+			kept = transform.write(out)
+
+	return Bunch(operation=operation, orientation=orientation, width=transform.width, height=transform.height, trimmed=transform.trimmed, original_tables=kept)
@@ -0,0 +1,336 @@
+# coding=utf-8
+
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from formats.jfif import Marker, layout_components
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# the marker ending or interrupting entropy coded data, a run of 0xFF (fill bytes) followed by anything but stuffing
+ENTROPY_MARKER = re.compile(rb"\xff+[^\x00\xff]")
+
+SOF_CODES = [marker.value for marker in Marker.SOF]
+PROGRESSIVE_CODES = [Marker.SOF2.value, Marker.SOF6.value, Marker.SOF10.value, Marker.SOF14.value]
+LOSSLESS_CODES = [Marker.SOF3.value, Marker.SOF7.value, Marker.SOF11.value, Marker.SOF15.value]
+# arithmetic coded frames are conditioned by DAC (or its defaults) instead of having huffman tables
+ARITHMETIC_CODES = [marker.value for marker in Marker.SOF if marker.value >= Marker.SOF9.value]
+# arithmetic coding's temporary marker, the only other marker without a segment, Marker doesn't have it
+TEM = 0x01
+
+
+class Validator:
+	"""
+	Walks a whole jpeg checking its structure rather than decoding it, segments are checked against their lengths
+	and what came before them (tables a scan uses have to exist, ...) while entropy coded data is only searched for
+	the markers in it which happens in C over the mmap. Problems go into the verdict as errors (the file is broken)
+	or warnings (it's odd but decoders will cope).
+	"""
+
+	def __init__(self, buf, verdict):
+		self.buf = buf
+		self.size = len(buf)
+		self.verdict = verdict
+		self.frame = None
+		self.progressive = False
+		self.lossless = False
+		self.arithmetic = False
+		self.quant = set()
+		self.dc = set()
+		self.ac = set()
+		self.restart_interval = 0
+
+	def error(self, pos, message):
+		self.verdict.errors.append("@{}: {}".format(pos, message))
+
+	def warning(self, pos, message):
+		self.verdict.warnings.append("@{}: {}".format(pos, message))
+
+	def truncated(self, pos, message):
+		self.verdict.truncated = True
+		self.error(pos, message)
+
+	def run(self):
+		buf = self.buf
+		if buf[:2] != b"\xff\xd8":
+			self.error(0, "missing SOI")
+			return
+
+		pos = 2
+		while True:
+			if pos >= self.size:
+				self.truncated(pos, "file ends before EOI")
+				return
+			if buf[pos] != 0xFF:
+				self.error(pos, "expected a marker, found 0x{:02x}".format(buf[pos]))
+				return
+			while pos + 1 < self.size and buf[pos + 1] == 0xFF:
+				pos += 1
+			if pos + 1 >= self.size:
+				self.truncated(pos, "file ends in the middle of a marker")
+				return
+
+			code = buf[pos + 1]
+			if code == Marker.EOI.value:
+				self.verdict.eoi = pos
+				self.verdict.trailing = self.size - pos - 2
+				if self.verdict.trailing:
+					self.warning(pos + 2, "{} bytes after EOI".format(self.verdict.trailing))
+				if self.verdict.scans == 0:
+					self.error(pos, "EOI before any scan")
+				return
+			if code == Marker.SOI.value:
+				self.error(pos, "SOI in the middle of the file")
+				return
+			if Marker.RST0.value <= code <= Marker.RST7.value:
+				self.error(pos, "RST{} outside of entropy coded data".format(code - Marker.RST0.value))
+				pos += 2
+				continue
+			if code == TEM:
+				pos += 2
+				continue
+			try:
+				Marker(code)
+			except ValueError:
+				self.error(pos, "invalid marker 0x{:02x}".format(code))
+				return
+
+			if pos + 4 > self.size:
+				self.truncated(pos, "file ends in the middle of a segment length")
+				return
+			length = struct.unpack_from(">H", buf, pos + 2)[0]
+			if length < 2:
+				self.error(pos, "segment length {} is too short".format(length))
+				return
+			if pos + 2 + length > self.size:
+				self.truncated(pos, "{} segment runs {} bytes past the end of the file".format(Marker(code).name, pos + 2 + length - self.size))
+				return
+
+			payload = buf[pos + 4:pos + 2 + length]
+			if code in SOF_CODES:
+				self.check_sof(pos, code, payload)
+			elif code == Marker.DQT.value:
+				self.check_dqt(pos, payload)
+			elif code == Marker.DHT.value:
+				self.check_dht(pos, payload)
+			elif code == Marker.DRI.value:
+				if len(payload) != 2:
+					self.error(pos, "DRI segment is {} bytes, should be 2".format(len(payload)))
+				else:
+					self.restart_interval = struct.unpack(">H", payload)[0]
+			pos += 2 + length
+
+			if code == Marker.SOS.value:
+				scan = self.check_sos(pos - 2 - length, payload)
+				pos = self.check_entropy(pos, scan)
+				if pos is None:
+					return
+
+	def check_sof(self, pos, code, payload):
+		if self.frame is not None:
+			self.error(pos, "more than one frame header")
+			return
+		if len(payload) < 6:
+			self.error(pos, "frame header is cut short")
+			return
+		(precision, lines, samples, count) = struct.unpack_from(">BHHB", payload)
+		if len(payload) != 6 + 3 * count:
+			self.error(pos, "frame header is {} bytes for {} components, should be {}".format(len(payload), count, 6 + 3 * count))
+			return
+		if count == 0:
+			self.error(pos, "frame has no components")
+		if samples == 0:
+			self.error(pos, "frame has no width")
+		if lines == 0:
+			self.warning(pos, "frame height left to a DNL segment")
+		if code in LOSSLESS_CODES:
+			if not 2 <= precision <= 16:
+				self.error(pos, "{} bit samples aren't valid for {}".format(precision, Marker(code).name))
+		elif precision not in (8, 12, 16) or (code == Marker.SOF0.value and precision != 8):
+			self.error(pos, "{} bit samples aren't valid for {}".format(precision, Marker(code).name))
+
+		components = {}
+		for i in range(count):
+			(cid, sampling, tq) = struct.unpack_from(">BBB", payload, 6 + 3 * i)
+			(h, v) = (sampling >> 4, sampling & 0x0F)
+			if not (1 <= h <= 4 and 1 <= v <= 4):
+				self.error(pos, "component {} has sampling factors {}x{}".format(cid, h, v))
+				h = v = 1
+			if tq > 3:
+				self.error(pos, "component {} uses quantization table {}".format(cid, tq))
+			if cid in components:
+				self.error(pos, "component {} defined twice".format(cid))
+			components[cid] = {"h_sample": h, "v_sample": v, "quant_dest": tq}
+		self.frame = {"sample_precision": precision, "lines": lines, "samples_per_line": samples, "components": components}
+		self.progressive = code in PROGRESSIVE_CODES
+		self.lossless = code in LOSSLESS_CODES
+		self.arithmetic = code in ARITHMETIC_CODES
+		(self.hmax, self.vmax) = layout_components(self.frame)
+
+	def check_dqt(self, pos, payload):
+		offset = 0
+		while offset < len(payload):
+			(precision, tid) = (payload[offset] >> 4, payload[offset] & 0x0F)
+			if precision > 1 or tid > 3:
+				self.error(pos, "quantization table {} with precision {}".format(tid, precision))
+				return
+			size = 128 if precision else 64
+			table = payload[offset + 1:offset + 1 + size]
+			if len(table) < size:
+				self.error(pos, "quantization table {} is cut short".format(tid))
+				return
+			values = struct.unpack(">64H", table) if precision else table
+			if 0 in values:
+				self.warning(pos, "quantization table {} has zero entries".format(tid))
+			self.quant.add(tid)
+			offset += 1 + size
+
+	def check_dht(self, pos, payload):
+		offset = 0
+		while offset < len(payload):
+			(tclass, tid) = (payload[offset] >> 4, payload[offset] & 0x0F)
+			if tclass > 1 or tid > 3:
+				self.error(pos, "huffman table {} of class {}".format(tid, tclass))
+				return
+			counts = payload[offset + 1:offset + 17]
+			if len(counts) < 16 or offset + 17 + sum(counts) > len(payload):
+				self.error(pos, "huffman table {}/{} is cut short".format(tclass, tid))
+				return
+			# kraft inequality, more codes than fit in 16 bits means the table can't be built
+			if sum(count << (16 - length) for (length, count) in enumerate(counts, 1)) > 1 << 16:
+				self.error(pos, "huffman table {}/{} has more codes than its lengths allow".format(tclass, tid))
+			(self.ac if tclass else self.dc).add(tid)
+			offset += 17 + sum(counts)
+
+	def check_sos(self, pos, payload):
+		"""
+		Checks a scan header against the frame and tables, returns the scan's components for counting restart intervals
+		"""
+		self.verdict.scans += 1
+		if self.frame is None:
+			self.error(pos, "scan before the frame header")
+			return None
+		if not payload:
+			self.error(pos, "empty scan header")
+			return None
+		count = payload[0]
+		if not 1 <= count <= 4 or len(payload) != 4 + 2 * count:
+			self.error(pos, "scan header is {} bytes for {} components, should be {}".format(len(payload), count, 4 + 2 * count))
+			return None
+		(ss, se, approximation) = payload[1 + 2 * count:4 + 2 * count]
+		(ah, al) = (approximation >> 4, approximation & 0x0F)
+
+		components = []
+		seen = set()
+		for i in range(count):
+			(cid, tables) = payload[1 + 2 * i:3 + 2 * i]
+			(td, ta) = (tables >> 4, tables & 0x0F)
+			spec = self.frame['components'].get(cid)
+			if spec is None:
+				self.error(pos, "scan uses component {} which isn't in the frame".format(cid))
+				continue
+			if cid in seen:
+				self.error(pos, "scan lists component {} twice".format(cid))
+			seen.add(cid)
+			components.append(spec)
+			# lossless frames aren't quantized, their Tq is just 0
+			if not self.lossless and spec['quant_dest'] not in self.quant:
+				self.error(pos, "component {} needs quantization table {} which isn't defined".format(cid, spec['quant_dest']))
+			if self.arithmetic:
+				continue
+			# lossless scans code every sample with the DC tables, Ss being the predictor
+			if (ss == 0 or self.lossless) and ah == 0 and td not in self.dc:
+				self.error(pos, "component {} needs DC table {} which isn't defined".format(cid, td))
+			if se > 0 and ta not in self.ac:
+				self.error(pos, "component {} needs AC table {} which isn't defined".format(cid, ta))
+
+		if self.lossless:
+			if not 1 <= ss <= 7 or se != 0 or ah != 0 or al > 15:
+				self.error(pos, "lossless scan with predictor {} Se={} Ah={} Al={}".format(ss, se, ah, al))
+		elif self.progressive:
+			if se > 63 or ss > se or (ss == 0 and se != 0) or (ss > 0 and count != 1) or ah > 13 or al > 13:
+				self.error(pos, "invalid progression Ss={} Se={} Ah={} Al={} for {} components".format(ss, se, ah, al, count))
+		elif (ss, se, ah, al) != (0, 63, 0, 0):
+			self.error(pos, "sequential scan with Ss={} Se={} Ah={} Al={}".format(ss, se, ah, al))
+		if count > 1 and sum(spec['h_sample'] * spec['v_sample'] for spec in components) > 10:
+			self.error(pos, "more than 10 blocks per MCU")
+		return components
+
+	def check_entropy(self, pos, components):
+		"""
+		Searches the entropy coded data from pos for the marker ending it, checking the RSTn on the way.
+		Returns where that marker is or None if the data runs off the end of the file.
+		"""
+		start = pos
+		expected = 0
+		restarts = 0
+		for match in ENTROPY_MARKER.finditer(self.buf, pos):
+			code = self.buf[match.end() - 1]
+			if Marker.RST0.value <= code <= Marker.RST7.value:
+				if not self.restart_interval:
+					self.warning(match.start(), "RST{} without a restart interval".format(code - Marker.RST0.value))
+				elif code - Marker.RST0.value != expected:
+					self.error(match.start(), "RST{} out of sequence, expected RST{}".format(code - Marker.RST0.value, expected))
+				expected = (code - Marker.RST0.value + 1) % 8
+				restarts += 1
+				continue
+
+			end = match.end() - 2
+			if end == start:
+				self.warning(start, "scan has no entropy coded data")
+			# with the height left to DNL there's no knowing how many MCUs the scan has
+			if self.restart_interval and components and self.frame['lines']:
+				wanted = math.ceil(self.scan_mcus(components) / self.restart_interval) - 1
+				if restarts != wanted:
+					self.error(start, "scan has {} restart markers, {} MCUs at {} per interval need {}".format(restarts, self.scan_mcus(components), self.restart_interval, wanted))
+			return end
+
+		self.truncated(start, "entropy coded data runs to the end of the file")
+		return None
+
+	def scan_mcus(self, components):
+		# lossless data units are single samples rather than 8x8 blocks
+		unit = 1 if self.lossless else 8
+		if len(components) == 1:
+			spec = components[0]
+			return math.ceil(spec['x'] / unit) * math.ceil(spec['y'] / unit)
+		lines = self.frame['lines']
+		return math.ceil(self.frame['samples_per_line'] / (unit * self.hmax)) * math.ceil(lines / (unit * self.vmax))
+
+
+def validate(path):
+	"""
+	Structured verdict on whether the jpeg at path is complete and well formed, see Validator
+	"""
+	verdict = Bunch(path=str(path), ok=False, errors=[], warnings=[], truncated=False, eoi=None, trailing=0, scans=0, size=0)
+	with open(path, "rb") as handle:
+		verdict.size = os.fstat(handle.fileno()).st_size
+		if verdict.size == 0:
+			verdict.errors.append("@0: empty file")
+			verdict.truncated = True
+			return verdict
+		with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			Validator(buf, verdict).run()
+	verdict.ok = not verdict.errors
+	return verdict
+
+
+def validate_directory(root, workers=None, pattern="**/*.jpg"):
+	"""
+	Validates every jpeg under root on a process pool, yielding verdicts in the order the files were found
+	"""
+	paths = [str(path) for path in Path(root).glob(pattern) if path.is_file()]
+	with ProcessPoolExecutor(workers) as pool:
+		yield from pool.map(validate, paths, chunksize=16)
@@ -0,0 +1,551 @@
+# coding=utf-8
+
+import logging
+import struct
+
+from enum import Enum
+
+from formats.exif import IFD, IFDTagType, Type
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class MakerNoteError(Exception):
+	pass
+
+
+class CanonTagType(Enum):
+	CameraSettings = 0x1
+	FocalLength = 0x2
+	FlashInfo = 0x3
+	ShotInfo = 0x4
+	Panorama = 0x5
+	ImageType = 0x6
+	FirmwareVersion = 0x7
+	FileNumber = 0x8
+	OwnerName = 0x9
+	SerialNumber = 0xC
+	CameraInfo = 0xD
+	CustomFunctions = 0xF
+	ModelID = 0x10
+	AFInfo = 0x12
+	ThumbnailImageValidArea = 0x13
+	SerialNumberFormat = 0x15
+	SuperMacro = 0x1A
+	DateStampMode = 0x1C
+	FirmwareRevision = 0x1E
+	Categories = 0x23
+	FaceDetect1 = 0x24
+	FaceDetect2 = 0x25
+	AFInfo2 = 0x26
+	ImageUniqueID = 0x28
+	FileInfo = 0x93
+	LensModel = 0x95
+	InternalSerialNumber = 0x96
+	DustRemovalData = 0x97
+	CropInfo = 0x98
+	CustomFunctions2 = 0x99
+	AspectInfo = 0x9A
+	ProcessingInfo = 0xA0
+	MeasuredColor = 0xAA
+	ColorSpace = 0xB4
+	VRDOffset = 0xD0
+	SensorInfo = 0xE0
+	ColorData = 0x4001
+	LensInfo = 0x4019
+
+
+class NikonTagType(Enum):
+	MakerNoteVersion = 0x1
+	ISO = 0x2
+	ColorMode = 0x3
+	Quality = 0x4
+	WhiteBalance = 0x5
+	Sharpness = 0x6
+	FocusMode = 0x7
+	FlashSetting = 0x8
+	FlashType = 0x9
+	WhiteBalanceFineTune = 0xB
+	WBRBLevels = 0xC
+	ProgramShift = 0xD
+	ExposureDifference = 0xE
+	PreviewIFD = 0x11
+	FlashExposureComp = 0x12
+	ISOSetting = 0x13
+	ImageBoundary = 0x16
+	ExternalFlashExposureComp = 0x17
+	FlashExposureBracketValue = 0x18
+	ExposureBracketValue = 0x19
+	ImageProcessing = 0x1A
+	CropHiSpeed = 0x1B
+	ExposureTuning = 0x1C
+	SerialNumber = 0x1D
+	ColorSpace = 0x1E
+	VRInfo = 0x1F
+	ImageAuthentication = 0x20
+	ActiveDLighting = 0x22
+	PictureControlData = 0x23
+	WorldTime = 0x24
+	ISOInfo = 0x25
+	VignetteControl = 0x2A
+	DistortInfo = 0x2B
+	ImageSizeRAW = 0x3E
+	LensType = 0x83
+	Lens = 0x84
+	ManualFocusDistance = 0x85
+	DigitalZoom = 0x86
+	FlashMode = 0x87
+	AFInfo = 0x88
+	ShootingMode = 0x89
+	LensFStops = 0x8B
+	ContrastCurve = 0x8C
+	ColorHue = 0x8D
+	SceneMode = 0x8F
+	LightSource = 0x90
+	ShotInfo = 0x91
+	HueAdjustment = 0x92
+	NEFCompression = 0x93
+	Saturation = 0x94
+	NoiseReduction = 0x95
+	NEFLinearizationTable = 0x96
+	ColorBalance = 0x97
+	LensData = 0x98
+	RawImageCenter = 0x99
+	SensorPixelSize = 0x9A
+	SerialNumber2 = 0xA0
+	ImageDataSize = 0xA2
+	ImageCount = 0xA5
+	DeletedImageCount = 0xA6
+	ShutterCount = 0xA7
+	FlashInfo = 0xA8
+	ImageOptimization = 0xA9
+	VariProgram = 0xAB
+	ImageStabilization = 0xAC
+	AFResponse = 0xAD
+	MultiExposure = 0xB0
+	HighISONoiseReduction = 0xB1
+	PowerUpTime = 0xB6
+	AFInfo2 = 0xB7
+	FileInfo = 0xB8
+	AFTune = 0xB9
+	RetouchInfo = 0xBB
+	PictureControlData2 = 0xBD
+
+
+class SonyTagType(Enum):
+	CameraInfo = 0x10
+	FocusInfo = 0x20
+	Quality = 0x102
+	FlashExposureComp = 0x104
+	Teleconverter = 0x105
+	WhiteBalanceFineTune = 0x112
+	CameraSettings = 0x114
+	WhiteBalance = 0x115
+	ExtraInfo = 0x116
+	PrintIM = 0xE00
+	MultiBurstMode = 0x1000
+	MultiBurstImageWidth = 0x1001
+	MultiBurstImageHeight = 0x1002
+	Panorama = 0x1003
+	PreviewImage = 0x2001
+	Rating = 0x2002
+	Contrast = 0x2004
+	Saturation = 0x2005
+	Sharpness = 0x2006
+	Brightness = 0x2007
+	LongExposureNoiseReduction = 0x2008
+	HighISONoiseReduction = 0x2009
+	HDR = 0x200A
+	MultiFrameNoiseReduction = 0x200B
+	PictureEffect = 0x200E
+	SoftSkinEffect = 0x200F
+	VignettingCorrection = 0x2011
+	LateralChromaticAberration = 0x2012
+	DistortionCorrectionSetting = 0x2013
+	WBShiftABGM = 0x2014
+	AutoPortraitFramed = 0x2016
+	FocusMode = 0x201B
+	AFAreaModeSetting = 0x201C
+	FlexibleSpotPosition = 0x201D
+	AFPointSelected = 0x201E
+	AFPointsUsed = 0x2020
+	AFTracking = 0x2021
+	MultiFrameNREffect = 0x2023
+	WBShiftABGMPrecise = 0x2026
+	FocusLocation = 0x2027
+	VariableLowPassFilter = 0x2028
+	RAWFileType = 0x2029
+	PrioritySetInAWB = 0x202B
+	MeteringMode2 = 0x202C
+	ExposureStandardAdjustment = 0x202D
+	Quality2 = 0x202E
+	PixelShiftInfo = 0x202F
+	SerialNumber = 0x2031
+	Shadows = 0x2032
+	Highlights = 0x2033
+	Fade = 0x2034
+	SharpnessRange = 0x2035
+	Clarity = 0x2036
+	FocusFrameSize = 0x2037
+	JPEGHEIFSwitch = 0x2039
+	SonyModelID = 0xB001
+	CreativeStyle = 0xB020
+	ColorTemperature = 0xB021
+	ColorCompensationFilter = 0xB022
+	SceneMode = 0xB023
+	ZoneMatching = 0xB024
+	DynamicRangeOptimizer = 0xB025
+	ImageStabilization = 0xB026
+	LensType = 0xB027
+	MinoltaMakerNote = 0xB028
+	ColorMode = 0xB029
+	LensSpec = 0xB02A
+	FullImageSize = 0xB02B
+	PreviewImageSize = 0xB02C
+
+
+class FujifilmTagType(Enum):
+	Version = 0x0
+	InternalSerialNumber = 0x10
+	Quality = 0x1000
+	Sharpness = 0x1001
+	WhiteBalance = 0x1002
+	Saturation = 0x1003
+	Contrast = 0x1004
+	ColorTemperature = 0x1005
+	Contrast2 = 0x1006
+	WhiteBalanceFineTune = 0x100A
+	NoiseReduction = 0x100B
+	HighISONoiseReduction = 0x100E
+	FujiFlashMode = 0x1010
+	FlashExposureComp = 0x1011
+	Macro = 0x1020
+	FocusMode = 0x1021
+	AFMode = 0x1022
+	FocusPixel = 0x1023
+	SlowSync = 0x1030
+	PictureMode = 0x1031
+	ExposureCount = 0x1032
+	EXRAuto = 0x1033
+	EXRMode = 0x1034
+	ShadowTone = 0x1040
+	HighlightTone = 0x1041
+	DigitalZoom = 0x1044
+	LensModulationOptimizer = 0x1045
+	GrainEffect = 0x1047
+	ColorChromeEffect = 0x1048
+	BWAdjustment = 0x1049
+	ShutterType = 0x1050
+	AutoBracketing = 0x1100
+	SequenceNumber = 0x1101
+	DriveSettings = 0x1103
+	PanoramaAngle = 0x1153
+	PanoramaDirection = 0x1154
+	AdvancedFilter = 0x1201
+	ColorMode = 0x1210
+	BlurWarning = 0x1300
+	FocusWarning = 0x1301
+	ExposureWarning = 0x1302
+	DynamicRange = 0x1400
+	FilmMode = 0x1401
+	DynamicRangeSetting = 0x1402
+	DevelopmentDynamicRange = 0x1403
+	MinFocalLength = 0x1404
+	MaxFocalLength = 0x1405
+	MaxApertureAtMinFocal = 0x1406
+	MaxApertureAtMaxFocal = 0x1407
+	AutoDynamicRange = 0x140B
+	ImageStabilization = 0x1422
+	Rating = 0x1431
+	ImageGeneration = 0x1436
+	ImageCount = 0x1438
+	FlickerReduction = 0x1446
+	FileSource = 0x8000
+	OrderNumber = 0x8002
+	FrameNumber = 0x8003
+
+
+class OlympusTagType(Enum):
+	MakerNoteVersion = 0x0
+	MinoltaCameraSettingsOld = 0x1
+	MinoltaCameraSettings = 0x3
+	CompressedImageSize = 0x40
+	PreviewImageData = 0x81
+	PreviewImageStart = 0x88
+	PreviewImageLength = 0x89
+	ThumbnailImage = 0x100
+	BodyFirmwareVersion = 0x104
+	SpecialMode = 0x200
+	Quality = 0x201
+	Macro = 0x202
+	BWMode = 0x203
+	DigitalZoom = 0x204
+	FocalPlaneDiagonal = 0x205
+	LensDistortionParams = 0x206
+	CameraType = 0x207
+	TextInfo = 0x208
+	CameraID = 0x209
+	EpsonImageWidth = 0x20B
+	EpsonImageHeight = 0x20C
+	EpsonSoftware = 0x20D
+	PreCaptureFrames = 0x300
+	WhiteBoard = 0x301
+	OneTouchWB = 0x302
+	WhiteBalanceBracket = 0x303
+	WhiteBalanceBias = 0x304
+	SerialNumber = 0x404
+	DataDump = 0xF00
+	# pointers to IFDs of their own, see OlympusTagType.IFDPointer
+	Equipment = 0x2010
+	CameraSettings = 0x2020
+	RawDevelopment = 0x2030
+	RawDevelopment2 = 0x2031
+	ImageProcessing = 0x2040
+	FocusInfo = 0x2050
+	RawInfo = 0x3000
+
+
+class OlympusEquipmentTagType(Enum):
+	EquipmentVersion = 0x0
+	CameraType2 = 0x100
+	SerialNumber = 0x101
+	InternalSerialNumber = 0x102
+	FocalPlaneDiagonal = 0x103
+	BodyFirmwareVersion = 0x104
+	LensType = 0x201
+	LensSerialNumber = 0x202
+	LensModel = 0x203
+	LensFirmwareVersion = 0x204
+	MaxApertureAtMinFocal = 0x205
+	MaxApertureAtMaxFocal = 0x206
+	MinFocalLength = 0x207
+	MaxFocalLength = 0x208
+	MaxAperture = 0x20A
+	LensProperties = 0x20B
+	Extender = 0x301
+	ExtenderSerialNumber = 0x302
+	ExtenderModel = 0x303
+	ExtenderFirmwareVersion = 0x304
+	ConversionLens = 0x403
+	FlashType = 0x1000
+	FlashModel = 0x1001
+	FlashFirmwareVersion = 0x1002
+	FlashSerialNumber = 0x1003
+
+
+class OlympusCameraSettingsTagType(Enum):
+	CameraSettingsVersion = 0x0
+	PreviewImageValid = 0x100
+	PreviewImageStart = 0x101
+	PreviewImageLength = 0x102
+	ExposureMode = 0x200
+	AELock = 0x201
+	MeteringMode = 0x202
+	ExposureShift = 0x203
+	NDFilter = 0x204
+	MacroMode = 0x300
+	FocusMode = 0x301
+	FocusProcess = 0x302
+	AFSearch = 0x303
+	AFAreas = 0x304
+	AFPointSelected = 0x305
+	AFFineTune = 0x306
+	FlashMode = 0x400
+	FlashExposureComp = 0x401
+	WhiteBalance2 = 0x500
+	WhiteBalanceTemperature = 0x501
+	CustomSaturation = 0x503
+	ModifiedSaturation = 0x504
+	ContrastSetting = 0x505
+	SharpnessSetting = 0x506
+	ColorSpace = 0x507
+	SceneMode = 0x509
+	NoiseReduction = 0x50A
+	DistortionCorrection = 0x50B
+	ShadingCompensation = 0x50C
+	CompressionFactor = 0x50D
+	Gradation = 0x50F
+	PictureMode = 0x520
+	PictureModeSaturation = 0x521
+	ImageQuality2 = 0x603
+	ImageStabilization = 0x604
+	DriveMode = 0x600
+	ArtFilter = 0x529
+
+
+for tag_type in (CanonTagType, NikonTagType, SonyTagType, FujifilmTagType, OlympusTagType, OlympusEquipmentTagType, OlympusCameraSettingsTagType):
+	tag_type.type = {}
+
+OlympusTagType.IFDPointer = {
+	OlympusTagType.Equipment: OlympusEquipmentTagType,
+	OlympusTagType.CameraSettings: OlympusCameraSettingsTagType,
+	OlympusTagType.RawDevelopment: int,
+	OlympusTagType.RawDevelopment2: int,
+	OlympusTagType.ImageProcessing: int,
+	OlympusTagType.FocusInfo: int,
+	OlympusTagType.RawInfo: int
+}
+
+
+class Vendor(Enum):
+	Canon = 0
+	Nikon = 1
+	Sony = 2
+	Fujifilm = 3
+	Olympus = 4
+
+Vendor.tag_type = {
+	Vendor.Canon: CanonTagType,
+	Vendor.Nikon: NikonTagType,
+	Vendor.Sony: SonyTagType,
+	Vendor.Fujifilm: FujifilmTagType,
+	Vendor.Olympus: OlympusTagType
+}
+
+# the same few things under whatever each vendor calls them, (pointer, tag) for ones in a sub IFD
+Vendor.fields = {
+	Vendor.Canon: {
+		"serial": CanonTagType.SerialNumber,
+		"lens": CanonTagType.LensModel,
+		"owner": CanonTagType.OwnerName,
+		"firmware": CanonTagType.FirmwareVersion
+	},
+	Vendor.Nikon: {
+		"serial": NikonTagType.SerialNumber,
+		"lens": NikonTagType.Lens,
+		"shutter_count": NikonTagType.ShutterCount
+	},
+	Vendor.Sony: {
+		"serial": SonyTagType.SerialNumber,
+		"lens": SonyTagType.LensType
+	},
+	Vendor.Fujifilm: {
+		"serial": FujifilmTagType.InternalSerialNumber
+	},
+	Vendor.Olympus: {
+		"serial": (OlympusTagType.Equipment, OlympusEquipmentTagType.SerialNumber),
+		"lens": (OlympusTagType.Equipment, OlympusEquipmentTagType.LensModel),
+		"firmware": (OlympusTagType.Equipment, OlympusEquipmentTagType.BodyFirmwareVersion)
+	}
+}
+
+SONY_HEADERS = (b"SONY DSC \x00\x00\x00", b"SONY CAM \x00\x00\x00", b"SONY MOBILE\x00", b"\x00\x00SONY PIC\x00")
+
+
+def byte_order(mark):
+	if mark == b"II":
+		return "<"
+	elif mark == b"MM":
+		return ">"
+	raise MakerNoteError("Invalid byte order '{}'.".format(mark))
+
+
+def layout(data, make, endian):
+	"""
+	Works out (vendor, byte order, base, IFD offset) from the start of a MakerNote and the Make tag, positions relative
+	to the MakerNote. base is where the offsets in it count from, None being the exif's own TIFF header.
+	None when it's nothing we know.
+	"""
+	head = bytes(data[:18])
+	make = (make.decode("ascii", "replace") if isinstance(make, (bytes, memoryview)) else make or "").strip().upper()
+	if head.startswith(b"Nikon\x00\x02"):
+		# "Nikon\0", version, 2 bytes of nothing then a whole TIFF header of its own
+		endian = byte_order(head[10:12])
+		(magic, offset) = struct.unpack_from(endian + "HI", head, 12)
+		return (Vendor.Nikon, endian, 10, 10 + offset)
+	if head.startswith(b"Nikon\x00\x01"):
+		return (Vendor.Nikon, endian, None, 8)
+	if head.startswith(b"FUJIFILM") or head.startswith(b"GENERALE"):
+		# always little endian, offsets from the start of the MakerNote
+		return (Vendor.Fujifilm, "<", 0, struct.unpack_from("<I", head, 8)[0])
+	if head.startswith(b"OLYMPUS\x00"):
+		return (Vendor.Olympus, byte_order(head[8:10]), 0, 12)
+	if head.startswith(b"OM SYSTEM\x00"):
+		return (Vendor.Olympus, byte_order(head[12:14]), 0, 16)
+	if head.startswith(b"OLYMP\x00") or head.startswith(b"EPSON\x00"):
+		return (Vendor.Olympus, endian, None, 8)
+	if head.startswith(SONY_HEADERS):
+		return (Vendor.Sony, endian, None, 12)
+	# the ones without a header of their own
+	if make.startswith("CANON"):
+		return (Vendor.Canon, endian, None, 0)
+	if make.startswith("NIKON"):
+		return (Vendor.Nikon, endian, None, 0)
+	if make.startswith("SONY"):
+		return (Vendor.Sony, endian, None, 0)
+	return None
+
+
+class MakerNote(Bunch):
+	"""
+	A vendor's MakerNote read with the EXIF IFD machinery, tags being just as lazy as they are there.
+	Nothing is looked at until EXIF.makernote is asked for.
+	"""
+
+	@classmethod
+	def from_exif(cls, exif):
+		tag = exif.find(IFDTagType.MakerNote)
+		if tag is None or "offset" not in tag:
+			return None
+		make = exif.find(IFDTagType.Make)
+		buf = exif._buf
+		start = tag.offset
+		try:
+			found = layout(tag.data, make.value if make is not None else None, exif._endian)
+		except (MakerNoteError, struct.error) as e:
+			logger.warning("Couldn't make sense of the MakerNote: {}".format(e))
+			return None
+		if found is None:
+			logger.debug("Unknown MakerNote for {}".format(make.value if make is not None else None))
+			return None
+		(vendor, endian, base, offset) = found
+
+		self = cls(vendor=vendor)
+		if base is None:
+			(view, offset) = (buf, start + offset)
+		else:
+			(view, offset) = (buf[start + base:], offset - base)
+		# kept out of the dict, what sub IFDs need
+		object.__setattr__(self, "_raw", (view, endian))
+		object.__setattr__(self, "_sub", {})
+		self.ifd = IFD.from_buffer(view, offset, endian, tag_type=Vendor.tag_type[vendor])
+		return self
+
+	def find(self, tag):
+		return self.ifd.find(tag)
+
+	def sub(self, pointer):
+		"""
+		The IFD a pointer tag (like Olympus' Equipment) leads to, None if it isn't there
+		"""
+		if pointer not in self._sub:
+			tag = self.find(pointer)
+			ifd = None
+			if tag is not None:
+				(view, endian) = self._raw
+				# older ones store the IFD itself as an UNDEFINED value rather than pointing at it
+				offset = tag.get("offset") if tag.type == Type.UNDEFINED else tag.value
+				tag_type = getattr(type(pointer), "IFDPointer", {}).get(pointer, int)
+				if isinstance(offset, int):
+					ifd = IFD.from_buffer(view, offset, endian, tag_type=tag_type if tag_type is not int else Vendor.tag_type[self.vendor])
+			self._sub[pointer] = ifd
+		return self._sub[pointer]
+
+	def field(self, name):
+		"""
+		A common field ("serial", "lens", "shutter_count", "owner", "firmware") whichever vendor this is, None if it
+		doesn't have it
+		"""
+		where = Vendor.fields[self.vendor].get(name)
+		if where is None:
+			return None
+		if isinstance(where, tuple):
+			ifd = self.sub(where[0])
+			tag = ifd.find(where[1]) if ifd is not None else None
+		else:
+			tag = self.find(where)
+		return tag.value if tag is not None else None
@@ -0,0 +1,144 @@
+# coding=utf-8
+
+import logging
+import os
+import struct
+
+from enum import Enum
+
+from formats.exif import IFD
+from formats.structio import BytesStructIO, Endianess
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class MPFError(Exception):
+	pass
+
+
+class MPFTagType(Enum):
+	# MP index IFD
+	MPFVersion = 0xB000
+	NumberOfImages = 0xB001
+	MPEntry = 0xB002
+	ImageUIDList = 0xB003
+	TotalFrames = 0xB004
+	# MP attribute IFD
+	MPIndividualNum = 0xB101
+	PanOrientation = 0xB201
+	PanOverlapH = 0xB202
+	PanOverlapV = 0xB203
+	BaseViewpointNum = 0xB204
+	ConvergenceAngle = 0xB205
+	BaselineLength = 0xB206
+	VerticalDivergence = 0xB207
+	AxisDistanceX = 0xB208
+	AxisDistanceY = 0xB209
+	AxisDistanceZ = 0xB20A
+	YawAngle = 0xB20B
+	PitchAngle = 0xB20C
+	RollAngle = 0xB20D
+
+MPFTagType.type = {}
+
+
+class MPType(Enum):
+	Undefined = 0x000000
+	LargeThumbnailVGA = 0x010001
+	LargeThumbnailFullHD = 0x010002
+	Panorama = 0x020001
+	Disparity = 0x020002
+	MultiAngle = 0x020003
+	BaselinePrimary = 0x030000
+
+
+class MPEntry(Bunch):
+	"""
+	16 bytes each, attributes (flags, format and type), size, offset and two dependent image entry numbers.
+	Offsets count from the MPF TIFF header apart from the primary image's which is always 0, start is where it is in the file.
+	"""
+	SIZE = 16
+
+	@classmethod
+	def from_bytes(cls, buf, endian):
+		self = cls()
+		(attributes, self.size, self.offset, first, second) = struct.unpack(endian + "IIIHH", buf)
+		self.dependent_parent = bool(attributes & 0x80000000)
+		self.dependent_child = bool(attributes & 0x40000000)
+		self.representative = bool(attributes & 0x20000000)
+		# 0 is the only format there is, jpeg
+		self.format = (attributes >> 24) & 0x7
+		try:
+			self.type = MPType(attributes & 0xFFFFFF)
+		except ValueError:
+			self.type = attributes & 0xFFFFFF
+		self.dependents = [i for i in (first, second) if i]
+		self.start = None
+		return self
+
+
+class MPF(Bunch):
+	"""
+	APP2 MPF, a little TIFF of its own with an index IFD listing every image stored in the file (the primary one included)
+	and an attribute IFD for the image it's in
+	"""
+
+	@classmethod
+	def from_buffer(cls, buf):
+		self = cls()
+		raw = BytesStructIO(buf)
+		byte_order = raw.read(2)
+		if byte_order == b"II":
+			(endian, order) = (Endianess.LITTLE, "<")
+		elif byte_order == b"MM":
+			(endian, order) = (Endianess.BIG, ">")
+		else:
+			raise MPFError("Invalid byte order '{}'.".format(byte_order))
+		raw.set_endian(endian)
+		if raw.read_ushort() != 42:
+			raise MPFError("That wasn't 42, byte order might be wrong.")
+
+		raw.seek(raw.read_uint())
+		self.index = IFD.from_structio(raw, tag_type=MPFTagType)
+		self.attributes = None
+		if self.index.get("next"):
+			raw.seek(self.index.next)
+			self.attributes = IFD.from_structio(raw, tag_type=MPFTagType)
+
+		self.images = []
+		for tag in self.index.tags:
+			if tag.tag == MPFTagType.MPFVersion:
+				self.version = bytes(tag.value).decode("ascii", "replace") if isinstance(tag.value, (bytes, memoryview)) else tag.value
+			elif tag.tag == MPFTagType.MPEntry:
+				entries = tag.value
+				for i in range(0, len(entries) - MPEntry.SIZE + 1, MPEntry.SIZE):
+					self.images.append(MPEntry.from_bytes(entries[i:i + MPEntry.SIZE], order))
+		self.base = None
+		return self
+
+	def locate(self, base):
+		"""
+		Works out where each image is in the file, base being the file offset of the MPF TIFF header
+		"""
+		self.base = base
+		for image in self.images:
+			image.start = base + image.offset if image.offset else 0
+		return self
+
+	def read(self, handle, image):
+		"""
+		The bytes of one of the images (an MPEntry or its index), a single read straight from where it sits
+		"""
+		if not isinstance(image, MPEntry):
+			image = self.images[image]
+		if image.start is None:
+			raise MPFError("MPF hasn't been located in its file")
+		try:
+			return os.pread(handle.fileno(), image.size, image.start)
+		except (AttributeError, OSError):
+			handle.seek(image.start)
+			return handle.read(image.size)
@@ -1,6 +1,8 @@
 
 # coding=utf-8
 
+import io
+import os
 import pdb
 import struct
 import sys
@@ -9,8 +11,10 @@ import zlib
 from enum import Enum
 from pathlib import Path
 
+from formats.exif import EXIF
 from formats.icc import ICCProfile
 from formats.structio import BytesStructIO, Endianess
+from formats.util import Bunch
 
 
 class ParseError(Exception):
@@ -82,8 +86,9 @@ class PNG:
 
 		# EXIF
 		# http://www.cipa.jp/std/documents/e/DC-008-Translation-2016-E.pdf
+		'eXIf',
 		'exIf',
-		'zxIf'
+		'zxIf',
 
 		# XMP
 		# https://www.adobe.com/devnet/xmp.html
@@ -102,6 +107,7 @@ class PNG:
 
 		# Apple iOS/Mac OS
 		'iDOT',
+		'CgBI',
 
 		# GLDPNG Related
 		'tpNG',  # 000000004A80291F crcs to 474C4433 or in ASCII "GLD3"
@@ -122,6 +128,21 @@ class PNG:
 		LA = 4
 		RGBA = 6
 
+	class Trailing(Enum):
+		"""
+		What repair does with any data found after IEND
+		"""
+		KEEP = 0
+		TRUNCATE = 1
+		EXTRACT = 2
+
+	# big enough that copying IDAT is a handful of syscalls rather than thousands
+	REPAIR_BUFFER = 1024 * 1024
+	# roughly how many bytes of raw scanlines get converted at once when normalizing CgBI
+	BAND_SIZE = 1024 * 1024
+	IDAT_SIZE = 256 * 1024
+	IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
 	VALID_BIT_DEPTHS = {
 		ColorType.GRAYSCALE: [1, 2, 4, 8, 16],
 		ColorType.RGB: [8, 16],
@@ -171,6 +192,15 @@ class PNG:
 		def verify(self):
 			return zlib.crc32(self.data, zlib.crc32(self.cid)) == self.crc
 
+		def write(self, out):
+			"""
+			Writes the chunk to out with a freshly computed crc
+			"""
+			out.write(INT.pack(len(self.data)))
+			out.write(self.cid)
+			out.write(self.data)
+			out.write(INT.pack(zlib.crc32(self.data, zlib.crc32(self.cid))))
+
 		def decode(self):
 			try:
 				handler = getattr(Chunks, self.cname)
@@ -192,6 +222,7 @@ class PNG:
 		self.fp = self.file.open('rb')
 		self.stat = self.file.stat()
 		self.meta = None
+		self.cgbi = None
 		if self.fp.read(8) != PNG.MAGIC:
 			raise ParseError("not a png?")
 
@@ -209,7 +240,14 @@ class PNG:
 		return PNG.Chunk(self, length, self.fp.read(4), self.fp.read(length), int.from_bytes(self.fp.read(4), byteorder='big'))
 
 	def chunks(self):
+		# from the top every time, reading exif and the like moves fp around
+		self.fp.seek(len(PNG.MAGIC))
 		chunk = self._get_chunk()
+		if chunk.cname == "CgBI":
+			# apple "optimized" png, the real IHDR follows
+			self.cgbi = chunk.decode()
+			yield chunk
+			chunk = self._get_chunk()
 		if chunk.cname != "IHDR":
 			raise ParseError("first chunk was not IHDR")
 
@@ -241,6 +279,306 @@ class PNG:
 		if self.fp.tell() != self.stat.st_size:
 			print("{} has trailing data!".format(self.file))
 
+	def read_exif(self, tags=None):
+		"""
+		The EXIF from the eXIf chunk (with tags only those, see EXIF) or None, stops reading once it's found
+		"""
+		for chunk in self.chunks():
+			if chunk.cname in ("eXIf", "exIf"):
+				return EXIF.from_buffer(memoryview(chunk.data), tags)
+		return None
+
+	def find_chunk(self, *cids):
+		"""
+		(offset, length) of the first chunk with one of cids going by chunk headers alone, None if IEND comes first
+		"""
+		self.fp.seek(len(PNG.MAGIC))
+		while True:
+			start = self.fp.tell()
+			head = self.fp.read(8)
+			if len(head) < 8:
+				return None
+			(length, cid) = (INT.unpack_from(head)[0], head[4:])
+			if cid in cids:
+				return (start, length)
+			if cid == b"IEND":
+				return None
+			self.fp.seek(length + 4, io.SEEK_CUR)
+
+	def write_exif(self, changes, output=None):
+		"""
+		Changes tags in the eXIf chunk (see EXIF.patches and EXIF.to_bytes). With output None and every new value
+		fitting where the old one was the file is patched in place, a pwrite for each value and one for the chunk's crc.
+		Otherwise the chunk is rebuilt and the png streamed to output (or a temporary that then replaces this file),
+		a new eXIf going in before the first IDAT.
+		"""
+		found = self.find_chunk(b"eXIf", b"exIf")
+		if found is not None:
+			(start, length) = found
+			self.fp.seek(start + 4)
+			cid = self.fp.read(4)
+			data = self.fp.read(length)
+			exif = EXIF.from_buffer(data)
+			writes = exif.patches(changes) if output is None else None
+			if writes is not None:
+				patched = bytearray(data)
+				for (position, value) in writes:
+					patched[position:position + len(value)] = value
+				fd = os.open(str(self.file), os.O_WRONLY)
+				try:
+					for (position, value) in writes:
+						os.pwrite(fd, value, start + 8 + position)
+					os.pwrite(fd, INT.pack(zlib.crc32(patched, zlib.crc32(cid))), start + 8 + length)
+				finally:
+					os.close(fd)
+				return Bunch(path=str(self.file), output=str(self.file), patched=True)
+		else:
+			exif = EXIF.new()
+		chunk = PNG.Chunk(cid=b"eXIf", data=exif.to_bytes(changes))
+		target = output or "{}.exif".format(self.file)
+		try:
+			with open(target, "wb", buffering=PNG.REPAIR_BUFFER) as out:
+				out.write(PNG.MAGIC)
+				self.fp.seek(len(PNG.MAGIC))
+				pending = True
+				while True:
+					head = self.fp.read(8)
+					if len(head) < 8:
+						break
+					(length, cid) = (INT.unpack_from(head)[0], head[4:])
+					if cid in (b"eXIf", b"exIf") or (pending and cid == b"IDAT"):
+						if pending:
+							chunk.write(out)
+							pending = False
+						if cid != b"IDAT":
+							self.fp.seek(length + 4, io.SEEK_CUR)
+							continue
+					out.write(head)
+					self._stream(out, length + 4)
+					if cid == b"IEND":
+						break
+		except BaseException:
+			# half a png is no use as the output either
+			if os.path.exists(target):
+				os.remove(target)
+			raise
+		if output is None:
+			os.replace(target, str(self.file))
+		return Bunch(path=str(self.file), output=str(output or self.file), patched=False, size=len(chunk.data))
+
+	def _stream(self, out, count, crc=0):
+		while count > 0:
+			block = self.fp.read(min(count, PNG.REPAIR_BUFFER))
+			if len(block) == 0:
+				raise EOFError()
+			crc = zlib.crc32(block, crc)
+			out.write(block)
+			count -= len(block)
+		return crc
+
+	def repair(self, path, ancillary_only=False, trailing=Trailing.TRUNCATE, trailing_path=None):
+		"""
+		Copies this png to path in a single pass, recomputing any bad crcs along the way.
+		If ancillary_only is set a bad crc on a critical chunk raises CRCError instead of being fixed.
+		Chunks cut off by the end of the file are dropped and a missing IEND is synthesized,
+		data after IEND is handled according to trailing (EXTRACT writes it to trailing_path).
+		Chunk data is streamed through in REPAIR_BUFFER sized blocks, IDAT is never held in memory.
+		"""
+		if trailing == PNG.Trailing.EXTRACT and trailing_path is None:
+			raise ValueError("extracting trailing data needs a trailing_path")
+
+		report = Bunch(fixed=[], truncated=None, synthesized_iend=False, trailing=0)
+		size = self.stat.st_size
+		self.fp.seek(len(PNG.MAGIC))
+
+		# written next to path and only moved there once it's all done, a CRCError leaves nothing half written behind
+		target = "{}.repair".format(path)
+		try:
+			with open(target, "wb", buffering=PNG.REPAIR_BUFFER) as out:
+				out.write(PNG.MAGIC)
+				cid = None
+				while True:
+					start = self.fp.tell()
+					if start == size:
+						break
+
+					head = self.fp.read(8)
+					length = INT.unpack_from(head)[0] if len(head) == 8 else 0
+					cid = head[4:]
+					if start + 12 + length > size or any(c not in PNG.VALID_ASCII for c in cid):
+						# either cut off or we lost sync with the chunk stream, nothing after here is salvageable
+						report.truncated = start
+						break
+
+					out.write(head)
+					crc = self._stream(out, length, zlib.crc32(cid))
+					if INT.unpack(self.fp.read(4))[0] != crc:
+						ancillary = (cid[0] & PNG.FIFTH_BIT) == PNG.FIFTH_BIT
+						if ancillary_only and not ancillary:
+							raise CRCError("bad crc on critical chunk {}".format(cid.decode('ascii')))
+						report.fixed.append(cid.decode('ascii'))
+					out.write(INT.pack(crc))
+
+					if cid == b"IEND":
+						break
+
+				if cid != b"IEND" or report.truncated is not None:
+					out.write(PNG.IEND)
+					report.synthesized_iend = True
+				else:
+					report.trailing = size - self.fp.tell()
+					if report.trailing > 0:
+						if trailing == PNG.Trailing.KEEP:
+							self._stream(out, report.trailing)
+						elif trailing == PNG.Trailing.EXTRACT:
+							with open(trailing_path, "wb", buffering=PNG.REPAIR_BUFFER) as extra:
+								self._stream(extra, report.trailing)
+		except BaseException:
+			if os.path.exists(target):
+				os.remove(target)
+			raise
+		os.replace(target, str(path))
+		return report
+
+	def normalize_cgbi(self, path):
+		"""
+		Converts an apple CgBI png (raw deflate, BGR(A), premultiplied alpha) into a standard png at path.
+		Scanlines are inflated, unfiltered, swizzled and unpremultiplied a band of roughly BAND_SIZE bytes at a time,
+		then re-deflated into IDAT_SIZE chunks so the whole image is never in memory.
+		"""
+		import numpy as np
+
+		# written next to path and only moved there once it's all done, nothing half written is left behind
+		target = "{}.cgbi".format(path)
+		try:
+			with open(target, "wb", buffering=PNG.REPAIR_BUFFER) as out:
+				out.write(PNG.MAGIC)
+				chunks = self.chunks()
+				for chunk in chunks:
+					if chunk.cname == "IHDR":
+						meta = self.meta
+						if self.cgbi is None:
+							raise ParseError("not a CgBI png")
+						if meta.color_type not in (PNG.ColorType.RGB, PNG.ColorType.RGBA) or meta.bit_depth != 8:
+							raise ParseError("can't normalize CgBI with color type {} and bit depth {}".format(meta.color_type, meta.bit_depth))
+						if meta.interlace != Interlace.NONE:
+							raise ParseError("can't normalize interlaced CgBI")
+					elif chunk.cname == "IDAT":
+						chunk = self._normalize_idat(np, out, chunk, chunks)
+					if chunk.cname in ("CgBI", "iDOT"):
+						# iDOT points into the old IDATs, after re-encoding it's just wrong
+						continue
+					chunk.write(out)
+		except BaseException:
+			if os.path.exists(target):
+				os.remove(target)
+			raise
+		os.replace(target, str(path))
+
+	def _normalize_idat(self, np, out, chunk, chunks):
+		bpp = 4 if self.meta.color_type == PNG.ColorType.RGBA else 3
+		stride = 1 + self.meta.width * bpp
+		band = max(1, PNG.BAND_SIZE // stride) * stride
+		inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+		deflate = zlib.compressobj()
+		pending = bytearray()
+		compressed = bytearray()
+		prev = np.zeros(stride - 1, dtype=np.uint8)
+		rows = 0
+
+		def convert(data):
+			nonlocal prev, rows
+			lines = np.frombuffer(bytes(data), dtype=np.uint8).reshape(-1, stride)[:self.meta.height - rows]
+			if len(lines) == 0:
+				return
+			pixels = np.empty((len(lines), stride - 1), dtype=np.uint8)
+			# runs of lines with the same filter get undone together
+			edges = [0] + (np.flatnonzero(np.diff(lines[:, 0])) + 1).tolist() + [len(lines)]
+			for (first, last) in zip(edges, edges[1:]):
+				pixels[first:last] = unfilter(np, lines[first, 0], lines[first:last, 1:], prev, bpp)
+				prev = pixels[last - 1]
+			rows += len(lines)
+
+			pixels = pixels.reshape(len(lines), -1, bpp)
+			swizzled = pixels[..., [2, 1, 0, 3][:bpp]]
+			if bpp == 4:
+				alpha = swizzled[..., 3:].astype(np.uint16)
+				color = swizzled[..., :3].astype(np.uint16)
+				color = np.where(alpha > 0, (color * 255 + alpha // 2) // np.maximum(alpha, 1), 0)
+				swizzled[..., :3] = np.minimum(color, 255)
+
+			filtered = np.zeros((len(lines), stride), dtype=np.uint8)
+			filtered[:, 1:] = swizzled.reshape(len(lines), -1)
+			compressed.extend(deflate.compress(filtered.tobytes()))
+			while len(compressed) >= PNG.IDAT_SIZE:
+				PNG.Chunk(self, PNG.IDAT_SIZE, b"IDAT", bytes(compressed[:PNG.IDAT_SIZE])).write(out)
+				del compressed[:PNG.IDAT_SIZE]
+
+		while chunk.cname == "IDAT":
+			pending.extend(inflate.decompress(chunk.data))
+			usable = len(pending) - len(pending) % band
+			if usable > 0:
+				convert(pending[:usable])
+				del pending[:usable]
+			chunk = next(chunks)
+
+		pending.extend(inflate.flush())
+		convert(pending[:len(pending) - len(pending) % stride])
+		if rows != self.meta.height:
+			raise ParseError("CgBI image data ended after {} of {} rows".format(rows, self.meta.height))
+		compressed.extend(deflate.flush())
+		PNG.Chunk(self, len(compressed), b"IDAT", bytes(compressed)).write(out)
+		return chunk
+
+
+def unfilter(np, filter_type, lines, prev, bpp):
+	"""
+	Undoes the png filter on a run of scanlines that all use filter_type, prev being the already unfiltered line above
+	the first of them
+	"""
+	if filter_type == 0:
+		return lines
+	elif filter_type == 1:
+		return np.cumsum(lines.reshape(len(lines), -1, bpp), axis=1, dtype=np.uint8).reshape(len(lines), -1)
+	elif filter_type == 2:
+		# a run of up filtered lines is a running sum down the columns starting from the line above
+		return np.cumsum(np.vstack([prev, lines]), axis=0, dtype=np.uint8)[1:]
+	elif filter_type not in (3, 4):
+		raise ParseError("invalid filter type {}".format(filter_type))
+
+	# average and paeth depend on the byte just produced to the left, so each line is a loop over python ints,
+	# whatever only needs the line above gets worked out with numpy first
+	out = np.empty_like(lines)
+	for (row, line) in enumerate(lines):
+		data = line.tolist()
+		up = prev.tolist()
+		if filter_type == 3:
+			for i in range(bpp):
+				data[i] = (data[i] + (up[i] >> 1)) & 0xFF
+			for i in range(bpp, len(data)):
+				data[i] = (data[i] + ((data[i - bpp] + up[i]) >> 1)) & 0xFF
+		else:
+			# |p - a| with p = a + b - c is just |b - c|
+			distance = np.abs(prev[bpp:].astype(np.int16) - prev[:-bpp]).tolist()
+			for i in range(bpp):
+				data[i] = (data[i] + up[i]) & 0xFF
+			for i in range(bpp, len(data)):
+				(a, b, c) = (data[i - bpp], up[i], up[i - bpp])
+				pa = distance[i - bpp]
+				pb = a - c if a >= c else c - a
+				pc = a + b - c - c
+				if pc < 0:
+					pc = -pc
+				if pa <= pb and pa <= pc:
+					data[i] = (data[i] + a) & 0xFF
+				elif pb <= pc:
+					data[i] = (data[i] + b) & 0xFF
+				else:
+					data[i] = (data[i] + c) & 0xFF
+		out[row] = data
+		prev = out[row]
+	return out
+
 
 class Compression(Enum):
 	DEFLATE = 0
@@ -291,6 +629,14 @@ class Chunks:
 		def __repr__(self):
 			return str(self)
 
+	class CgBI(Base):
+		STRUCT = INT
+
+		def __init__(self, flags, **kwargs):
+			super().__init__(**kwargs)
+
+			self.flags = flags
+
 	class IHDR(Base):
 		STRUCT = struct.Struct(">2I5B")
 
@@ -406,6 +752,23 @@ class Chunks:
 				data = zlib.decompress(rest[1:])
 			return self(name, data, chunk=chunk)
 
+	class eXIf(Base):
+		def __init__(self, exif, **kwargs):
+			super().__init__(**kwargs)
+
+			self.exif = exif
+
+		@classmethod
+		def parse(self, png, chunk):
+			# same TIFF structure as in a jpeg's APP1 minus the "Exif\0\0", parsed straight out of the chunk data
+			return self(EXIF.from_buffer(memoryview(chunk.data)), chunk=chunk)
+
+		def __repr__(self):
+			return "{}: {}".format(self.__class__.__name__, self.exif)
+
+	# the name it had before it was registered
+	exIf = eXIf
+
 	class iCCP(zTXt):
 		def __init__(self, key, text, *args):
 			Chunks.Base.__init__(self, *args)
@@ -550,8 +913,29 @@ def main():
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument("file")
+	parser.add_argument("--repair", metavar="OUTPUT", help="write a repaired copy of file to OUTPUT")
+	parser.add_argument("--ancillary-only", action="store_true", help="only fix crcs of ancillary chunks")
+	parser.add_argument("--trailing", choices=[i.name.lower() for i in PNG.Trailing], default="truncate")
+	parser.add_argument("--trailing-output", help="where extracted trailing data goes")
+	parser.add_argument("--normalize-cgbi", metavar="OUTPUT", help="convert an apple CgBI png into a standard png at OUTPUT")
 	args = parser.parse_args()
 
+	if args.normalize_cgbi:
+		with PNG(args.file) as png:
+			try:
+				png.normalize_cgbi(args.normalize_cgbi)
+			except ParseError as e:
+				print("Failed on {}: {}".format(args.file, e.args[0]))
+		return
+
+	if args.repair:
+		with PNG(args.file) as png:
+			try:
+				print(png.repair(args.repair, ancillary_only=args.ancillary_only, trailing=PNG.Trailing[args.trailing.upper()], trailing_path=args.trailing_output))
+			except ParseError as e:
+				print("Failed on {}: {}".format(args.file, e.args[0]))
+		return
+
 	PNG.VERIFY = True
 	png = PNG(args.file)
 	try:
@@ -0,0 +1,323 @@
+# coding=utf-8
+
+import logging
+import math
+import mmap
+import zlib
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from formats.exif import EXIF, NATIVE, Compression, IFDTagType, PlanarConfiguration
+from formats.util import Bunch
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TIFFError(Exception):
+	pass
+
+
+def packbits(data):
+	"""
+	PackBits, a header byte n then n + 1 literal bytes (n < 128) or the next byte 257 - n times (n > 128), 128 is nothing
+	"""
+	data = bytes(data)
+	out = bytearray()
+	i = 0
+	while i < len(data):
+		n = data[i]
+		i += 1
+		if n < 128:
+			out += data[i:i + n + 1]
+			i += n + 1
+		elif n > 128:
+			out += data[i:i + 1] * (257 - n)
+			i += 1
+	return bytes(out)
+
+
+def lzw(data):
+	"""
+	TIFF's LZW, codes most significant bit first starting at 9 bits, growing a code early (at 511, 1023 and 2047)
+	"""
+	out = bytearray()
+	table = [bytes((i,)) for i in range(256)] + [b"", b""]
+	width = 9
+	bits = 0
+	held = 0
+	previous = None
+	for byte in bytes(data):
+		bits = (bits << 8) | byte
+		held += 8
+		while held >= width:
+			held -= width
+			code = bits >> held
+			bits &= (1 << held) - 1
+			if code == 256:
+				del table[258:]
+				width = 9
+				previous = None
+				continue
+			if code == 257:
+				return bytes(out)
+			if previous is None:
+				entry = table[code]
+			elif code < len(table):
+				entry = table[code]
+				table.append(previous + entry[:1])
+			else:
+				entry = previous + previous[:1]
+				table.append(entry)
+			out += entry
+			previous = entry
+			if len(table) + 1 >= 1 << width and width < 12:
+				width += 1
+	logger.debug("LZW data without an EOI code")
+	return bytes(out)
+
+
+DECODERS = {
+	Compression.PackBits: packbits,
+	Compression.LZW: lzw,
+	Compression.AdobeDeflate: zlib.decompress,
+	Compression.Deflate: zlib.decompress
+}
+
+# decoders that are plain python and hold the GIL the whole time, these go to processes instead of threads
+PURE_PYTHON = {Compression.PackBits, Compression.LZW}
+# chunks handed to each worker process at a time, they're small and pickling them one by one adds up
+CHUNKS_PER_TASK = 16
+
+
+def undo_predictor(data, width, samples, bits, endian):
+	"""
+	Horizontal differencing (Predictor 2), every sample being stored as the difference from the one left of it
+	"""
+	code = {8: "B", 16: "H", 32: "I" if array("I").itemsize == 4 else "L"}.get(bits)
+	if code is None:
+		raise TIFFError("Predictor for {} bit samples isn't supported".format(bits))
+	row = width * samples
+	try:
+		import numpy as np
+	except ImportError:
+		np = None
+	if np is not None:
+		stored = np.dtype("{}u{}".format(endian, bits // 8))
+		values = np.frombuffer(data, dtype=stored)
+		values = values[:len(values) - len(values) % row].reshape(-1, width, samples)
+		# wraps around just like the differences did, summed in native order and put back in the file's
+		return np.cumsum(values, axis=1, dtype=stored.newbyteorder("=")).astype(stored).tobytes()
+
+	values = array(code, bytes(data)[:len(data) - len(data) % (bits // 8)])
+	if endian != NATIVE:
+		values.byteswap()
+	mask = (1 << bits) - 1
+	for start in range(0, len(values) - len(values) % row, row):
+		for i in range(start + samples, start + row):
+			values[i] = (values[i] + values[i - samples]) & mask
+	if endian != NATIVE:
+		values.byteswap()
+	return values.tobytes()
+
+
+def decode_chunk(data, compression, predictor, width, samples, bits, endian):
+	"""
+	A chunk's bytes decompressed and with its predictor undone, left as they are for Uncompressed without one
+	"""
+	if compression != Compression.Uncompressed:
+		decoder = DECODERS.get(compression)
+		if decoder is None:
+			raise TIFFError("Can't decompress {}".format(compression))
+		data = decoder(data)
+	if predictor == 2:
+		data = undo_predictor(data, width, samples, bits, endian)
+	elif predictor != 1:
+		raise TIFFError("Predictor {} isn't supported".format(predictor))
+	return data
+
+
+def decode_packed(job):
+	return decode_chunk(*job)
+
+
+class Image(Bunch):
+	"""
+	The image in one IFD, as the strips or tiles (chunks) it's stored in. Chunks are views straight into the map,
+	decoding one only ever touches its own bytes.
+	"""
+
+	@classmethod
+	def from_ifd(cls, ifd, buf, endian, key):
+		def value(tag, default=None):
+			found = ifd.find(tag)
+			return default if found is None or found.value is None else found.value
+
+		self = cls(key=key)
+		self.width = value(IFDTagType.ImageWidth)
+		self.height = value(IFDTagType.ImageHeight)
+		if self.width is None or self.height is None:
+			raise TIFFError("IFD {} has image data but no size".format(key))
+		bits = value(IFDTagType.BitsPerSample, 1)
+		self.bits = list(bits) if isinstance(bits, (array, tuple, list)) else [bits]
+		self.samples = value(IFDTagType.SamplesPerPixel, 1)
+		self.compression = value(IFDTagType.Compression, Compression.Uncompressed)
+		self.predictor = value(IFDTagType.Predictor, 1)
+		self.planar = value(IFDTagType.PlanarConfiguration, PlanarConfiguration.Chunky)
+		self.photometric = value(IFDTagType.PhotometricInterpretation)
+		# bit 0 set is a reduced resolution version (thumbnails, previews) of another image
+		self.subfile = value(IFDTagType.NewSubfileType, 0)
+		self.tiled = ifd.find(IFDTagType.TileOffsets) is not None
+		if self.tiled:
+			self.chunk_width = value(IFDTagType.TileWidth)
+			self.chunk_height = value(IFDTagType.TileLength)
+			offsets = value(IFDTagType.TileOffsets)
+			counts = value(IFDTagType.TileByteCounts)
+		else:
+			self.chunk_width = self.width
+			self.chunk_height = min(value(IFDTagType.RowsPerStrip, self.height), self.height)
+			offsets = value(IFDTagType.StripOffsets)
+			counts = value(IFDTagType.StripByteCounts)
+		if self.chunk_width is None or self.chunk_height is None or counts is None:
+			raise TIFFError("IFD {} is missing how its image is laid out".format(key))
+		self.offsets = offsets if isinstance(offsets, array) else [offsets]
+		self.counts = counts if isinstance(counts, array) else [counts]
+		if len(self.offsets) != len(self.counts):
+			raise TIFFError("IFD {} has {} chunks but {} byte counts".format(key, len(self.offsets), len(self.counts)))
+		# kept out of the dict, where the chunks are read from
+		object.__setattr__(self, "_buf", buf)
+		object.__setattr__(self, "_endian", endian)
+		return self
+
+	@property
+	def across(self):
+		return math.ceil(self.width / self.chunk_width)
+
+	@property
+	def down(self):
+		return math.ceil(self.height / self.chunk_height)
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def position(self, i):
+		"""
+		(x, y, plane) of chunk i's top left corner in the image
+		"""
+		(plane, i) = divmod(i, self.across * self.down)
+		(row, column) = divmod(i, self.across)
+		return (column * self.chunk_width, row * self.chunk_height, plane)
+
+	def shape(self, i):
+		"""
+		(width, height) of the pixels chunk i holds, tiles are always full size (padded at the edges), strips aren't
+		"""
+		if self.tiled:
+			return (self.chunk_width, self.chunk_height)
+		(x, y, plane) = self.position(i)
+		return (self.width, min(self.chunk_height, self.height - y))
+
+	def chunk(self, i):
+		"""
+		Chunk i as it's stored, a view into the file without copying anything
+		"""
+		(offset, count) = (self.offsets[i], self.counts[i])
+		if offset + count > len(self._buf):
+			raise TIFFError("Chunk {} @ {} runs past the end of the file".format(i, offset))
+		return self._buf[offset:offset + count]
+
+	def layout(self, i):
+		"""
+		What decode_chunk needs to know besides chunk i's bytes
+		"""
+		samples = 1 if self.planar == PlanarConfiguration.Planar else self.samples
+		return (self.compression, self.predictor, self.shape(i)[0], samples, self.bits[0], self._endian)
+
+	def decode(self, i):
+		"""
+		Chunk i decompressed, uncompressed ones stay views into the file
+		"""
+		return decode_chunk(self.chunk(i), *self.layout(i))
+
+	def decode_all(self, workers=None):
+		"""
+		Every chunk decoded, in order. zlib lets go of the GIL while it works so Deflate (and Uncompressed) run on a
+		thread pool straight off the map, LZW and PackBits are plain python and go to a process pool instead with
+		each chunk copied over to it.
+		"""
+		if self.compression not in PURE_PYTHON:
+			with ThreadPoolExecutor(workers) as pool:
+				return list(pool.map(self.decode, range(len(self))))
+		with ProcessPoolExecutor(workers) as pool:
+			jobs = ((bytes(self.chunk(i)),) + self.layout(i) for i in range(len(self)))
+			return list(pool.map(decode_packed, jobs, chunksize=CHUNKS_PER_TASK))
+
+
+class TIFF(Bunch):
+	"""
+	A TIFF (or DNG, which is one, or BigTIFF) read through mmap, its IFDs as EXIF reads them and images for those that have one,
+	keyed the same way as exif.ifd.
+	Nothing but the IFDs gets read up front, image data is only touched when a chunk is asked for.
+	"""
+
+	def __init__(self, handle):
+		self.handle = handle
+		try:
+			object.__setattr__(self, "_map", mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+		except ValueError as e:
+			# empty files can't be mapped
+			handle.close()
+			raise TIFFError("Can't map {}: {}".format(getattr(handle, "name", handle), e))
+		try:
+			self.read(memoryview(self._map))
+		except BaseException:
+			self.close()
+			raise
+
+	def read(self, buf):
+		self.exif = EXIF(buf)
+		endian = self.exif._endian
+		self.images = {}
+		for (key, ifd) in self.exif.ifd.items():
+			if ifd.find(IFDTagType.StripOffsets) is None and ifd.find(IFDTagType.TileOffsets) is None:
+				continue
+			try:
+				self.images[key] = Image.from_ifd(ifd, buf, endian, key)
+			except TIFFError as e:
+				logger.warning(e)
+
+	@classmethod
+	def from_file(cls, path):
+		return cls(open(path, "rb"))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, one, two, three):
+		self.close()
+
+	def close(self):
+		self.handle.close()
+		try:
+			self._map.close()
+		except BufferError:
+			# views of it are still around (tag values, chunks), it goes once they do
+			logger.debug("Map is still in use, leaving it to be collected")
+
+	@property
+	def dng_version(self):
+		tag = self.exif.find(IFDTagType.DNGVersion)
+		return tuple(tag.value) if tag is not None else None
+
+	@property
+	def main(self):
+		"""
+		The full resolution image, for DNGs that's the raw data rather than the preview in the 0th IFD
+		"""
+		for image in self.images.values():
+			if not image.subfile & 1:
+				return image
+		return None